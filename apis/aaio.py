@@ -0,0 +1,52 @@
+"""
+Адаптер aaio.io. Запросы к API выполняет библиотека AaioAsync.
+"""
+import hashlib
+from typing import Mapping
+
+from AaioAsync import AaioAsync
+
+import config
+from apis.base import ProviderAdapter, BillInfo, WebhookEvent, ProviderError
+from apis.sessions import ProviderSessions
+from db import InvoiceInfo, InvoiceStatus
+
+
+def _get_webhook_sign(shop_id: str, amount: str, currency: str, key2: str, invoice_id: str):
+    return hashlib.sha256(f"{shop_id}:{amount}:{currency}:{key2}:{invoice_id}".encode('utf-8')).hexdigest()
+
+
+def is_sign_valid(sign: str, amount: str, currency: str, invoice_id: str) -> bool:
+    s = _get_webhook_sign(config.AAIO_SHOP_ID, amount, currency, config.AAIO_KEY2, invoice_id)
+    return s == sign
+
+
+class AaioAdapter(ProviderAdapter):
+    method_id = "aaio"
+    webhook_source = "form"
+    required_config = ("AAIO_API_KEY", "AAIO_SHOP_ID", "AAIO_KEY1", "AAIO_KEY2")
+
+    _aaio: AaioAsync
+
+    def __init__(self, sessions: ProviderSessions):
+        super().__init__(sessions)
+        self._aaio = AaioAsync(config.AAIO_API_KEY, config.AAIO_SHOP_ID, config.AAIO_KEY1)
+
+    async def create_bill(self, invoice_info: InvoiceInfo) -> BillInfo:
+        try:
+            url = await self._aaio.generatepaymenturl(invoice_info.amount, invoice_info.invoice_id, desc=invoice_info.comment)
+        except Exception as ex:
+            raise ProviderError(self.method_id) from ex
+        return BillInfo(url)
+
+    def verify_signature(self, data: dict, headers: Mapping[str, str]) -> bool:
+        if not all(key in data for key in ("sign", "amount", "currency", "order_id")):
+            return False
+        return is_sign_valid(str(data["sign"]), str(data["amount"]), str(data["currency"]), str(data["order_id"]))
+
+    def parse_webhook(self, data: dict) -> WebhookEvent | None:
+        missing = [key for key in ("order_id", "profit", "invoice_id") if key not in data]
+        if missing:
+            raise ValueError(f"Missing webhook fields: {', '.join(missing)}")
+        return WebhookEvent(self.method_id, str(data["order_id"]), InvoiceStatus.SUCCESS, float(data["profit"]),
+                            payment_method_invoice_id=str(data["invoice_id"]), transaction_id=str(data["invoice_id"]))
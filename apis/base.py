@@ -0,0 +1,113 @@
+"""
+Общий интерфейс платежных систем (адаптеров).
+Адаптер создает счет в платежной системе и разбирает присланные ею вебхуки.
+"""
+import datetime
+import time
+from abc import ABC, abstractmethod
+from dataclasses import dataclass, field
+from typing import Literal, Mapping
+
+from starlette.requests import Request
+
+import config
+from apis.sessions import ProviderSessions
+from db import InvoiceInfo, InvoiceStatus
+
+
+@dataclass
+class BillInfo:
+    """
+    Счет, созданный в платежной системе.
+    """
+    url: str    # страница оплаты
+    provider_invoice_id: str | None = None    # айди счета в платежной системе
+
+
+@dataclass
+class ProviderHealth:
+    ok: bool
+    detail: str = ""
+
+
+@dataclass
+class WebhookEvent:
+    """
+    Изменение статуса счета, о котором сообщила платежная система.
+    """
+    method_id: str
+    invoice_id: str
+    status: InvoiceStatus
+    credited: float | None = None
+    payed: datetime.datetime | None = None
+    payment_method_invoice_id: str | None = None
+    transaction_id: str | None = None    # айди транзакции в платежной системе, по нему распознаются повторы вебхука
+    received: float = field(default_factory=time.monotonic)
+    attempt: int = 0    # количество уже сделанных попыток применить событие
+
+
+class ProviderError(Exception):
+    """
+    Платежная система вернула ошибку при создании счета.
+    transient - ошибка на стороне платежной системы (ответ 5xx), которая говорит о ее неисправности;
+    отказ по существу запроса (например, недопустимая сумма) не transient и не размыкает предохранитель.
+    Если адаптер не может отличить одно от другого, ошибка считается transient.
+    """
+    transient: bool
+
+    def __init__(self, method_id: str, *args, transient: bool = True):
+        self.transient = transient
+        super().__init__(f"Payment method '{method_id}' returned an error.", *args)
+
+
+class ProviderAdapter(ABC):
+    """
+    Базовый класс адаптеров. Адаптер создается реестром providers.ProviderRegistry при первом обращении к платежной системе.
+    """
+
+    method_id: str
+    webhook_source: Literal["json", "form", "query"] = "json"    # откуда читать данные вебхука
+    required_config: tuple[str, ...] = ()    # параметры config, без которых адаптер не работает
+
+    _sessions: ProviderSessions
+
+    def __init__(self, sessions: ProviderSessions):
+        self._sessions = sessions
+
+    @abstractmethod
+    async def create_bill(self, invoice_info: InvoiceInfo) -> BillInfo:
+        """
+        Создает счет в платежной системе.
+        :raises ProviderError: платежная система отказала в создании счета
+        """
+
+    @abstractmethod
+    def parse_webhook(self, data: dict) -> WebhookEvent | None:
+        """
+        Преобразует данные вебхука в событие. Возвращает None, если вебхук не меняет статус счета.
+        :raises ValueError: данные вебхука некорректны (в том числе pydantic.ValidationError)
+        """
+
+    def verify_signature(self, data: dict, headers: Mapping[str, str]) -> bool:
+        """
+        Проверяет, что вебхук действительно прислан платежной системой.
+        """
+        return True
+
+    async def health(self) -> ProviderHealth:
+        """
+        Проверяет, что адаптер может работать. По умолчанию - что заданы все необходимые параметры config.
+        """
+        missing = [name for name in self.required_config if not getattr(config, name, None)]
+        if missing:
+            return ProviderHealth(False, f"Missing config: {', '.join(missing)}")
+        return ProviderHealth(True)
+
+    async def read_webhook_data(self, request: Request) -> dict:
+        match self.webhook_source:
+            case "form":
+                return dict(await request.form())
+            case "query":
+                return dict(request.query_params)
+            case _:
+                return await request.json()
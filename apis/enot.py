@@ -6,6 +6,15 @@ import hmac
 import hashlib
 from enum import Enum
 from pydantic import BaseModel, validator
+from typing import Mapping
+
+import config
+from apis.base import ProviderAdapter, BillInfo, WebhookEvent, ProviderError
+from apis.sessions import session_scope
+from db import InvoiceInfo, InvoiceStatus
+
+API_URL = getattr(config, "ENOT_API_URL", "https://api.enot.io").rstrip("/")    # в config можно указать адрес имитации из loadtest
+CREATE_INVOICE_URL = f"{API_URL}/invoice/create"
 
 
 @dataclass
@@ -22,7 +31,9 @@ class APIError(Exception):
     """Базовый класс для всех ошибок, возвращаемых API"""
     error_text: str
     status_code: int
-    def __init__(self, response: dict):
+    http_status: int    # код ответа HTTP
+    def __init__(self, response: dict, http_status: int = 200):
+        self.http_status = http_status
         self.error_text = response.get("error", "Unknown error")
         self.status_code = int(response.get("status", 0))
         super().__init__(f"({self.status_code}) {self.error_text}")
@@ -42,10 +53,12 @@ async def create_invoice_async(
         success_url: str | None = None,
         expire_minutes: int | None = None,
         include_services: list[str] | None = None,
-        exclude_services: str | None = None
+        exclude_services: str | None = None,
+        session: aiohttp.ClientSession | None = None,
 ):
     """
     Создает счет на оплату в сервисе enot.io
+    :param session: общая сессия из apis.sessions.ProviderSessions; если не передана, создается временная
     """
 
     data ={
@@ -73,8 +86,8 @@ async def create_invoice_async(
     if exclude_services is not None:
         data["exclude_service"] = exclude_services
 
-    async with aiohttp.ClientSession() as session:
-        async with session.post("https://api.enot.io/invoice/create",
+    async with session_scope(session) as session:
+        async with session.post(CREATE_INVOICE_URL,
                                 headers=__build_headers(secret_key),
                                 json=data,
                                 ) as response:
@@ -84,7 +97,7 @@ async def create_invoice_async(
                 except Exception as e:
                     response_json = {"code": response.status, "error": f"Failed to read JSON response: {str(e)}"}
 
-                raise APIError(response_json)
+                raise APIError(response_json, response.status)
 
             response_data: dict = (await response.json(encoding="utf-8")).get("data", {})
             invoice_info = EnotInvoiceInfo(
@@ -158,3 +171,44 @@ class EnotWebhook(BaseModel):
     @validator('pay_time', 'reject_time', 'refund_time', pre=True)
     def parse_datetime(cls, value):
         return datetime.datetime.strptime(value, '%Y-%m-%d %H:%M:%S')
+
+
+class EnotAdapter(ProviderAdapter):
+    method_id = "enot"
+    webhook_source = "json"
+    required_config = ("ENOT_SHOP_ID", "ENOT_SECRET_KEY", "ENOT_WEBHOOK_URL")
+
+    async def create_bill(self, invoice_info: InvoiceInfo) -> BillInfo:
+        try:
+            enot_invoice_info = await create_invoice_async(
+                shop_id=config.ENOT_SHOP_ID,
+                secret_key=config.ENOT_SECRET_KEY,
+                amount=invoice_info.amount,
+                order_id=invoice_info.invoice_id,
+                hook_url=config.ENOT_WEBHOOK_URL,
+                comment=invoice_info.comment,
+                success_url=config.SUCCESS_URL,
+                fail_url=config.FAILED_URL,
+                session=self._sessions.get(CREATE_INVOICE_URL),
+            )
+        except APIError as e:
+            raise ProviderError(self.method_id, transient=e.http_status >= 500) from e
+        return BillInfo(enot_invoice_info.url, enot_invoice_info.invoice_id)
+
+    def verify_signature(self, data: dict, headers: Mapping[str, str]) -> bool:
+        # подпись проверяется, только если в config задан дополнительный ключ из настроек кассы
+        secret = getattr(config, "ENOT_WEBHOOK_SECRET", None)
+        if not secret:
+            return True
+        return check_signature(data, headers.get("x-api-sha256-signature", ""), secret.encode("utf-8"))
+
+    def parse_webhook(self, data: dict) -> WebhookEvent | None:
+        webhook = EnotWebhook(**data)
+        if webhook.status == EnotWebhookStatus.success:
+            return WebhookEvent(self.method_id, str(webhook.order_id), InvoiceStatus.SUCCESS, float(webhook.credited),
+                                payed=webhook.pay_time, payment_method_invoice_id=str(webhook.invoice_id), transaction_id=str(webhook.invoice_id))
+        if webhook.status == EnotWebhookStatus.refund:
+            return None
+        status = InvoiceStatus.TIMEOUT if webhook.status == EnotWebhookStatus.expired else InvoiceStatus.ERROR
+        return WebhookEvent(self.method_id, str(webhook.order_id), status,
+                            payment_method_invoice_id=str(webhook.invoice_id), transaction_id=str(webhook.invoice_id))
@@ -0,0 +1,56 @@
+"""
+Адаптер lava.ru (бизнес-API). Запросы к API выполняет библиотека lava_api.
+"""
+import datetime
+from typing import Optional
+
+from lava_api.business import LavaBusinessAPI, CreateInvoiceException
+from pydantic import BaseModel
+
+import config
+from apis.base import ProviderAdapter, BillInfo, WebhookEvent, ProviderError
+from apis.sessions import ProviderSessions
+from db import InvoiceInfo, InvoiceStatus
+
+
+class LavaWebhook(BaseModel):
+    invoice_id: str
+    order_id: str
+    status: str
+    pay_time: str
+    amount: float
+    custom_fields: Optional[str | None] = None
+    credited: float
+
+
+class LavaAdapter(ProviderAdapter):
+    method_id = "lava"
+    webhook_source = "json"
+    required_config = ("LAVA_SECRET_KEY", "LAVA_SHOP_ID", "LAVA_WEBHOOK_URL")
+
+    _lava: LavaBusinessAPI
+
+    def __init__(self, sessions: ProviderSessions):
+        super().__init__(sessions)
+        self._lava = LavaBusinessAPI(config.LAVA_SECRET_KEY)
+
+    async def create_bill(self, invoice_info: InvoiceInfo) -> BillInfo:
+        try:
+            lava_invoice_info = await self._lava.create_invoice(invoice_info.amount, config.LAVA_SHOP_ID,
+                                                                order_id=invoice_info.invoice_id,
+                                                                comment=invoice_info.comment,
+                                                                webhook_url=config.LAVA_WEBHOOK_URL,
+                                                                success_url=config.SUCCESS_URL,
+                                                                fail_url=config.FAILED_URL)
+        except CreateInvoiceException as ex:
+            raise ProviderError(self.method_id) from ex
+        return BillInfo(lava_invoice_info.url, lava_invoice_info.invoice_id)
+
+    def parse_webhook(self, data: dict) -> WebhookEvent | None:
+        webhook = LavaWebhook(**data)
+        try:
+            pay_time = datetime.datetime.strptime(webhook.pay_time, "%Y-%m-%d %H:%M:%S")
+        except ValueError:
+            pay_time = None    # время оплаты не критично: будет записано время обработки вебхука
+        return WebhookEvent(self.method_id, str(webhook.order_id), InvoiceStatus.SUCCESS, float(webhook.credited),
+                            payed=pay_time, payment_method_invoice_id=str(webhook.invoice_id), transaction_id=str(webhook.invoice_id))
@@ -7,14 +7,23 @@ from enum import Enum
 from typing import Annotated
 import hmac
 import hashlib
+from typing import Mapping
 
-CREATE_INVOICE_URL = "https://nicepay.io/public/api/payment"
+import config
+from apis.base import ProviderAdapter, BillInfo, WebhookEvent, ProviderError
+from apis.sessions import session_scope
+from db import InvoiceInfo, InvoiceStatus
+
+API_URL = getattr(config, "NICEPAY_API_URL", "https://nicepay.io").rstrip("/")
+CREATE_INVOICE_URL = f"{API_URL}/public/api/payment"
 
 class APIError(Exception):
     """Базовый класс для всех ошибок, возвращаемых API"""
     error_text: str
     status: str
-    def __init__(self, response: dict):
+    http_status: int    # код ответа HTTP
+    def __init__(self, response: dict, http_status: int = 200):
+        self.http_status = http_status
         self.status = response.get("status", "")
         if "data" in response.keys() and "message" in response["data"].keys():
             self.error_text = response["data"]["message"]
@@ -41,9 +50,11 @@ async def create_invoice_async(merchant_id: str,
                                description: str | None = None,
                                method: str | None = None,
                                success_url: str | None = None,
-                               fail_url: str | None = None):
+                               fail_url: str | None = None,
+                               session: aiohttp.ClientSession | None = None):
     """
     https://nicepay.io/ru/docs/merchant/payment
+    :param session: общая сессия из apis.sessions.ProviderSessions; если не передана, создается временная
     """
 
     converted_amount = int(round(amount * 100))    # Сумма платежа в центах/копейках. Пример: 125.28 USD это 12528
@@ -57,7 +68,7 @@ async def create_invoice_async(merchant_id: str,
     if fail_url:
         data["fail_url"] = fail_url
 
-    async with aiohttp.ClientSession() as session:
+    async with session_scope(session) as session:
         async with session.post(CREATE_INVOICE_URL, json=data) as response:
             if response.status != 200:
                 try:
@@ -65,7 +76,7 @@ async def create_invoice_async(merchant_id: str,
                 except Exception as e:
                     response_json = {"status": "HTTP " + str(response.status), "data": {"message": f"Failed to read JSON response: {str(e)}"}}
 
-                raise APIError(response_json)
+                raise APIError(response_json, response.status)
 
             json = await response.json(encoding="utf-8")
             if json["status"] != "success":
@@ -113,4 +124,40 @@ def is_hash_valid(secret_key: str, data: dict):
 
     hash_calculated = hashlib.sha256(hash_string.encode()).hexdigest()
 
-    return hash_received == hash_calculated
\ No newline at end of file
+    return hash_received == hash_calculated
+
+
+class NicepayAdapter(ProviderAdapter):
+    method_id = "nicepay"
+    webhook_source = "query"
+    required_config = ("NICEPAY_MERCHANT_ID", "NICEPAY_SECRET_KEY")
+
+    async def create_bill(self, invoice_info: InvoiceInfo) -> BillInfo:
+        try:
+            nicepay_invoice_info = await create_invoice_async(config.NICEPAY_MERCHANT_ID,
+                                                              config.NICEPAY_SECRET_KEY,
+                                                              invoice_info.invoice_id,
+                                                              "customer@untstrong.ru",
+                                                              invoice_info.amount,
+                                                              "RUB",
+                                                              description=invoice_info.comment,
+                                                              success_url=config.SUCCESS_URL,
+                                                              fail_url=config.FAILED_URL,
+                                                              session=self._sessions.get(CREATE_INVOICE_URL),
+                                                              )
+        except APIError as e:
+            raise ProviderError(self.method_id, transient=e.http_status >= 500) from e
+        return BillInfo(nicepay_invoice_info.link, nicepay_invoice_info.payment_id)
+
+    def verify_signature(self, data: dict, headers: Mapping[str, str]) -> bool:
+        if "hash" not in data:
+            return False
+        return is_hash_valid(config.NICEPAY_SECRET_KEY, dict(data))    # is_hash_valid изменяет переданный словарь
+
+    def parse_webhook(self, data: dict) -> WebhookEvent | None:
+        webhook = NicepayWebhook(**data)
+        if webhook.result == WebhookInvoiceStatus.success:
+            return WebhookEvent(self.method_id, str(webhook.order_id), InvoiceStatus.SUCCESS, float(webhook.profit),
+                                payment_method_invoice_id=webhook.payment_id, transaction_id=webhook.payment_id)
+        return WebhookEvent(self.method_id, str(webhook.order_id), InvoiceStatus.ERROR,
+                            payment_method_invoice_id=webhook.payment_id, transaction_id=webhook.payment_id)
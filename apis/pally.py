@@ -5,7 +5,15 @@ from pydantic import BaseModel
 import hashlib
 import decimal
 
+from typing import Mapping
+
 import config
+from apis.base import ProviderAdapter, BillInfo, WebhookEvent, ProviderError
+from apis.sessions import session_scope
+from db import InvoiceInfo, InvoiceStatus
+
+API_URL = getattr(config, "PALLY_API_URL", "https://pal24.pro").rstrip("/")
+CREATE_BILL_URL = f"{API_URL}/api/v1/bill/create"
 
 
 @dataclass
@@ -19,8 +27,10 @@ class APIError(Exception):
 
     error_text: str
     status_code: int
+    http_status: int    # код ответа HTTP
 
-    def __init__(self, response: dict):
+    def __init__(self, response: dict, http_status: int = 200):
+        self.http_status = http_status
         super().__init__(str(response))
 
 
@@ -30,7 +40,11 @@ async def create_bill_async(shop_id: str,
                             order_id: str,
                             name: str,
                             description: str,
+                            session: aiohttp.ClientSession | None = None,
                             ):
+    """
+    :param session: общая сессия из apis.sessions.ProviderSessions; если не передана, создается временная
+    """
     data = {
         "shop_id": shop_id,
         "amount": amount,
@@ -41,8 +55,8 @@ async def create_bill_async(shop_id: str,
 
     headers = __build_headers(secret_key)
 
-    async with aiohttp.ClientSession() as session:
-        async with session.post("https://pal24.pro/api/v1/bill/create",
+    async with session_scope(session) as session:
+        async with session.post(CREATE_BILL_URL,
                                 headers=headers,
                                 data=data) as response:
             if response.status != 200:
@@ -54,7 +68,7 @@ async def create_bill_async(shop_id: str,
                         "error": f"Failed to read JSON response: {str(e)}",
                     }
 
-                raise APIError(response_json)
+                raise APIError(response_json, response.status)
 
             response_data: dict = (await response.json(encoding="utf-8"))
             return PallyBillInfo(
@@ -82,7 +96,43 @@ class PostbackForm(BaseModel):
     SignatureValue: str
 
 
-def is_signature_valid(signature: str, out_sum: decimal.Decimal, invoice_id: str) -> bool:
+def is_signature_valid(signature: str, out_sum: decimal.Decimal | str, invoice_id: str) -> bool:
     string = f"{out_sum}:{invoice_id}:{config.PALLY_SECRET_KEY}"
     sig = hashlib.md5(string.encode("utf-8")).hexdigest().lower()
     return sig == signature.lower()
+
+
+class PallyAdapter(ProviderAdapter):
+    method_id = "pally"
+    webhook_source = "form"
+    required_config = ("PALLY_SHOP_ID", "PALLY_SECRET_KEY")
+
+    async def create_bill(self, invoice_info: InvoiceInfo) -> BillInfo:
+        try:
+            bill = await create_bill_async(
+                config.PALLY_SHOP_ID,
+                config.PALLY_SECRET_KEY,
+                invoice_info.amount,
+                invoice_info.invoice_id,
+                invoice_info.comment,
+                invoice_info.comment,
+                session=self._sessions.get(CREATE_BILL_URL),
+            )
+        except APIError as e:
+            raise ProviderError(self.method_id, transient=e.http_status >= 500) from e
+        return BillInfo(bill.url, bill.id)
+
+    def verify_signature(self, data: dict, headers: Mapping[str, str]) -> bool:
+        # подпись считается от OutSum в том виде, в котором его прислала платежная система
+        if not all(key in data for key in ("SignatureValue", "OutSum", "InvId")):
+            return False
+        return is_signature_valid(data["SignatureValue"], data["OutSum"], data["InvId"])
+
+    def parse_webhook(self, data: dict) -> WebhookEvent | None:
+        webhook = PostbackForm(**data)
+        if webhook.Status in ("SUCCESS", "OVERPAID"):
+            # при создании счета сохраняется айди счета (bill_id), а вебхук приходит с айди транзакции;
+            # TrsId записывается в счет, чтобы повтор вебхука распознавался по БД и в другом процессе
+            return WebhookEvent(self.method_id, str(webhook.InvId), InvoiceStatus.SUCCESS, float(webhook.OutSum),
+                                payment_method_invoice_id=webhook.TrsId, transaction_id=webhook.TrsId)
+        return WebhookEvent(self.method_id, str(webhook.InvId), InvoiceStatus.ERROR, transaction_id=webhook.TrsId)
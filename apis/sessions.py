@@ -0,0 +1,98 @@
+"""
+Общие HTTP-сессии для запросов к API платежных систем.
+Для каждого хоста держится одна сессия aiohttp с keep-alive, кешем DNS и ограничением числа соединений,
+поэтому повторные запросы не тратят время на установку TCP и TLS.
+"""
+import contextlib
+from dataclasses import dataclass
+from urllib.parse import urlsplit
+
+import aiohttp
+
+from tracing import create_aiohttp_trace_config
+
+
+@dataclass
+class SessionStats:
+    host: str
+    limit_per_host: int
+    acquired: int    # соединения, занятые запросами
+    idle: int    # открытые keep-alive соединения, ожидающие следующего запроса
+
+
+class ProviderSessions:
+    """
+    Пул сессий aiohttp, по одной на хост. Создается при запуске приложения и закрывается при остановке.
+    """
+
+    _sessions: dict[str, aiohttp.ClientSession]
+    _limit_per_host: int
+    _keepalive_timeout: float
+    _dns_cache_ttl: int
+    _timeout: aiohttp.ClientTimeout
+
+    def __init__(self,
+                 limit_per_host: int = 20,
+                 keepalive_timeout: float = 60,
+                 dns_cache_ttl: int = 300,
+                 connect_timeout: float = 5,
+                 read_timeout: float = 15,
+                 total_timeout: float | None = 30):
+        """
+        :param limit_per_host: максимальное количество одновременных соединений с одним хостом
+        :param keepalive_timeout: сколько секунд держать простаивающее соединение открытым
+        :param dns_cache_ttl: время жизни записей в кеше DNS, сек
+        :param connect_timeout: таймаут установки соединения (включая ожидание свободного слота), сек
+        :param read_timeout: максимальная пауза между чтениями из сокета, сек
+        :param total_timeout: общий таймаут запроса, сек (None - без ограничения)
+        """
+        self._sessions = {}
+        self._limit_per_host = limit_per_host
+        self._keepalive_timeout = keepalive_timeout
+        self._dns_cache_ttl = dns_cache_ttl
+        self._timeout = aiohttp.ClientTimeout(total=total_timeout, connect=connect_timeout, sock_read=read_timeout)
+
+    def get(self, url: str) -> aiohttp.ClientSession:
+        """
+        Возвращает сессию для хоста, к которому относится url. Сессия создается при первом обращении.
+        """
+        host = urlsplit(url).netloc
+        session = self._sessions.get(host)
+        if session is None or session.closed:
+            connector = aiohttp.TCPConnector(limit_per_host=self._limit_per_host,
+                                             keepalive_timeout=self._keepalive_timeout,
+                                             ttl_dns_cache=self._dns_cache_ttl,
+                                             use_dns_cache=True)
+            session = aiohttp.ClientSession(connector=connector, timeout=self._timeout,
+                                            trace_configs=[create_aiohttp_trace_config()])
+            self._sessions[host] = session
+        return session
+
+    def get_stats(self) -> list[SessionStats]:
+        stats = []
+        for host, session in self._sessions.items():
+            connector = session.connector
+            if connector is None or connector.closed:
+                continue
+            idle = sum(len(conns) for conns in connector._conns.values())
+            stats.append(SessionStats(host, self._limit_per_host, len(connector._acquired), idle))
+        return stats
+
+    async def close_async(self):
+        sessions = list(self._sessions.values())
+        self._sessions.clear()
+        for session in sessions:
+            await session.close()
+
+
+@contextlib.asynccontextmanager
+async def session_scope(session: aiohttp.ClientSession | None):
+    """
+    Использует переданную сессию, не закрывая ее, или создает временную, если сессия не передана.
+    """
+    if session is not None:
+        yield session
+        return
+
+    async with aiohttp.ClientSession(trace_configs=[create_aiohttp_trace_config()]) as temp_session:
+        yield temp_session
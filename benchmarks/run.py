@@ -0,0 +1,236 @@
+"""
+Микробенчмарки кода, выполняемого при каждом платеже.
+Результаты сравниваются с benchmarks/baseline.json; замедление больше допустимого считается регрессией.
+
+    python -m benchmarks.run                     # сравнить с baseline.json
+    python -m benchmarks.run --save              # записать текущие результаты в baseline.json
+    python -m benchmarks.run -k signature        # только бенчмарки, в названии которых есть "signature"
+
+Базовые результаты нужно записывать на той же машине, на которой выполняется сравнение.
+"""
+import argparse
+import datetime
+import json
+import os
+import platform
+import sys
+import timeit
+from dataclasses import dataclass, asdict
+from typing import Callable
+
+import config
+
+BASELINE_PATH = os.path.join(os.path.dirname(__file__), "baseline.json")
+
+_BENCHMARKS: dict[str, Callable[[], Callable[[], object]]] = {}
+
+
+def benchmark(name: str):
+    """
+    Регистрирует бенчмарк. Декорируемая функция выполняет подготовку и возвращает измеряемую функцию без аргументов.
+    """
+    def decorator(setup: Callable[[], Callable[[], object]]):
+        _BENCHMARKS[name] = setup
+        return setup
+    return decorator
+
+
+ENOT_WEBHOOK = {
+    "invoice_id": "a3e9ff6f-c5c1-3bcd-854e-4bc995b1ae7a",
+    "status": "success",
+    "amount": "100.00",
+    "currency": "RUB",
+    "order_id": "c78d8fe9-ab44-3f21-a37a-ce4ca269cb47",
+    "pay_service": "card",
+    "payer_details": "553691******1279",
+    "custom_fields": '{"user": 1}',
+    "type": 1,
+    "credited": "95.50",
+    "pay_time": "2024-01-15 12:30:00",
+    "code": 1,
+}
+
+NICEPAY_WEBHOOK = {
+    "result": "success",
+    "payment_id": "bVz657-bd8755-040148-6c9b6c-e47dld",
+    "merchant_id": "657b475da365fbeb3e5cfaf6",
+    "order_id": "c78d8fe9-ab44-3f21-a37a-ce4ca269cb47",
+    "amount": "567000",
+    "amount_currency": "RUB",
+    "profit": "537000",
+    "profit_currency": "RUB",
+    "method": "card_rub",
+}
+
+PALLY_POSTBACK = {
+    "InvId": "c78d8fe9-ab44-3f21-a37a-ce4ca269cb47",
+    "OutSum": "100.00",
+    "Commission": "3.50",
+    "TrsId": "9c8d3e5a1b",
+    "Status": "SUCCESS",
+}
+
+
+@benchmark("signature.enot")
+def bench_enot_signature():
+    import hashlib
+    import hmac
+    from apis import enot
+
+    secret = b"enot-webhook-secret"
+    signed = json.dumps(ENOT_WEBHOOK, sort_keys=True, separators=(", ", ": ")).encode("utf-8")
+    signature = hmac.new(secret, signed, hashlib.sha256).hexdigest()
+    return lambda: enot.check_signature(ENOT_WEBHOOK, signature, secret)
+
+
+@benchmark("signature.nicepay")
+def bench_nicepay_hash():
+    from apis import nicepay
+
+    data = dict(NICEPAY_WEBHOOK, hash="0" * 64)
+    return lambda: nicepay.is_hash_valid(config.NICEPAY_SECRET_KEY, dict(data))    # is_hash_valid изменяет словарь
+
+
+@benchmark("signature.pally")
+def bench_pally_signature():
+    from apis import pally
+
+    return lambda: pally.is_signature_valid("0" * 32, PALLY_POSTBACK["OutSum"], PALLY_POSTBACK["InvId"])
+
+
+@benchmark("signature.aaio")
+def bench_aaio_sign():
+    from apis import aaio
+
+    return lambda: aaio.is_sign_valid("0" * 64, "100.00", "RUB", PALLY_POSTBACK["InvId"])
+
+
+@benchmark("parse.enot_webhook")
+def bench_parse_enot():
+    from apis import enot
+
+    return lambda: enot.EnotWebhook(**ENOT_WEBHOOK)
+
+
+@benchmark("parse.nicepay_webhook")
+def bench_parse_nicepay():
+    from apis import nicepay
+
+    data = dict(NICEPAY_WEBHOOK, hash="0" * 64)
+    return lambda: nicepay.NicepayWebhook(**data)
+
+
+@benchmark("parse.pally_postback")
+def bench_parse_pally():
+    from apis import pally
+
+    data = dict(PALLY_POSTBACK, SignatureValue="0" * 32)
+    return lambda: pally.PostbackForm(**data)
+
+
+@benchmark("db.invoice_from_row")
+def bench_invoice_from_row():
+    from db import DatabaseManager
+
+    row = ("c78d8fe9-ab44-3f21-a37a-ce4ca269cb47", "processing", 100.0, 0.0, datetime.datetime(2024, 1, 15, 12, 0), None,
+           "Пополнение баланса", '{"user": 1}', "https://example.com/webhook", "enot", "https://enot.io/pay/1",
+           "a3e9ff6f-c5c1-3bcd-854e-4bc995b1ae7a", None)
+    return lambda: DatabaseManager._invoice_from_row(row)
+
+
+# main не импортируется: при импорте он настраивает логирование, создает сервисы и HTTP-сессии.
+# Ответы повторяют main.ResponseCreateInvoice и main.PaymentMethod
+@dataclass
+class CreateInvoiceResponse:
+    status: str
+    id: str
+    url: str
+
+
+@dataclass
+class PaymentMethodResponse:
+    id: str
+    name: str
+    description: str
+    icon_url: str
+    instructions: str
+    available: bool
+
+
+@benchmark("serialize.create_invoice_response")
+def bench_serialize_create_invoice():
+    from fastapi.encoders import jsonable_encoder
+
+    response = CreateInvoiceResponse("success", "c78d8fe9-ab44-3f21-a37a-ce4ca269cb47",
+                                     "https://untstrong.ru/payment/c78d8fe9-ab44-3f21-a37a-ce4ca269cb47")
+    return lambda: json.dumps(jsonable_encoder(response), ensure_ascii=False, separators=(",", ":"))
+
+
+@benchmark("serialize.methods_list")
+def bench_serialize_methods():
+    methods = [PaymentMethodResponse(f"method{i}", f"Method {i}", "Банковские карты, СБП", f"https://example.com/{i}.png",
+                                     "Инструкция по оплате", True) for i in range(6)]
+    return lambda: json.dumps([asdict(m) for m in methods], ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+
+
+def measure(func: Callable[[], object], repeat: int, min_time: float) -> float:
+    """
+    Возвращает лучшее из repeat измерений времени одного вызова, нс.
+    """
+    timer = timeit.Timer(func)
+    number, elapsed = timer.autorange()
+    number = max(1, int(number * min_time / max(elapsed, 1e-9)))
+    return min(timer.repeat(repeat, number)) / number * 1e9
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Payment hot path microbenchmarks")
+    parser.add_argument("-k", dest="filter", default="", help="run only benchmarks whose name contains this string")
+    parser.add_argument("--save", action="store_true", help="write results to the baseline file")
+    parser.add_argument("--baseline", default=BASELINE_PATH)
+    parser.add_argument("--tolerance", type=float, default=0.2, help="allowed slowdown vs baseline, 0.2 = 20%%")
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--min-time", type=float, default=0.2, help="seconds per measurement")
+    args = parser.parse_args()
+
+    baseline = {}
+    if os.path.exists(args.baseline):
+        with open(args.baseline, encoding="utf-8") as f:
+            baseline = json.load(f).get("results", {})
+
+    results = {}
+    regressions = []
+    print(f"{'benchmark':<40}{'ns/op':>12}{'baseline':>12}{'change':>10}")
+    for name, setup in _BENCHMARKS.items():
+        if args.filter not in name:
+            continue
+        ns = measure(setup(), args.repeat, args.min_time)
+        results[name] = round(ns, 1)
+        base = baseline.get(name)
+        if base:
+            change = ns / base - 1
+            mark = "  REGRESSION" if change > args.tolerance else ""
+            if mark:
+                regressions.append(name)
+            print(f"{name:<40}{ns:>12.1f}{base:>12.1f}{change:>+10.1%}{mark}")
+        else:
+            print(f"{name:<40}{ns:>12.1f}{'-':>12}{'':>10}")
+
+    if args.save:
+        saved = {}
+        if os.path.exists(args.baseline):
+            with open(args.baseline, encoding="utf-8") as f:
+                saved = json.load(f).get("results", {})
+        saved.update(results)
+        with open(args.baseline, "w", encoding="utf-8") as f:
+            json.dump({"python": platform.python_version(), "machine": platform.machine(),
+                       "saved": datetime.datetime.now().isoformat(timespec="seconds"), "results": saved}, f, indent=2, sort_keys=True)
+            f.write("\n")
+        print(f"Baseline saved to {args.baseline}")
+    elif regressions:
+        print(f"Regressions (> {args.tolerance:.0%} slower): {', '.join(regressions)}")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
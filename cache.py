@@ -0,0 +1,93 @@
+"""
+Кеш в памяти процесса с ограничением размера (LRU) и временем жизни записей.
+"""
+import time
+from collections import OrderedDict
+from dataclasses import dataclass
+from typing import Generic, TypeVar, Hashable
+
+K = TypeVar("K", bound=Hashable)
+V = TypeVar("V")
+
+
+@dataclass
+class CacheStats:
+    size: int
+    max_size: int
+    hits: int
+    misses: int
+    evictions: int    # записи, вытесненные из-за переполнения
+
+
+class LRUCache(Generic[K, V]):
+    """
+    При переполнении вытесняется запись, к которой дольше всего не обращались.
+    Просроченные записи удаляются при обращении к ним.
+    Не потокобезопасен - рассчитан на использование из одного цикла событий.
+    """
+
+    _data: OrderedDict[K, tuple[float, V]]    # ключ -> (момент истечения, значение)
+    _max_size: int
+    _ttl: float
+    _hits: int
+    _misses: int
+    _evictions: int
+
+    def __init__(self, max_size: int, ttl: float):
+        """
+        :param max_size: максимальное количество записей; 0 отключает кеш
+        :param ttl: время жизни записи, сек
+        """
+        self._data = OrderedDict()
+        self._max_size = max_size
+        self._ttl = ttl
+        self._hits = 0
+        self._misses = 0
+        self._evictions = 0
+
+    def get(self, key: K) -> V | None:
+        item = self._data.get(key)
+        if item is None:
+            self._misses += 1
+            return None
+
+        expires, value = item
+        if expires < time.monotonic():
+            del self._data[key]
+            self._misses += 1
+            return None
+
+        self._data.move_to_end(key)
+        self._hits += 1
+        return value
+
+    def peek(self, key: K) -> V | None:
+        """
+        Возвращает значение, не учитывая обращение в статистике и порядке вытеснения.
+        """
+        item = self._data.get(key)
+        if item is None or item[0] < time.monotonic():
+            return None
+        return item[1]
+
+    def __contains__(self, key: K) -> bool:
+        item = self._data.get(key)
+        return item is not None and item[0] >= time.monotonic()
+
+    def set(self, key: K, value: V):
+        if self._max_size <= 0:
+            return
+        self._data[key] = (time.monotonic() + self._ttl, value)
+        self._data.move_to_end(key)
+        while len(self._data) > self._max_size:
+            self._data.popitem(last=False)
+            self._evictions += 1
+
+    def pop(self, key: K):
+        self._data.pop(key, None)
+
+    def clear(self):
+        self._data.clear()
+
+    def get_stats(self) -> CacheStats:
+        return CacheStats(len(self._data), self._max_size, self._hits, self._misses, self._evictions)
@@ -0,0 +1,210 @@
+"""
+Предохранители (circuit breaker) для запросов к платежным системам.
+Если платежная система отвечает ошибками или слишком медленно, предохранитель размыкается: запросы к ней
+сразу отклоняются, а способ оплаты скрывается со страницы выбора. Через open_duration секунд пропускается
+несколько пробных запросов; если они успешны, предохранитель замыкается.
+"""
+import asyncio
+import logging
+import math
+import time
+from collections import deque
+from dataclasses import dataclass
+from enum import Enum
+from typing import Awaitable, Callable, TypeVar
+
+T = TypeVar("T")
+
+
+class CircuitState(Enum):
+    CLOSED = "CLOSED"    # запросы выполняются
+    OPEN = "OPEN"    # запросы отклоняются
+    HALF_OPEN = "HALF_OPEN"    # выполняются пробные запросы
+
+
+class CircuitOpenError(Exception):
+    def __init__(self, name: str, *args):
+        super().__init__(f"Circuit '{name}' is open.", *args)
+
+
+@dataclass
+class CircuitBreakerSettings:
+    deadline: float = 10    # максимальное время одного запроса, сек
+    window: float = 60    # за сколько последних секунд учитываются запросы
+    min_requests: int = 10    # минимальное количество запросов в окне, после которого предохранитель может разомкнуться
+    error_rate: float = 0.5    # доля ошибок, при которой предохранитель размыкается
+    p95_latency: float = 8    # 95-й перцентиль времени ответа, сек, при котором предохранитель размыкается
+    open_duration: float = 30    # сколько секунд предохранитель разомкнут до пробных запросов
+    half_open_probes: int = 1    # сколько пробных запросов выполняется одновременно
+
+
+@dataclass
+class CircuitBreakerStats:
+    name: str
+    state: CircuitState
+    requests: int    # запросы в окне
+    error_rate: float
+    p95_latency_ms: float
+    opened: int    # сколько раз предохранитель размыкался
+    rejected: int    # запросы, отклоненные без обращения к платежной системе
+
+
+class CircuitBreaker:
+
+    _MAX_SAMPLES = 1000
+
+    name: str
+    _settings: CircuitBreakerSettings
+    _logger: logging.Logger
+    _samples: deque[tuple[float, bool, float]]    # (момент завершения, успех, время выполнения)
+    _state: CircuitState
+    _opened_at: float
+    _probes: int
+    _opened: int
+    _rejected: int
+
+    def __init__(self, name: str, settings: CircuitBreakerSettings):
+        self.name = name
+        self._settings = settings
+        self._logger = logging.getLogger("payment_api_logger")
+        self._samples = deque(maxlen=self._MAX_SAMPLES)
+        self._state = CircuitState.CLOSED
+        self._opened_at = 0
+        self._probes = 0
+        self._opened = 0
+        self._rejected = 0
+
+    @property
+    def state(self) -> CircuitState:
+        if self._state == CircuitState.OPEN and time.monotonic() - self._opened_at >= self._settings.open_duration:
+            self._state = CircuitState.HALF_OPEN
+            self._probes = 0
+        return self._state
+
+    def is_available(self) -> bool:
+        return self.state != CircuitState.OPEN
+
+    async def call_async(self, func: Callable[[], Awaitable[T]], is_failure: Callable[[Exception], bool] | None = None) -> T:
+        """
+        Выполняет запрос с ограничением времени settings.deadline.
+        :param is_failure: считать ли исключение неисправностью; исключения, для которых он вернул False (например,
+            отказ платежной системы по существу запроса), пробрасываются, но учитываются как успешный ответ
+        :raises CircuitOpenError: предохранитель разомкнут
+        :raises asyncio.TimeoutError: запрос не уложился в deadline
+        """
+        state = self.state
+        if state == CircuitState.OPEN or (state == CircuitState.HALF_OPEN and self._probes >= self._settings.half_open_probes):
+            self._rejected += 1
+            raise CircuitOpenError(self.name)
+
+        probe = state == CircuitState.HALF_OPEN
+        if probe:
+            self._probes += 1
+
+        started = time.monotonic()
+        try:
+            result = await asyncio.wait_for(func(), self._settings.deadline)
+        except Exception as ex:
+            self._record(is_failure is not None and not is_failure(ex), time.monotonic() - started, probe)
+            raise
+        except asyncio.CancelledError:
+            if probe:
+                self._probes -= 1
+            raise
+        self._record(True, time.monotonic() - started, probe)
+        return result
+
+    def _record(self, success: bool, elapsed: float, probe: bool):
+        now = time.monotonic()
+        if probe:
+            self._probes -= 1
+            if success:
+                self._close()
+            else:
+                self._open(now, "probe failed")
+            return
+        if self._state != CircuitState.CLOSED:
+            # запрос начался до размыкания
+            return
+
+        self._samples.append((now, success, elapsed))
+        self._trim(now)
+        if len(self._samples) < self._settings.min_requests:
+            return
+
+        error_rate = self._get_error_rate()
+        if error_rate >= self._settings.error_rate:
+            self._open(now, f"error rate {error_rate:.0%}")
+            return
+        p95 = self._get_p95_latency()
+        if p95 >= self._settings.p95_latency:
+            self._open(now, f"p95 latency {p95:.2f}s")
+
+    def _open(self, now: float, reason: str):
+        self._state = CircuitState.OPEN
+        self._opened_at = now
+        self._opened += 1
+        self._samples.clear()
+        self._logger.warning("[CIRCUIT] '%s' opened: %s", self.name, reason)
+
+    def _close(self):
+        self._state = CircuitState.CLOSED
+        self._samples.clear()
+        self._logger.info("[CIRCUIT] '%s' closed", self.name)
+
+    def _trim(self, now: float):
+        while self._samples and self._samples[0][0] < now - self._settings.window:
+            self._samples.popleft()
+
+    def _get_error_rate(self) -> float:
+        if not self._samples:
+            return 0
+        return sum(1 for _, success, _ in self._samples if not success) / len(self._samples)
+
+    def _get_p95_latency(self) -> float:
+        if not self._samples:
+            return 0
+        latencies = sorted(elapsed for _, _, elapsed in self._samples)
+        return latencies[min(len(latencies) - 1, math.ceil(len(latencies) * 0.95) - 1)]
+
+    def get_stats(self) -> CircuitBreakerStats:
+        state = self.state
+        self._trim(time.monotonic())
+        return CircuitBreakerStats(self.name, state, len(self._samples), self._get_error_rate(),
+                                   self._get_p95_latency() * 1000, self._opened, self._rejected)
+
+
+class CircuitBreakers:
+    """
+    Предохранители, создаваемые по имени при первом обращении.
+    """
+
+    _default: CircuitBreakerSettings
+    _overrides: dict[str, CircuitBreakerSettings]
+    _breakers: dict[str, CircuitBreaker]
+
+    def __init__(self, default: CircuitBreakerSettings, overrides: dict[str, CircuitBreakerSettings] | None = None):
+        """
+        :param default: настройки предохранителей
+        :param overrides: настройки отдельных предохранителей (ключ - имя, для платежных систем - method_id)
+        """
+        self._default = default
+        self._overrides = overrides or {}
+        self._breakers = {}
+
+    def get(self, name: str) -> CircuitBreaker:
+        breaker = self._breakers.get(name)
+        if breaker is None:
+            breaker = CircuitBreaker(name, self._overrides.get(name, self._default))
+            self._breakers[name] = breaker
+        return breaker
+
+    def is_available(self, name: str) -> bool:
+        breaker = self._breakers.get(name)
+        return breaker is None or breaker.is_available()
+
+    def get_unavailable(self) -> frozenset[str]:
+        return frozenset(name for name, breaker in self._breakers.items() if not breaker.is_available())
+
+    def get_stats(self) -> list[CircuitBreakerStats]:
+        return [breaker.get_stats() for breaker in self._breakers.values()]
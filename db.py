@@ -1,20 +1,20 @@
 """
-Модуль дял работы с базой данных пользователей (SQLite3).
+Модуль для работы с базой данных счетов. Запросы выполняет движок хранилища (см. storage.create_engine).
 """
 import asyncio
 import datetime
-
-import aiomysql
-from aiomysql import Pool
-import asyncio
-import secrets
-from typing import Tuple
-import traceback
-from dataclasses import dataclass
+import time
+from dataclasses import dataclass, field
 from enum import Enum
-from typing import Optional
+from typing import AsyncIterator, Iterable, Any, Optional
 
 import config
+from cache import LRUCache, CacheStats
+from metrics import timed_async, DB_QUERY_SECONDS, DB_ERRORS, INVOICE_TRANSITIONS
+from tracing import traced_async
+from storage import StorageEngine, create_engine, INVOICE_COLUMNS, ColumnRef, PaymentMethod, OutboxEntry, OutboxBacklog, InboxEntry, PoolStats, \
+    WriteOp, InsertInvoice, UpdateInvoice, TransitionInvoice
+from storage.coalescer import WriteCoalescer, WriteCoalescerStats
 
 
 class InvoiceStatus(Enum):
@@ -30,6 +30,7 @@ class InvoiceStatus(Enum):
 class InvoiceInfo:
     """
     Содержит информацию о счете.
+    Отслеживает, какие поля изменились после загрузки из БД, чтобы при сохранении обновлять только их.
     """
     invoice_id: str  # номер счета
     status: InvoiceStatus
@@ -43,105 +44,407 @@ class InvoiceInfo:
     payment_method: str | None
     payment_url: str
     payment_method_invoice_id: Optional[str | None] = None    # айди счета в системе оплаты
+    idempotency_key: str | None = None    # ключ, переданный клиентом при создании счета, для защиты от повторного создания
 
+    _persisted: bool = field(default=False, init=False, repr=False, compare=False)    # счет уже есть в БД
+    _dirty: set[str] = field(default_factory=set, init=False, repr=False, compare=False)    # поля, измененные после загрузки или сохранения
 
-@dataclass
-class PaymentMethod:
-    method_id: str
-    name: str
-    description: str
-    icon_url: str
-    instructions: str | None
-    delegate_url: str = ""
+    def __setattr__(self, name, value):
+        if self.__dict__.get("_persisted") and name in INVOICE_COLUMNS and self.__dict__.get(name) != value:
+            self._dirty.add(name)
+        object.__setattr__(self, name, value)
+
+    def is_persisted(self) -> bool:
+        return self._persisted
+
+    def get_changes(self) -> dict[str, Any]:
+        """
+        Возвращает поля, измененные после загрузки из БД или последнего сохранения.
+        """
+        return {name: getattr(self, name) for name in self._dirty}
+
+    def mark_saved(self):
+        self._persisted = True
+        self._dirty.clear()
 
 
 class DatabaseManager:
-    _host: str
-    _user: str
-    _password: str
-    _db_name: str
-
-    _GET_INVOICES_QUERY = "SELECT * FROM invoices WHERE invoice_id = %s;"
-    _SAVE_INVOICE_QUERY = "INSERT INTO invoices VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s) " \
-                          "ON DUPLICATE KEY UPDATE invoice_id = %s, status = %s, amount = %s, credited = %s, created = %s, payed = %s, comment = %s, custom_fields = %s, webhook_url = %s, payment_method = %s, payment_url = %s, payment_method_invoice_id = %s;"
-    _GET_PAYMENT_METHODS_QUERY = "SELECT * FROM payment_methods;"
-    _GET_PAYMENT_METHOD_QUERY = "SELECT * FROM payment_methods WHERE method_id = %s;"
-
-    def __init__(self, host: str, user: str, password: str, db_name: str):
-        self._host = host
-        self._user = user
-        self._password = password
-        self._db_name = db_name
-
-    def _get_connection(self):
-        return aiomysql.connect(host=self._host, user=self._user, password=self._password, db=self._db_name)
-
-    async def get_invoice_info_async(self, invoice_id: str) -> InvoiceInfo | None:
-        async with self._get_connection() as conn:
-            async with conn.cursor() as cur:
-                await cur.execute(self._GET_INVOICES_QUERY, invoice_id)
-                rows = await cur.fetchall()
-
-        if not any(rows):
-            return None
+    """
+    Доступ к счетам, платежным системам и очереди вебхуков. Запросы выполняет движок хранилища (см. storage),
+    здесь - кеширование, метрики и преобразование строк в InvoiceInfo.
+    """
+    _engine: StorageEngine
+    _methods_cache: dict[str, PaymentMethod] | None
+    _methods_cache_ttl: float
+    _methods_loaded_at: float
+    _methods_version: int
+    _methods_lock: asyncio.Lock
+    _invoice_cache: LRUCache[str, tuple]    # invoice_id -> строка таблицы invoices
+    _coalescer: WriteCoalescer | None
+
+    def __init__(self, engine: StorageEngine,
+                 payment_methods_cache_ttl: float = 300,
+                 invoice_cache_size: int = 10000,
+                 invoice_cache_ttl: float = 300,
+                 write_batch_size: int = 0,
+                 write_batch_wait: float = 0.002):
+        """
+        :param engine: движок хранилища, см. storage.create_engine
+        :param payment_methods_cache_ttl: сколько секунд хранить список платежных систем в памяти
+        :param invoice_cache_size: сколько последних счетов хранить в памяти (0 - не кешировать)
+        :param invoice_cache_ttl: время жизни счета в кеше, сек; ограничивает расхождение с БД,
+            если счет изменил другой процесс
+        :param write_batch_size: сохранения и переходы счетов, пришедшие в течение write_batch_wait секунд,
+            записываются одной транзакцией, не больше write_batch_size операций в пачке (0 - каждая операция отдельно)
+        :param write_batch_wait: сколько ждать других операций после первой операции пачки, сек
+        """
+        self._engine = engine
+        self._methods_cache = None
+        self._methods_cache_ttl = payment_methods_cache_ttl
+        self._methods_loaded_at = 0
+        self._methods_version = 0
+        self._methods_lock = asyncio.Lock()
+        self._invoice_cache = LRUCache(invoice_cache_size, invoice_cache_ttl)
+        self._coalescer = WriteCoalescer(engine, write_batch_size, write_batch_wait) if write_batch_size > 0 else None
+
+    @property
+    def engine(self) -> StorageEngine:
+        return self._engine
+
+    async def connect_async(self):
+        """
+        Подключается к хранилищу. Вызывается один раз при запуске приложения.
+        """
+        await self._engine.connect_async()
+
+    async def close_async(self):
+        """
+        Закрывает соединения с хранилищем, дожидаясь завершения выполняемых запросов.
+        """
+        if self._coalescer is not None:
+            await self._coalescer.flush_async()
+        await self._engine.close_async()
+
+    def get_pool_stats(self) -> PoolStats:
+        return self._engine.get_pool_stats()
+
+    def get_write_coalescer_stats(self) -> WriteCoalescerStats | None:
+        return self._coalescer.get_stats() if self._coalescer is not None else None
+
+    async def _write_async(self, op: WriteOp) -> Any:
+        """
+        Выполняет запись сразу или в составе пачки, если включена групповая запись. В обоих случаях возвращает управление
+        только после фиксации.
+        """
+        if self._coalescer is not None:
+            return await self._coalescer.submit_async(op)
+        return await self._engine.execute_write_async(op)
 
-        inv = InvoiceInfo(*rows[0])
+    @staticmethod
+    def _invoice_from_row(row: tuple) -> InvoiceInfo:
+        inv = InvoiceInfo(*row)
         inv.status = InvoiceStatus(inv.status)
+        inv.mark_saved()
         return inv
 
-    async def save_invoice_info_async(self, invoice_info: InvoiceInfo):
-        async with self._get_connection() as conn:
-            async with conn.cursor() as cur:
-                await cur.execute(self._SAVE_INVOICE_QUERY,
-                                  (invoice_info.invoice_id, invoice_info.status.value, invoice_info.amount,
-                                   invoice_info.credited, invoice_info.created, invoice_info.payed,
-                                   invoice_info.comment, invoice_info.custom_fields,
-                                   invoice_info.webhook_url, invoice_info.payment_method, invoice_info.payment_url, invoice_info.payment_method_invoice_id, invoice_info.invoice_id, invoice_info.status.value,
-                                   invoice_info.amount,
-                                   invoice_info.credited, invoice_info.created, invoice_info.payed,
-                                   invoice_info.comment, invoice_info.custom_fields,
-                                   invoice_info.webhook_url, invoice_info.payment_method, invoice_info.payment_url, invoice_info.payment_method_invoice_id))
-                await conn.commit()
+    @staticmethod
+    def _invoice_to_row(invoice_info: InvoiceInfo) -> tuple:
+        return tuple(DatabaseManager._to_db_value(getattr(invoice_info, column)) for column in INVOICE_COLUMNS)
 
-    async def get_payment_methods_async(self) -> list[PaymentMethod]:
-        async with self._get_connection() as conn:
-            async with conn.cursor() as cur:
-                await cur.execute(self._GET_PAYMENT_METHODS_QUERY)
-                rows = await cur.fetchall()
+    @staticmethod
+    def _to_db_value(value: Any) -> Any:
+        return value.value if isinstance(value, InvoiceStatus) else value
 
-        if not any(rows):
-            return []
-        return [PaymentMethod(*r) for r in rows]
+    @timed_async(DB_QUERY_SECONDS, DB_ERRORS)
+    @traced_async("db")
+    async def get_invoice_info_async(self, invoice_id: str, use_cache: bool = True) -> InvoiceInfo | None:
+        """
+        :param use_cache: вернуть счет из кеша, если он там есть; иначе всегда читать из БД
+        """
+        # в кеше хранится строка, а не объект: каждый вызов получает свой InvoiceInfo, который можно менять
+        row = self._invoice_cache.get(invoice_id) if use_cache else None
+        if row is not None:
+            return self._invoice_from_row(row)
 
-    async def get_payment_method_async(self, method_id: str) -> PaymentMethod | None:
-        async with self._get_connection() as conn:
-            async with conn.cursor() as cur:
-                await cur.execute(self._GET_PAYMENT_METHOD_QUERY, method_id)
-                rows = await cur.fetchall()
+        row = await self._engine.get_invoice_row_async(invoice_id)
+        if row is None:
+            return None
 
-        if not any(rows):
+        self._invoice_cache.set(invoice_id, row)
+        return self._invoice_from_row(row)
+
+    def get_invoice_cache_stats(self) -> CacheStats:
+        return self._invoice_cache.get_stats()
+
+    @timed_async(DB_QUERY_SECONDS, DB_ERRORS)
+    @traced_async("db")
+    async def get_invoice_by_idempotency_key_async(self, idempotency_key: str) -> InvoiceInfo | None:
+        row = await self._engine.get_invoice_row_by_idempotency_key_async(idempotency_key)
+        if row is None:
             return None
 
-        return PaymentMethod(*rows[0])
+        return self._invoice_from_row(row)
+
+    @timed_async(DB_QUERY_SECONDS, DB_ERRORS)
+    @traced_async("db")
+    async def get_invoice_by_provider_id_async(self, method_id: str, provider_invoice_id: str) -> InvoiceInfo | None:
+        """
+        Ищет счет по его айди в системе оплаты (payment_method_invoice_id).
+        """
+        row = await self._engine.get_invoice_row_by_provider_id_async(method_id, provider_invoice_id)
+        if row is None:
+            return None
+
+        return self._invoice_from_row(row)
+
+    async def iter_invoices_by_status_async(self, status: InvoiceStatus, older_than: datetime.datetime,
+                                            batch_size: int = 500) -> AsyncIterator[InvoiceInfo]:
+        """
+        Перебирает счета в статусе status, созданные раньше older_than, в порядке создания.
+        Счета читаются пачками по batch_size, соединение с БД не удерживается между пачками.
+        """
+        last_created, last_id = datetime.datetime.min, ""
+        while True:
+            rows = await self._engine.get_invoice_rows_by_status_async(status.value, older_than, (last_created, last_id), batch_size)
+
+            for row in rows:
+                yield self._invoice_from_row(row)
+
+            if len(rows) < batch_size:
+                return
+            last_created, last_id = rows[-1][INVOICE_COLUMNS.index("created")], rows[-1][0]
+
+    @timed_async(DB_QUERY_SECONDS, DB_ERRORS)
+    @traced_async("db")
+    async def save_invoice_info_async(self, invoice_info: InvoiceInfo):
+        """
+        Новый счет добавляется через INSERT, у существующего обновляются только измененные поля.
+        :raises DuplicateInvoiceError: новый счет совпадает с существующим по invoice_id или idempotency_key
+        """
+        if not invoice_info.is_persisted():
+            await self._write_async(InsertInvoice(self._invoice_to_row(invoice_info)))
+        else:
+            changes = invoice_info.get_changes()
+            if not changes:
+                return
+            await self._write_async(UpdateInvoice(invoice_info.invoice_id,
+                                                  {column: self._to_db_value(value) for column, value in changes.items()}))
+
+        invoice_info.mark_saved()
+        self._invoice_cache.set(invoice_info.invoice_id, self._invoice_to_row(invoice_info))
+
+    @timed_async(DB_QUERY_SECONDS, DB_ERRORS)
+    @traced_async("db")
+    async def insert_invoices_async(self, invoices: list[InvoiceInfo]):
+        """
+        Добавляет новые счета одним запросом: либо все, либо ни одного.
+        :raises DuplicateInvoiceError: один из счетов совпадает с существующим по invoice_id или idempotency_key
+        """
+        if not invoices:
+            return
+        await self._engine.insert_invoices_async([self._invoice_to_row(invoice_info) for invoice_info in invoices])
+
+        for invoice_info in invoices:
+            invoice_info.mark_saved()
+            self._invoice_cache.set(invoice_info.invoice_id, self._invoice_to_row(invoice_info))
+
+    @timed_async(DB_QUERY_SECONDS, DB_ERRORS)
+    @traced_async("db")
+    async def transition_invoice_async(self, invoice_id: str,
+                                       from_statuses: Iterable[InvoiceStatus],
+                                       to_status: InvoiceStatus,
+                                       changes: dict[str, Any] | None = None,
+                                       require_no_payment_method: bool = False,
+                                       enqueue_webhook: bool = False) -> bool:
+        """
+        Атомарно переводит счет в статус to_status, если сейчас он находится в одном из from_statuses.
+        Проверка и запись выполняются одним UPDATE, поэтому два одновременных вебхука не могут оба пройти проверку.
+        :param changes: другие столбцы, которые нужно обновить вместе со статусом; значение может быть ColumnRef
+        :param require_no_payment_method: дополнительно требовать, чтобы платежная система еще не была выбрана
+        :param enqueue_webhook: в той же транзакции добавить вебхук на сервер игры в очередь доставки
+        :return: True, если переход выполнен; False, если счет не найден или находится в другом статусе
+        """
+        db_changes = {}
+        for column, value in (changes or {}).items():
+            if column not in INVOICE_COLUMNS or column in ("invoice_id", "status"):
+                raise ValueError(f"Column '{column}' cannot be changed by a transition")
+            if isinstance(value, ColumnRef) and value.column not in INVOICE_COLUMNS:
+                raise ValueError(f"Unknown column '{value.column}'")
+            db_changes[column] = self._to_db_value(value)
+
+        applied = await self._write_async(TransitionInvoice(invoice_id, [s.value for s in from_statuses], to_status.value,
+                                                            db_changes, require_no_payment_method, enqueue_webhook))
+
+        INVOICE_TRANSITIONS.inc(to_status.value, "applied" if applied else "rejected")
+        if applied:
+            self._apply_to_cached_invoice(invoice_id, to_status, changes or {})
+        return applied
+
+    def _apply_to_cached_invoice(self, invoice_id: str, status: InvoiceStatus, changes: dict[str, Any]):
+        """
+        Повторяет в кеше изменения, только что примененные к строке в БД.
+        """
+        row = self._invoice_cache.peek(invoice_id)
+        if row is None:
+            return
+        values = dict(zip(INVOICE_COLUMNS, row))
+        new_values = values | {"status": status.value}
+        for column, value in changes.items():
+            new_values[column] = values[value.column] if isinstance(value, ColumnRef) else self._to_db_value(value)
+        self._invoice_cache.set(invoice_id, tuple(new_values[column] for column in INVOICE_COLUMNS))
+
+    @timed_async(DB_QUERY_SECONDS, DB_ERRORS)
+    @traced_async("db")
+    async def expire_invoices_async(self, from_status: InvoiceStatus, created_before: datetime.datetime, limit: int,
+                                    payment_method: str | None = None,
+                                    exclude_methods: Iterable[str] = ()) -> int:
+        """
+        Переводит в TIMEOUT не более limit счетов в статусе from_status, созданных раньше created_before.
+        :param payment_method: обрабатывать только счета этой платежной системы
+        :param exclude_methods: пропускать счета этих платежных систем
+        :return: количество измененных счетов
+        """
+        invoice_ids = await self._engine.expire_invoices_async(from_status.value, InvoiceStatus.TIMEOUT.value, created_before, limit,
+                                                               payment_method, list(exclude_methods))
+        for invoice_id in invoice_ids:
+            self._invoice_cache.pop(invoice_id)    # иначе чтение из кеша вернуло бы прежний статус
+        INVOICE_TRANSITIONS.inc(InvoiceStatus.TIMEOUT.value, "applied", value=len(invoice_ids))
+        return len(invoice_ids)
+
+    def named_lock_async(self, name: str):
+        """
+        Блокировка, общая для всех процессов, работающих с этим хранилищем. Не ждет, если блокировка занята.
+        Возвращает True, если блокировка получена.
+        """
+        return self._engine.named_lock_async(name)
+
+    @timed_async(DB_QUERY_SECONDS, DB_ERRORS)
+    @traced_async("db")
+    async def claim_outbox_async(self, limit: int, lease_seconds: int) -> list[OutboxEntry]:
+        """
+        Забирает до limit вебхуков, время отправки которых наступило.
+        Забранные записи откладываются на lease_seconds, чтобы другие воркеры их не взяли, пока идет доставка;
+        если процесс упадет, не отметив результат, по истечении этого времени вебхук будет отправлен повторно.
+        """
+        return await self._engine.claim_outbox_async(limit, lease_seconds)
+
+    @timed_async(DB_QUERY_SECONDS, DB_ERRORS)
+    @traced_async("db")
+    async def mark_outbox_delivered_async(self, entry_id: int):
+        await self._engine.mark_outbox_delivered_async(entry_id)
+
+    @timed_async(DB_QUERY_SECONDS, DB_ERRORS)
+    @traced_async("db")
+    async def reschedule_outbox_async(self, entry_id: int, delay_seconds: int, error: str, give_up: bool = False):
+        """
+        Записывает неудачную попытку доставки. Если give_up, вебхук больше не отправляется.
+        """
+        await self._engine.reschedule_outbox_async(entry_id, delay_seconds, error, give_up)
+
+    @timed_async(DB_QUERY_SECONDS, DB_ERRORS)
+    @traced_async("db")
+    async def release_outbox_async(self, entry_id: int):
+        """
+        Возвращает забранный, но не отправленный вебхук в очередь без учета попытки.
+        """
+        await self._engine.release_outbox_async(entry_id)
+
+    @timed_async(DB_QUERY_SECONDS, DB_ERRORS)
+    @traced_async("db")
+    async def get_outbox_backlog_async(self) -> OutboxBacklog:
+        return await self._engine.get_outbox_backlog_async()
+
+    @timed_async(DB_QUERY_SECONDS, DB_ERRORS)
+    @traced_async("db")
+    async def add_inbox_async(self, method_id: str, invoice_id: str, payload: dict, lease_seconds: int = 0) -> int:
+        """
+        Записывает событие от платежной системы, которое не удалось применить сразу: оно будет применено,
+        даже если процесс перезапустится.
+        :param lease_seconds: если больше 0, событие сразу считается забранным текущим процессом на это время
+            (то есть следующая попытка будет не раньше чем через lease_seconds)
+        """
+        return await self._engine.add_inbox_async(method_id, invoice_id, payload, lease_seconds)
+
+    @timed_async(DB_QUERY_SECONDS, DB_ERRORS)
+    @traced_async("db")
+    async def claim_inbox_async(self, limit: int, lease_seconds: int) -> list[InboxEntry]:
+        """
+        Забирает до limit событий, время применения которых наступило. Аналогично claim_outbox_async,
+        забранные события скрываются от других воркеров на lease_seconds.
+        """
+        return await self._engine.claim_inbox_async(limit, lease_seconds)
+
+    @timed_async(DB_QUERY_SECONDS, DB_ERRORS)
+    @traced_async("db")
+    async def mark_inbox_processed_async(self, entry_id: int):
+        await self._engine.mark_inbox_processed_async(entry_id)
+
+    @timed_async(DB_QUERY_SECONDS, DB_ERRORS)
+    @traced_async("db")
+    async def reschedule_inbox_async(self, entry_id: int, delay_seconds: int, error: str, give_up: bool = False):
+        """
+        Записывает неудачную попытку применения. Если give_up, событие больше не применяется и остается в таблице для разбора вручную.
+        """
+        await self._engine.reschedule_inbox_async(entry_id, delay_seconds, error, give_up)
+
+    @timed_async(DB_QUERY_SECONDS, DB_ERRORS)
+    @traced_async("db")
+    async def release_inbox_async(self, entry_id: int):
+        """
+        Возвращает забранное, но не примененное событие в очередь без учета попытки.
+        """
+        await self._engine.release_inbox_async(entry_id)
+
+    async def _get_payment_methods_cached_async(self) -> dict[str, PaymentMethod]:
+        """
+        Таблица платежных систем меняется редко, поэтому она загружается целиком и хранится в памяти payment_methods_cache_ttl секунд.
+        """
+        if self._methods_cache is not None and time.monotonic() - self._methods_loaded_at < self._methods_cache_ttl:
+            return self._methods_cache
+
+        async with self._methods_lock:
+            # пока ждали блокировку, кеш мог обновить другой запрос
+            if self._methods_cache is not None and time.monotonic() - self._methods_loaded_at < self._methods_cache_ttl:
+                return self._methods_cache
+
+            methods = await self._engine.get_payment_methods_async()
+
+            self._methods_cache = {m.method_id: m for m in methods}
+            self._methods_loaded_at = time.monotonic()
+            self._methods_version += 1
+            return self._methods_cache
+
+    def invalidate_payment_methods_cache(self):
+        """
+        Сбрасывает кеш платежных систем в этом процессе. Следующий запрос загрузит их из БД заново.
+        """
+        self._methods_cache = None
+
+    @property
+    def payment_methods_version(self) -> int:
+        """
+        Увеличивается при каждой загрузке платежных систем из БД. Позволяет не пересчитывать то, что построено на их основе.
+        """
+        return self._methods_version
+
+    @timed_async(DB_QUERY_SECONDS, DB_ERRORS)
+    @traced_async("db")
+    async def get_payment_methods_async(self) -> list[PaymentMethod]:
+        return list((await self._get_payment_methods_cached_async()).values())
+
+    @timed_async(DB_QUERY_SECONDS, DB_ERRORS)
+    @traced_async("db")
+    async def get_payment_method_async(self, method_id: str) -> PaymentMethod | None:
+        return (await self._get_payment_methods_cached_async()).get(method_id)
 
     async def create_tables_async(self):
-        async with self._get_connection() as conn:
-            async with conn.cursor() as cur:
-                await cur.execute(
-                    "CREATE TABLE IF NOT EXISTS invoices "
-                    "(invoice_id VARCHAR(36) NOT NULL, status VARCHAR(32) NOT NULL DEFAULT 'created', "
-                    "amount REAL NOT NULL, credited REAL NOT NULL, created DATETIME NOT NULL, "
-                    "payed DATETIME, comment VARCHAR(256) NOT NULL DEFAULT '',"
-                    "custom_fields VARCHAR(128) NOT NULL DEFAULT '{}', webhook_url VARCHAR(128) NOT NULL DEFAULT '', payment_method VARCHAR(32), payment_url VARCHAR(512) NOT NULL, payment_method_invoice_id VARCHAR(128), PRIMARY KEY (invoice_id));")
-                await cur.execute(
-                    "CREATE TABLE IF NOT EXISTS payment_methods "
-                    "(method_id VARCHAR(32) NOT NULL, name VARCHAR(64) NOT NULL, description VARCHAR(256) NOT NULL DEFAULT '', icon_url VARCHAR(256) NOT NULL, instructions TEXT, PRIMARY KEY (method_id));"
-                )
-                await conn.commit()
+        await self._engine.create_tables_async()
 
 
 async def debug():
-    manager = DatabaseManager(config.MYSQL_HOST, config.MYSQL_USER, config.MYSQL_PASSWORD, config.MYSQL_DATABASE)
+    manager = DatabaseManager(create_engine("mysql", host=config.MYSQL_HOST, user=config.MYSQL_USER,
+                                            password=config.MYSQL_PASSWORD, db_name=config.MYSQL_DATABASE))
+    await manager.connect_async()
 
     await manager.create_tables_async()
 
@@ -151,7 +454,8 @@ async def debug():
     #invoice = await manager.get_invoice_info_async("test_inv")
     #print(invoice)
 
+    await manager.close_async()
+
 
 if __name__ == "__main__":
     asyncio.run(debug(), debug=True)
-
@@ -0,0 +1,314 @@
+"""
+Прием вебхуков от платежных систем.
+Обработчик HTTP-запроса проверяет подпись, кладет событие в ограниченную очередь в памяти и сразу отвечает платежной системе,
+не обращаясь к БД. Изменение счета выполняют фоновые обработчики, поэтому ни медленное применение события, ни медленная БД
+не приводят к таймаутам и повторным вебхукам со стороны платежных систем.
+Событие, которое не удалось применить сразу, записывается в таблицу webhook_inbox и повторяется из нее без ограничения попыток;
+туда же записываются события, не примененные до остановки процесса. Пока событие ждет в очереди, оно хранится только в памяти:
+при аварийном завершении процесса такие события теряются и будут применены, только если платежная система повторит вебхук.
+"""
+import asyncio
+import datetime
+import logging
+import time
+from dataclasses import dataclass
+from typing import Callable
+
+from apis.base import WebhookEvent
+from db import DatabaseManager, InvoiceStatus, InboxEntry
+from invoice_manager import InvoiceManager, InvalidInvoiceError, InvalidInvoiceStatusError
+
+
+@dataclass
+class WebhookIngestorStats:
+    queued: int
+    in_flight: int
+    processed: int
+    rejected: int    # события, не поместившиеся в очередь (платежной системе ответили 503)
+    retried: int    # неудачные попытки, отложенные на потом
+    failed: int    # события, применить которые невозможно (оставлены в webhook_inbox со статусом failed)
+    last_lag_ms: float    # сколько последнее событие ждало в очереди
+    avg_lag_ms: float    # экспоненциальное скользящее среднее ожидания в очереди
+    avg_processing_ms: float
+
+
+# событие в логе: WebhookEvent изменяется при обработке, поэтому в лог передаются значения его полей (см. log_config.py)
+_EVENT_FORMAT = "[%s] status=%s credited=%s transaction_id=%s"
+
+
+def _event_log_args(event: WebhookEvent) -> tuple:
+    return event.invoice_id, event.status.value, event.credited, event.transaction_id
+
+
+def _event_to_payload(event: WebhookEvent) -> dict:
+    return {
+        "status": event.status.value,
+        "credited": event.credited,
+        "payed": event.payed.isoformat() if event.payed is not None else None,
+        "payment_method_invoice_id": event.payment_method_invoice_id,
+        "transaction_id": event.transaction_id,
+    }
+
+
+def _event_from_entry(entry: InboxEntry) -> WebhookEvent:
+    payload = entry.payload
+    payed = payload.get("payed")
+    return WebhookEvent(entry.method_id, entry.invoice_id, InvoiceStatus(payload["status"]),
+                        credited=payload.get("credited"),
+                        payed=datetime.datetime.fromisoformat(payed) if payed is not None else None,
+                        payment_method_invoice_id=payload.get("payment_method_invoice_id"),
+                        transaction_id=payload.get("transaction_id"),
+                        attempt=entry.attempts - 1)
+
+
+class WebhookIngestor:
+    """
+    Очередь событий от платежных систем и пул обработчиков, применяющих их через InvoiceManager.
+    Повторные попытки и события, не примененные до остановки, хранятся в таблице webhook_inbox.
+    """
+
+    _LAG_SMOOTHING = 0.1
+
+    _db_manager: DatabaseManager
+    _invoice_manager: InvoiceManager
+    _on_payed: Callable[[], None]
+    _workers_count: int
+    _batch_size: int
+    _poll_interval: float
+    _lease_seconds: int
+    _retry_delay: float
+    _max_retry_delay: float
+    _logger: logging.Logger
+
+    _queue: asyncio.Queue[tuple[int | None, WebhookEvent]]    # (id записи в webhook_inbox или None, если события нет в БД, событие)
+    _parked: list[tuple[float, WebhookEvent]]    # (time.monotonic() следующей попытки, событие), которые не удалось записать в БД
+    _workers: list[asyncio.Task]
+    _poller: asyncio.Task | None
+    _in_flight: int
+    _processed: int
+    _rejected: int
+    _retried: int
+    _failed: int
+    _last_lag: float
+    _avg_lag: float
+    _avg_processing: float
+
+    def __init__(self, db_manager: DatabaseManager, invoice_manager: InvoiceManager, on_payed: Callable[[], None],
+                 workers: int = 4,
+                 queue_size: int = 1000,
+                 batch_size: int = 50,
+                 poll_interval: float = 5,
+                 lease_seconds: int = 60,
+                 retry_delay: float = 2,
+                 max_retry_delay: float = 300):
+        """
+        :param on_payed: вызывается после того, как счет отмечен оплаченным (например, чтобы разбудить отправку вебхуков)
+        :param workers: количество одновременно работающих обработчиков
+        :param queue_size: максимальная длина очереди в памяти; на события сверх нее платежной системе отвечают 503
+        :param batch_size: сколько событий забирать из БД за один запрос
+        :param poll_interval: как часто проверять БД на отложенные события, сек
+        :param lease_seconds: на сколько забранное событие скрывается от других процессов, сек;
+            если процесс упадет, не применив событие, по истечении этого времени его применит любой другой
+        :param retry_delay: задержка перед повторной попыткой при временных ошибках (например, недоступности БД), сек;
+            удваивается с каждой попыткой. Количество попыток не ограничено
+        :param max_retry_delay: максимальная задержка между попытками, сек
+        """
+        self._db_manager = db_manager
+        self._invoice_manager = invoice_manager
+        self._on_payed = on_payed
+        self._workers_count = workers
+        self._batch_size = batch_size
+        self._poll_interval = poll_interval
+        self._lease_seconds = lease_seconds
+        self._retry_delay = retry_delay
+        self._max_retry_delay = max_retry_delay
+        self._logger = logging.getLogger("payment_api_logger")
+
+        self._queue = asyncio.Queue(queue_size)
+        self._parked = []
+        self._workers = []
+        self._poller = None
+        self._in_flight = 0
+        self._processed = 0
+        self._rejected = 0
+        self._retried = 0
+        self._failed = 0
+        self._last_lag = 0
+        self._avg_lag = 0
+        self._avg_processing = 0
+
+    async def start_async(self):
+        self._workers = [asyncio.create_task(self._worker_async()) for _ in range(self._workers_count)]
+        self._poller = asyncio.create_task(self._poll_async())
+
+    def submit(self, event: WebhookEvent) -> bool:
+        """
+        Передает событие обработчикам, не обращаясь к БД. Возвращает False, если очередь переполнена -
+        тогда платежной системе нужно ответить ошибкой, чтобы она повторила вебхук позже.
+        """
+        event.attempt = 0
+        try:
+            self._queue.put_nowait((None, event))
+        except asyncio.QueueFull:
+            self._rejected += 1
+            self._logger.error("[%s WEBHOOK] Queue is full, rejected: " + _EVENT_FORMAT, event.method_id.upper(), *_event_log_args(event))
+            return False
+        return True
+
+    async def _poll_async(self):
+        while True:
+            now = time.monotonic()
+            due = [event for retry_at, event in self._parked if retry_at <= now]
+            self._parked = [(retry_at, event) for retry_at, event in self._parked if retry_at > now]
+            for event in due:
+                await self._queue.put((None, event))
+
+            limit = min(self._batch_size, self._queue.maxsize - self._queue.qsize())
+            entries = []
+            if limit > 0:
+                try:
+                    entries = await self._db_manager.claim_inbox_async(limit, self._lease_seconds)
+                except Exception as ex:
+                    self._logger.exception("[WEBHOOK INGESTION] Failed to claim events from inbox", exc_info=ex)
+
+            for entry in entries:
+                try:
+                    event = _event_from_entry(entry)
+                except (KeyError, ValueError) as ex:
+                    self._failed += 1
+                    self._logger.error("[WEBHOOK INGESTION] Invalid inbox entry: id = %s", entry.id, exc_info=ex)
+                    await self._save_result_async(entry.id, repr(ex), give_up=True)
+                    continue
+                await self._queue.put((entry.id, event))
+
+            if limit > 0 and len(entries) == limit:
+                continue    # пачка заполнена целиком - вероятно, в БД есть еще
+
+            await asyncio.sleep(self._poll_interval)
+
+    async def _worker_async(self):
+        while True:
+            entry_id, event = await self._queue.get()
+            self._in_flight += 1
+            started = time.monotonic()
+            self._last_lag = started - event.received
+            self._avg_lag += (self._last_lag - self._avg_lag) * self._LAG_SMOOTHING
+            try:
+                await self._apply_async(entry_id, event)
+            except asyncio.CancelledError:
+                if entry_id is None:
+                    # остановка прервала применение события, которого еще нет в БД; stop_async запишет его
+                    self._parked.append((0, event))
+                raise
+            finally:
+                self._avg_processing += (time.monotonic() - started - self._avg_processing) * self._LAG_SMOOTHING
+                self._in_flight -= 1
+                self._queue.task_done()
+
+    async def _apply_async(self, entry_id: int | None, event: WebhookEvent):
+        """
+        :param entry_id: id записи в webhook_inbox или None, если событие пришло только что и в БД еще не записано
+        """
+        event.attempt += 1
+        try:
+            if event.status == InvoiceStatus.SUCCESS:
+                await self._invoice_manager.set_invoice_payed_async(event.invoice_id, event.credited, payed=event.payed,
+                                                                    payment_method_invoice_id=event.payment_method_invoice_id,
+                                                                    method_id=event.method_id, transaction_id=event.transaction_id)
+                self._on_payed()
+            else:
+                await self._invoice_manager.set_invoice_status_async(event.invoice_id, event.status,
+                                                                     method_id=event.method_id, transaction_id=event.transaction_id)
+        except (InvalidInvoiceError, InvalidInvoiceStatusError) as ex:
+            # повтор не поможет
+            self._failed += 1
+            self._logger.error("[%s WEBHOOK] Failed to handle: " + _EVENT_FORMAT, event.method_id.upper(), *_event_log_args(event), exc_info=ex)
+            if entry_id is None:
+                await self._add_to_inbox_async(event, repr(ex), give_up=True)
+            else:
+                await self._save_result_async(entry_id, repr(ex), give_up=True)
+            return
+        except Exception as ex:
+            self._retried += 1
+            self._logger.warning("[%s WEBHOOK] Attempt %s failed, will retry: " + _EVENT_FORMAT, event.method_id.upper(), event.attempt,
+                                 *_event_log_args(event), exc_info=ex)
+            if entry_id is None:
+                await self._add_to_inbox_async(event, repr(ex), delay=self.get_retry_delay(event.attempt))
+            else:
+                await self._save_result_async(entry_id, repr(ex), delay=self.get_retry_delay(event.attempt))
+            return
+
+        self._processed += 1
+        if entry_id is not None:
+            await self._save_result_async(entry_id, None)
+
+    async def _add_to_inbox_async(self, event: WebhookEvent, error: str | None, delay: float = 0, give_up: bool = False) -> bool:
+        """
+        Записывает в webhook_inbox событие, которое не удалось применить сразу (или не успели применить до остановки).
+        Если БД недоступна, событие, которое еще можно применить, повторяется из памяти через delay секунд.
+        """
+        try:
+            # запись с арендой на delay секунд - это событие с одной сделанной попыткой, следующая через delay
+            entry_id = await self._db_manager.add_inbox_async(event.method_id, event.invoice_id, _event_to_payload(event), round(delay))
+            if error is not None:
+                await self._db_manager.reschedule_inbox_async(entry_id, round(delay), error, give_up)
+        except Exception as ex:
+            self._logger.exception("[%s WEBHOOK] Failed to save event to inbox: " + _EVENT_FORMAT, event.method_id.upper(), *_event_log_args(event), exc_info=ex)
+            if not give_up:
+                self._parked.append((time.monotonic() + delay, event))
+            return False
+        return True
+
+    async def _save_result_async(self, entry_id: int, error: str | None, delay: float = 0, give_up: bool = False):
+        try:
+            if error is None:
+                await self._db_manager.mark_inbox_processed_async(entry_id)
+            else:
+                await self._db_manager.reschedule_inbox_async(entry_id, round(delay), error, give_up)
+        except Exception as ex:
+            # результат не записан - событие будет забрано повторно после истечения lease_seconds
+            self._logger.exception("[WEBHOOK INGESTION] Failed to save result: id = %s", entry_id, exc_info=ex)
+
+    def get_retry_delay(self, attempt: int) -> float:
+        return min(self._max_retry_delay, self._retry_delay * 2 ** (attempt - 1))
+
+    def get_stats(self) -> WebhookIngestorStats:
+        return WebhookIngestorStats(self._queue.qsize() + len(self._parked), self._in_flight, self._processed, self._rejected,
+                                    self._retried, self._failed, self._last_lag * 1000, self._avg_lag * 1000, self._avg_processing * 1000)
+
+    async def stop_async(self, timeout: float = 10):
+        """
+        Прекращает забирать события из БД и ждет обработки уже принятых (но не дольше timeout секунд).
+        Необработанные за это время события записываются в БД (забранные из нее - возвращаются) и будут применены после перезапуска.
+        """
+        if self._poller is not None:
+            self._poller.cancel()
+            await asyncio.gather(self._poller, return_exceptions=True)
+            self._poller = None
+
+        try:
+            await asyncio.wait_for(self._queue.join(), timeout)
+        except asyncio.TimeoutError:
+            self._logger.warning("[WEBHOOK INGESTION] Shutdown timeout, %s events are returned to inbox", self._queue.qsize())
+
+        for worker in self._workers:
+            worker.cancel()
+        await asyncio.gather(*self._workers, return_exceptions=True)
+        self._workers = []
+
+        while not self._queue.empty():
+            entry_id, event = self._queue.get_nowait()
+            if entry_id is None:
+                self._parked.append((0, event))
+                continue
+            try:
+                await self._db_manager.release_inbox_async(entry_id)
+            except Exception as ex:
+                # событие все равно будет забрано после истечения lease_seconds
+                self._logger.exception("[%s WEBHOOK] Failed to return event to inbox: " + _EVENT_FORMAT, event.method_id.upper(), *_event_log_args(event), exc_info=ex)
+
+        parked, self._parked = self._parked, []
+        for _, event in parked:
+            if not await self._add_to_inbox_async(event, None):
+                self._logger.error("[%s WEBHOOK] Event is lost on shutdown: " + _EVENT_FORMAT, event.method_id.upper(), *_event_log_args(event))
+        self._parked = []
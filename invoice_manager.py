@@ -1,17 +1,28 @@
-from db import DatabaseManager, InvoiceInfo, InvoiceStatus, PaymentMethod
+from db import DatabaseManager, InvoiceInfo, InvoiceStatus, PaymentMethod, ColumnRef
+from storage import DuplicateInvoiceError
+from cache import LRUCache, CacheStats
+import asyncio
+import time
 import uuid
 import datetime
 import logging
 import config
-import hashlib
 
-from AaioAsync import AaioAsync
-from lava_api.business import LavaBusinessAPI, CreateInvoiceException, InvoiceInfo as LavaInvoiceInfo
-from apis import enot, nicepay, pally
+from apis.base import ProviderAdapter, BillInfo, ProviderError
+from circuit import CircuitBreakers, CircuitOpenError
+from ranking import MethodRanking, MethodStats
+from metrics import PROVIDER_BILL_SECONDS, PROVIDER_BILL_ERRORS
+from tracing import traced_async, span
+from providers import ProviderRegistry
 
 
 class InvalidInvoiceStatusError(Exception):
+    invoice_id: str
+    invoice_status: InvoiceStatus
+
     def __init__(self, invoice_id: str, invoice_status: InvoiceStatus, *args, **kwargs):
+        self.invoice_id = invoice_id
+        self.invoice_status = invoice_status
         super().__init__(f"The operation cannot be performed on the invoice '{invoice_id}' with status '{invoice_status}'.", *args)
 
 
@@ -25,41 +36,145 @@ class InvalidPaymentMethodError(Exception):
         super().__init__(f"Payment method {method_id} not found or currently unavailable.", *args)
 
 
+class IdempotencyKeyReusedError(Exception):
+    def __init__(self, idempotency_key: str, *args, **kwargs):
+        super().__init__(f"Idempotency key '{idempotency_key}' was already used with different invoice parameters.", *args)
+
+
 class PaymentSystemError(Exception):
     def __init__(self, method_id: str, *args, **kwargs):
         super().__init__(f"An error occured in '{method_id}' payment method.", *args)
 
 
+# статусы, из которых счет еще может быть оплачен или отменен
+_OPEN_STATUSES = (InvoiceStatus.CREATED, InvoiceStatus.PROCESSING, InvoiceStatus.TIMEOUT, InvoiceStatus.DELEGATED)
+
+# (method_id, айди транзакции в платежной системе, новый статус) - идентифицирует вебхук платежной системы
+ProviderEventKey = tuple[str, str, InvoiceStatus]
+
+
+def _is_provider_failure(ex: Exception) -> bool:
+    """
+    Размыкать предохранитель должны сбои сети, таймауты и ошибки 5xx, а не отказ платежной системы по существу запроса.
+    """
+    return not isinstance(ex, ProviderError) or ex.transient
+
+
 class InvoiceManager:
 
     _db_manager: DatabaseManager
+    _providers: ProviderRegistry
+    _breakers: CircuitBreakers    # предохранители платежных систем, ключ - method_id
+    _ranking: MethodRanking    # статистика создания счетов по платежным системам
     _logger: logging.Logger
-    _aaio: AaioAsync
-    _lava: LavaBusinessAPI
-
-    def __init__(self, db_manager: DatabaseManager):
+    _idempotency_keys: LRUCache[str, str]    # Idempotency-Key -> invoice_id
+    _applied_events: LRUCache[ProviderEventKey, bool]    # недавно примененные вебхуки платежных систем
+
+    def __init__(self, db_manager: DatabaseManager, providers: ProviderRegistry, breakers: CircuitBreakers,
+                 idempotency_cache_size: int = 10000,
+                 idempotency_cache_ttl: float = 24 * 60 * 60,
+                 dedupe_cache_size: int = 10000,
+                 dedupe_window: float = 60 * 60,
+                 ranking_half_life: float = 300,
+                 ranking_latency_reference: float = 2):
+        """
+        :param idempotency_cache_size: сколько последних ключей идемпотентности хранить в памяти
+        :param idempotency_cache_ttl: время жизни ключа в памяти, сек; после него ключ проверяется по БД
+        :param dedupe_cache_size: сколько последних примененных вебхуков платежных систем помнить
+        :param dedupe_window: сколько секунд повтор вебхука отбрасывается без обращения к БД
+        :param ranking_half_life: через сколько секунд вес измерения времени создания счета уменьшается вдвое
+        :param ranking_latency_reference: время создания счета, сек, при котором платежная система получает оценку 0.5
+        """
         self._db_manager = db_manager
+        self._providers = providers
+        self._breakers = breakers
+        self._idempotency_keys = LRUCache(idempotency_cache_size, idempotency_cache_ttl)
+        self._applied_events = LRUCache(dedupe_cache_size, dedupe_window)
+        self._ranking = MethodRanking(ranking_half_life, ranking_latency_reference)
         self._logger = logging.getLogger("payment_api_logger")
 
-        self._aaio = AaioAsync(config.AAIO_API_KEY, config.AAIO_SHOP_ID, config.AAIO_KEY1)
-        self._lava = LavaBusinessAPI(config.LAVA_SECRET_KEY)
-
     @staticmethod
     def get_choose_method_url(invoice_id: str):
         return config.CHOOSE_METHOD_URL.format(invoice_id)
 
-    async def create_invoice_async(self, amount: float, comment: str, custom_fields: str, webhook_url: str) -> InvoiceInfo:
+    @traced_async("invoice_manager")
+    async def create_invoice_async(self, amount: float, comment: str, custom_fields: str, webhook_url: str,
+                                   idempotency_key: str | None = None) -> InvoiceInfo:
+        """
+        :param idempotency_key: если счет с таким ключом уже создан, возвращается он, а новый не создается.
+            Если параметры созданного счета отличаются от переданных, выбрасывается IdempotencyKeyReusedError
+        """
+        request = (amount, comment, custom_fields, webhook_url)
+        if idempotency_key:
+            invoice = await self._get_invoice_by_idempotency_key_async(idempotency_key)
+            if invoice is not None:
+                return self._check_idempotent_request(idempotency_key, invoice, request)
+
         invoice_id = str(uuid.uuid4())
 
-        invoice = InvoiceInfo(invoice_id, InvoiceStatus.CREATED, amount, 0, datetime.datetime.now(), None, comment, custom_fields, webhook_url, None, self.get_choose_method_url(invoice_id))
-        await self._db_manager.save_invoice_info_async(invoice)
+        invoice = InvoiceInfo(invoice_id, InvoiceStatus.CREATED, amount, 0, datetime.datetime.now(), None, comment, custom_fields, webhook_url, None, self.get_choose_method_url(invoice_id),
+                              idempotency_key=idempotency_key or None)
+        try:
+            await self._db_manager.save_invoice_info_async(invoice)
+        except DuplicateInvoiceError:
+            if not idempotency_key:
+                raise
+            # параллельный запрос с тем же ключом успел создать счет раньше
+            existing = await self._db_manager.get_invoice_by_idempotency_key_async(idempotency_key)
+            if existing is None:
+                raise
+            self._idempotency_keys.set(idempotency_key, existing.invoice_id)
+            return self._check_idempotent_request(idempotency_key, existing, request)
+
+        if idempotency_key:
+            self._idempotency_keys.set(idempotency_key, invoice_id)
+
+        self._logger.info("Created invoice: [%s] amount=%s", invoice.invoice_id, invoice.amount)
+
+        return invoice
+
+    @traced_async("invoice_manager")
+    async def create_invoices_async(self, items: list[tuple[float, str, str, str]]) -> list[InvoiceInfo]:
+        """
+        Создает несколько счетов одной записью в БД.
+        :param items: (amount, comment, custom_fields, webhook_url) для каждого счета, как в create_invoice_async
+        """
+        created = datetime.datetime.now()
+        invoices = []
+        for amount, comment, custom_fields, webhook_url in items:
+            invoice_id = str(uuid.uuid4())
+            invoices.append(InvoiceInfo(invoice_id, InvoiceStatus.CREATED, amount, 0, created, None, comment, custom_fields, webhook_url, None,
+                                        self.get_choose_method_url(invoice_id)))
+
+        await self._db_manager.insert_invoices_async(invoices)
 
-        self._logger.info(f"Created invoice: {invoice}")
+        self._logger.info("Created %s invoices: %s", len(invoices), ", ".join(invoice.invoice_id for invoice in invoices))
+        return invoices
 
+    @staticmethod
+    def _check_idempotent_request(idempotency_key: str, invoice: InvoiceInfo, request: tuple[float, str, str, str]) -> InvoiceInfo:
+        """
+        Повтор запроса с тем же Idempotency-Key должен совпадать с первым запросом: параметры запроса хранятся
+        в созданном по ключу счете, и другой запрос с тем же ключом - ошибка клиента, а не повтор.
+        """
+        if (invoice.amount, invoice.comment, invoice.custom_fields, invoice.webhook_url) != request:
+            raise IdempotencyKeyReusedError(idempotency_key)
         return invoice
 
+    async def _get_invoice_by_idempotency_key_async(self, idempotency_key: str) -> InvoiceInfo | None:
+        invoice_id = self._idempotency_keys.get(idempotency_key)
+        if invoice_id is not None:
+            return await self._db_manager.get_invoice_info_async(invoice_id)
+
+        invoice = await self._db_manager.get_invoice_by_idempotency_key_async(idempotency_key)
+        if invoice is not None:
+            self._idempotency_keys.set(idempotency_key, invoice.invoice_id)
+        return invoice
+
+    @traced_async("invoice_manager")
     async def process_invoice_async(self, invoice_id: str, method_id: str) -> InvoiceInfo:
-        invoice_info = await self._db_manager.get_invoice_info_async(invoice_id)
+        # не из кеша: если счет уже обработан другим процессом, по устаревшей копии был бы создан лишний счет в платежной системе
+        invoice_info = await self._db_manager.get_invoice_info_async(invoice_id, use_cache=False)
         if invoice_info is None:
             raise InvalidInvoiceError(invoice_id)
 
@@ -72,149 +187,169 @@ class InvoiceManager:
 
         invoice_info.status = InvoiceStatus.PROCESSING
 
-        match method.method_id:
-            case "aaio":
-                invoice_info.payment_url = await self._create_aaio_invoice(invoice_info)
-            case "lava":
-                lava_invoice_info = await self._create_lava_invoice(invoice_info)
-                invoice_info.payment_url = lava_invoice_info.url
-                invoice_info.payment_method_invoice_id = lava_invoice_info.invoice_id
-            case "enot":
-                enot_invoice_info = await self._create_enot_invoice(invoice_info)
-                invoice_info.payment_url = enot_invoice_info.url
-                invoice_info.payment_method_invoice_id = enot_invoice_info.invoice_id
-            case "nicepay":
-                nicepay_invoice_info = await self._create_nicepay_invoice(invoice_info)
-                invoice_info.payment_url = nicepay_invoice_info.link
-                invoice_info.payment_method_invoice_id = nicepay_invoice_info.payment_id
-            case "pally":
-                pally_invoice_info = await self._create_pally_invoice(invoice_info)
-                invoice_info.payment_url = pally_invoice_info.url
-                invoice_info.payment_method_invoice_id = pally_invoice_info.id
-            case _:
-                await self._delegate_invoice_async(invoice_info, method)
+        adapter = await self._providers.get_async(method.method_id)
+        if adapter is None:
+            await self._delegate_invoice_async(invoice_info, method)
+        else:
+            bill = await self._create_bill_async(adapter, invoice_info)
+            invoice_info.payment_url = bill.url
+            invoice_info.payment_method_invoice_id = bill.provider_invoice_id
 
         invoice_info.payment_method = method.method_id
 
-        await self._db_manager.save_invoice_info_async(invoice_info)
+        changes = invoice_info.get_changes()    # только payment_url, payment_method и payment_method_invoice_id
+        changes.pop("status", None)
+        applied = await self._db_manager.transition_invoice_async(invoice_id, (InvoiceStatus.CREATED,), invoice_info.status, changes,
+                                                                  require_no_payment_method=True)
+        if not applied:
+            # счет успели обработать параллельным запросом
+            await self._raise_transition_error_async(invoice_id, (InvoiceStatus.CREATED,))
+        invoice_info.mark_saved()
 
-        self._logger.info(f"Processed invoice: {invoice_info}")
+        self._logger.info("Processed invoice: [%s] method=%s payment_method_invoice_id=%s", invoice_id, invoice_info.payment_method,
+                          invoice_info.payment_method_invoice_id)
 
         return invoice_info
 
-    async def _create_aaio_invoice(self, invoice_info: InvoiceInfo) -> str:
-        try:
-            return await self._aaio.generatepaymenturl(invoice_info.amount, invoice_info.invoice_id, desc=invoice_info.comment)
-        except Exception as ex:
-            raise PaymentSystemError("aaio") from ex
-
-    async def _create_lava_invoice(self, invoice_info: InvoiceInfo) -> LavaInvoiceInfo:
-        try:
-            return await self._lava.create_invoice(invoice_info.amount, config.LAVA_SHOP_ID,
-                                                   order_id=invoice_info.invoice_id,
-                                                   comment=invoice_info.comment,
-                                                   webhook_url=config.LAVA_WEBHOOK_URL,
-                                                   success_url=config.SUCCESS_URL,
-                                                   fail_url=config.FAILED_URL)
-        except CreateInvoiceException as ex:
-            raise PaymentSystemError("lava") from ex
-
-    @staticmethod
-    async def _create_enot_invoice(invoice_info: InvoiceInfo) -> enot.EnotInvoiceInfo:
-        try:
-            return await enot.create_invoice_async(
-                shop_id=config.ENOT_SHOP_ID,
-                secret_key=config.ENOT_SECRET_KEY,
-                amount=invoice_info.amount,
-                order_id=invoice_info.invoice_id,
-                hook_url=config.ENOT_WEBHOOK_URL,
-                comment=invoice_info.comment,
-                success_url=config.SUCCESS_URL,
-                fail_url=config.FAILED_URL,
-            )
-        except enot.APIError as e:
-            raise PaymentSystemError("enot") from e
-
-    @staticmethod
-    async def _create_nicepay_invoice(invoice_info: InvoiceInfo) -> nicepay.NicepayInvoiceInfo:
-        try:
-            return await nicepay.create_invoice_async(config.NICEPAY_MERCHANT_ID,
-                                                      config.NICEPAY_SECRET_KEY,
-                                                      invoice_info.invoice_id,
-                                                      "customer@untstrong.ru",
-                                                      invoice_info.amount,
-                                                      "RUB",
-                                                      description=invoice_info.comment,
-                                                      success_url=config.SUCCESS_URL,
-                                                      fail_url=config.FAILED_URL,
-                                                      )
-        except nicepay.APIError as e:
-            raise PaymentSystemError("nicepay") from e
-
-    @staticmethod
-    async def _create_pally_invoice(invoice_info: InvoiceInfo) -> pally.PallyBillInfo:
+    async def _create_bill_async(self, adapter: ProviderAdapter, invoice_info: InvoiceInfo) -> BillInfo:
+        method_id = adapter.method_id
+        started = time.monotonic()
         try:
-            return await pally.create_bill_async(
-                config.PALLY_SHOP_ID,
-                config.PALLY_SECRET_KEY,
-                invoice_info.amount,
-                invoice_info.invoice_id,
-                invoice_info.comment,
-                invoice_info.comment,
-            )
-        except pally.APIError as e:
-            raise PaymentSystemError("pally") from e
+            with span("provider.create_bill", method=method_id):
+                bill = await self._breakers.get(method_id).call_async(lambda: adapter.create_bill(invoice_info), _is_provider_failure)
+        except CircuitOpenError as ex:
+            PROVIDER_BILL_ERRORS.inc(method_id, "circuit_open")
+            raise InvalidPaymentMethodError(method_id) from ex
+        except (ProviderError, asyncio.TimeoutError) as ex:
+            self._record_bill(method_id, started, "timeout" if isinstance(ex, asyncio.TimeoutError) else "provider_error")
+            raise PaymentSystemError(method_id) from ex
+        except Exception:
+            self._record_bill(method_id, started, "exception")
+            raise
+        self._record_bill(method_id, started)
+        return bill
+
+    def _record_bill(self, method_id: str, started: float, error: str | None = None):
+        elapsed = time.monotonic() - started
+        self._ranking.record(method_id, error is None, elapsed)
+        PROVIDER_BILL_SECONDS.observe(elapsed, method_id)
+        if error is not None:
+            PROVIDER_BILL_ERRORS.inc(method_id, error)
+
+    def rank_methods(self, methods: list[PaymentMethod]) -> list[PaymentMethod]:
+        """
+        Сортирует платежные системы: сначала быстро и успешно создающие счета.
+        """
+        return self._ranking.rank(methods)
+
+    def get_method_stats(self) -> list[MethodStats]:
+        return self._ranking.get_all_stats()
 
     @staticmethod
     async def _delegate_invoice_async(invoice_info: InvoiceInfo, method: PaymentMethod):
         invoice_info.payment_url = method.delegate_url
         invoice_info.status = InvoiceStatus.DELEGATED
 
-    @staticmethod
-    def _get_aaio_webhook_sign(shop_id: str, amount: str, currency: str, key2: str, invoice_id: str):
-        return hashlib.sha256(f"{shop_id}:{amount}:{currency}:{key2}:{invoice_id}".encode('utf-8')).hexdigest()
+    @traced_async("invoice_manager")
+    async def set_invoice_payed_async(self, invoice_id: str, credited: float | None = None, payed: datetime.datetime | None = None, payment_method_invoice_id: str | None = None,
+                                      method_id: str | None = None, transaction_id: str | None = None):
+        """
+        :param method_id: платежная система, приславшая вебхук
+        :param transaction_id: айди транзакции в платежной системе; вместе с method_id позволяет распознать повтор вебхука
+        """
+        event_key = self._get_event_key(method_id, transaction_id, InvoiceStatus.SUCCESS)
+        if self._is_duplicate_event(event_key):
+            return
+
+        changes = {
+            "credited": credited or ColumnRef("amount"),
+            "payed": payed or datetime.datetime.now(),
+        }
+        if payment_method_invoice_id is not None:
+            changes["payment_method_invoice_id"] = payment_method_invoice_id
+
+        applied = await self._db_manager.transition_invoice_async(invoice_id, _OPEN_STATUSES, InvoiceStatus.SUCCESS, changes,
+                                                                  enqueue_webhook=True)
+        if not applied:
+            await self._raise_transition_error_async(invoice_id, _OPEN_STATUSES, event_key)
+            self._remember_event(event_key)
+            return
+
+        self._remember_event(event_key)
+        self._logger.info("Invoice payed: [%s] credited=%s", invoice_id, credited)
+
+    @traced_async("invoice_manager")
+    async def set_invoice_status_async(self, invoice_id: str, status: InvoiceStatus,
+                                       method_id: str | None = None, transaction_id: str | None = None):
+        if status == InvoiceStatus.SUCCESS:
+            return await self.set_invoice_payed_async(invoice_id, method_id=method_id, transaction_id=transaction_id)
+
+        event_key = self._get_event_key(method_id, transaction_id, status)
+        if self._is_duplicate_event(event_key):
+            return
+
+        applied = await self._db_manager.transition_invoice_async(invoice_id, _OPEN_STATUSES, status, {
+            "credited": 0,
+            "payed": None,
+        })
+        if not applied:
+            await self._raise_transition_error_async(invoice_id, _OPEN_STATUSES, event_key)
+            self._remember_event(event_key)
+            return
+
+        self._remember_event(event_key)
+        self._logger.info("Invoice status updated: [%s] %s", status, invoice_id)
 
     @staticmethod
-    def check_aaio_sign(sign: str, amount: str, currency: str, invoice_id: str) -> bool:
-        s = InvoiceManager._get_aaio_webhook_sign(config.AAIO_SHOP_ID, amount, currency, config.AAIO_KEY2, invoice_id)
-        return s == sign
-
-    async def set_invoice_payed_async(self, invoice_id: str, credited: float | None = None, payed: datetime.datetime | None = None, payment_method_invoice_id: str | None = None) -> InvoiceInfo:
+    def _get_event_key(method_id: str | None, transaction_id: str | None, status: InvoiceStatus) -> ProviderEventKey | None:
+        if not method_id or not transaction_id:
+            return None
+        return method_id, transaction_id, status
+
+    def _is_duplicate_event(self, event_key: ProviderEventKey | None) -> bool:
+        if event_key is None or self._applied_events.get(event_key) is None:
+            return False
+        self._logger.debug("Duplicate webhook ignored: %s", event_key)
+        return True
+
+    def is_applied_event(self, method_id: str | None, transaction_id: str | None, status: InvoiceStatus) -> bool:
+        """
+        Проверяет, применял ли этот процесс такой вебхук недавно. Позволяет ответить на повтор, не обращаясь к БД.
+        """
+        return self._is_duplicate_event(self._get_event_key(method_id, transaction_id, status))
+
+    def _remember_event(self, event_key: ProviderEventKey | None):
+        if event_key is not None:
+            self._applied_events.set(event_key, True)
+
+    def get_dedupe_stats(self) -> CacheStats:
+        """
+        hits - отброшенные повторы вебхуков.
+        """
+        return self._applied_events.get_stats()
+
+    async def _raise_transition_error_async(self, invoice_id: str, from_statuses: tuple[InvoiceStatus, ...],
+                                            event_key: ProviderEventKey | None = None):
+        """
+        Вызывается, когда условный переход не выполнен: выясняет причину и выбрасывает соответствующее исключение.
+        Если переход не выполнен потому, что этот же вебхук уже был применен (event_key), исключение не выбрасывается.
+        """
         invoice_info = await self._db_manager.get_invoice_info_async(invoice_id)
-        if invoice_info is None:
-            raise InvalidInvoiceError(invoice_id)
-
-        if invoice_info.status == InvoiceStatus.SUCCESS or invoice_info.status == InvoiceStatus.ERROR:
-            raise InvalidInvoiceStatusError(invoice_info.invoice_id, invoice_info.status)
-
-        invoice_info.status = InvoiceStatus.SUCCESS
-        invoice_info.credited = credited or invoice_info.amount
-        invoice_info.payed = payed or datetime.datetime.now()
-        invoice_info.payment_method_invoice_id = payment_method_invoice_id
-
-        await self._db_manager.save_invoice_info_async(invoice_info)
+        if invoice_info is not None and invoice_info.status in from_statuses:
+            # в кеше устаревшая версия: счет изменил другой процесс
+            invoice_info = await self._db_manager.get_invoice_info_async(invoice_id, use_cache=False)
 
-        self._logger.info(f"Invoice payed: {invoice_info}")
-
-        return invoice_info
-
-    async def set_invoice_status_async(self, invoice_id: str, status: InvoiceStatus) -> InvoiceInfo:
-        if status == InvoiceStatus.SUCCESS:
-            return await self.set_invoice_payed_async(invoice_id)
-
-        invoice_info = await self._db_manager.get_invoice_info_async(invoice_id)
         if invoice_info is None:
             raise InvalidInvoiceError(invoice_id)
+        if event_key is not None and self._is_replay(invoice_info, event_key):
+            self._logger.debug("Webhook already applied: %s", event_key)
+            return
+        raise InvalidInvoiceStatusError(invoice_info.invoice_id, invoice_info.status)
 
-        if invoice_info.status == InvoiceStatus.SUCCESS or invoice_info.status == InvoiceStatus.ERROR:
-            raise InvalidInvoiceStatusError(invoice_info.invoice_id, invoice_info.status)
-
-        invoice_info.status = status
-        invoice_info.credited = 0
-        invoice_info.payed = None
-
-        await self._db_manager.save_invoice_info_async(invoice_info)
-
-        self._logger.info("Invoice status updated: [%s] %s", status, invoice_id)
-
-        return invoice_info
+    @staticmethod
+    def _is_replay(invoice_info: InvoiceInfo, event_key: ProviderEventKey) -> bool:
+        _, transaction_id, status = event_key
+        if invoice_info.status != status:
+            return False
+        # повторная оплата другой транзакцией - не повтор, а ошибка, которую нужно видеть в логах
+        return status != InvoiceStatus.SUCCESS or invoice_info.payment_method_invoice_id == transaction_id
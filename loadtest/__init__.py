@@ -0,0 +1,21 @@
+"""
+Нагрузочное тестирование платежного сервиса без обращения к настоящим платежным системам.
+
+1. Запустить имитацию платежных систем:
+       python -m loadtest.fake_providers --port 9100 --service-url http://127.0.0.1:8000 --latency-ms 150 --error-rate 0.01
+2. Указать в config.py сервиса адреса имитации и перезапустить его:
+       ENOT_API_URL = "http://127.0.0.1:9100/enot"
+       NICEPAY_API_URL = "http://127.0.0.1:9100/nicepay"
+       PALLY_API_URL = "http://127.0.0.1:9100/pally"
+   Секреты платежных систем в config.py сервиса и имитации должны совпадать (имитация читает тот же config.py).
+3. Запустить нагрузку:
+       python -m loadtest.driver --service-url http://127.0.0.1:8000 --fake-url http://127.0.0.1:9100 --rate 50 --duration 60
+
+Чтобы измерить пропускную способность самого сервиса без влияния БД, в config.py сервиса можно указать
+       STORAGE_ENGINE = "memory"
+       STORAGE_PAYMENT_METHODS = [{"method_id": "enot", "name": "Enot", "description": "", "icon_url": "", "instructions": None}, ...]
+
+Библиотеки AaioAsync и lava_api обращаются к зашитым в них адресам. Ссылка aaio формируется без запроса
+к API, поэтому aaio тестируется полностью; счета lava имитация создать не может, и lava по умолчанию
+исключена из нагрузки (вебхуки lava имитация отправляет).
+"""
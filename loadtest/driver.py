@@ -0,0 +1,201 @@
+"""
+Нагрузка на платежный сервис полными сценариями оплаты:
+create_invoice -> process_invoice -> вебхук платежной системы (через loadtest.fake_providers) -> вебхук серверу игры.
+Сценарии запускаются с заданной частотой независимо от того, завершились ли предыдущие (открытая модель нагрузки).
+По окончании выводится пропускная способность и p50/p95/p99 по каждому этапу.
+
+Запуск: python -m loadtest.driver --help
+"""
+import argparse
+import asyncio
+import itertools
+import json
+import math
+import random
+import time
+from dataclasses import dataclass, field
+
+import aiohttp
+from aiohttp import web
+
+import config
+from loadtest.webhook_sink import WebhookSink
+
+STAGES = ("create", "process", "provider_webhook", "user_webhook", "total")
+
+
+@dataclass
+class StageStats:
+    latencies: list[float] = field(default_factory=list)    # сек, только успешные
+    errors: int = 0
+
+    def add(self, latency: float):
+        self.latencies.append(latency)
+
+    def percentile(self, p: float) -> float:
+        if not self.latencies:
+            return math.nan
+        ordered = sorted(self.latencies)
+        return ordered[min(len(ordered) - 1, max(0, math.ceil(len(ordered) * p / 100) - 1))]
+
+
+class StageError(Exception):
+    pass
+
+
+class LoadDriver:
+
+    _service_url: str
+    _fake_url: str
+    _sink_url: str
+    _sink: WebhookSink
+    _methods: list[str]
+    _user_webhook_timeout: float
+    _session: aiohttp.ClientSession | None
+    stats: dict[str, StageStats]
+    started: int
+    completed: int
+
+    def __init__(self, service_url: str, fake_url: str, sink_url: str, sink: WebhookSink, methods: list[str],
+                 user_webhook_timeout: float = 30):
+        self._service_url = service_url.rstrip("/")
+        self._fake_url = fake_url.rstrip("/")
+        self._sink_url = sink_url
+        self._sink = sink
+        self._methods = methods
+        self._user_webhook_timeout = user_webhook_timeout
+        self._session = None
+        self.stats = {stage: StageStats() for stage in STAGES}
+        self.started = 0
+        self.completed = 0
+
+    async def run_async(self, rate: float, duration: float, max_in_flight: int) -> float:
+        """
+        Возвращает фактическую длительность теста, сек (включая ожидание незавершенных сценариев).
+        """
+        self._session = aiohttp.ClientSession(connector=aiohttp.TCPConnector(limit=max_in_flight))
+        in_flight = asyncio.Semaphore(max_in_flight)
+        tasks = set()
+        started = time.perf_counter()
+        try:
+            for i in itertools.count():
+                scheduled = started + i / rate
+                if scheduled - started >= duration:
+                    break
+                await asyncio.sleep(max(0.0, scheduled - time.perf_counter()))
+                if in_flight.locked():
+                    # сервис не успевает: сценарий пропускается, чтобы не копить бесконечную очередь
+                    self.stats["total"].errors += 1
+                    continue
+                await in_flight.acquire()
+                task = asyncio.create_task(self._flow_async(self._methods[i % len(self._methods)]))
+                task.add_done_callback(lambda _: in_flight.release())
+                tasks.add(task)
+                task.add_done_callback(tasks.discard)
+            await asyncio.gather(*tasks)
+        finally:
+            await self._session.close()
+        return time.perf_counter() - started
+
+    async def _flow_async(self, method_id: str):
+        self.started += 1
+        flow_started = time.perf_counter()
+        try:
+            amount = random.randint(10, 5000)
+            invoice_id = await self._stage_async("create", self._create_async(amount))
+            await self._stage_async("process", self._process_async(invoice_id, method_id))
+            paid = await self._stage_async("provider_webhook", self._pay_async(method_id, invoice_id, amount))
+            try:
+                arrived = await self._sink.wait_async(invoice_id, self._user_webhook_timeout)
+            except asyncio.TimeoutError:
+                self.stats["user_webhook"].errors += 1
+                raise StageError()
+            self.stats["user_webhook"].add(arrived - paid)
+        except StageError:
+            self.stats["total"].errors += 1
+            return
+        self.stats["total"].add(time.perf_counter() - flow_started)
+        self.completed += 1
+
+    async def _stage_async(self, stage: str, coro):
+        started = time.perf_counter()
+        try:
+            result = await coro
+        except Exception:
+            self.stats[stage].errors += 1
+            raise StageError()
+        self.stats[stage].add(time.perf_counter() - started)
+        return result
+
+    async def _create_async(self, amount: int) -> str:
+        body = {"user_token": config.AUTH_TOKEN, "amount": amount, "comment": "load test",
+                "webhook_url": self._sink_url, "webhook_field": "loadtest"}
+        async with self._session.post(f"{self._service_url}/payment_service/create_invoice", json=body) as resp:
+            resp.raise_for_status()
+            return (await resp.json())["id"]
+
+    async def _process_async(self, invoice_id: str, method_id: str):
+        body = {"invoice_id": invoice_id, "method_id": method_id}
+        async with self._session.post(f"{self._service_url}/payment_service/process_invoice", json=body) as resp:
+            resp.raise_for_status()
+
+    async def _pay_async(self, method_id: str, invoice_id: str, amount: int) -> float:
+        """
+        Возвращает момент, когда сервис ответил платежной системе на вебхук.
+        """
+        async with self._session.post(f"{self._fake_url}/{method_id}/_pay", json={"order_id": invoice_id, "amount": amount}) as resp:
+            resp.raise_for_status()
+            result = await resp.json()
+        if result["status"] != 200:
+            raise StageError(result)
+        return time.perf_counter()
+
+
+def format_report(driver: LoadDriver, elapsed: float) -> str:
+    lines = [f"flows: started {driver.started}, completed {driver.completed}, elapsed {elapsed:.1f}s, "
+             f"throughput {driver.completed / elapsed:.1f} flows/s",
+             f"{'stage':<18}{'ok':>8}{'errors':>8}{'rps':>9}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}"]
+    for stage, stats in driver.stats.items():
+        lines.append(f"{stage:<18}{len(stats.latencies):>8}{stats.errors:>8}{len(stats.latencies) / elapsed:>9.1f}"
+                     f"{stats.percentile(50) * 1000:>10.1f}{stats.percentile(95) * 1000:>10.1f}{stats.percentile(99) * 1000:>10.1f}")
+    return "\n".join(lines)
+
+
+async def main_async(args: argparse.Namespace):
+    sink = WebhookSink()
+    runner = web.AppRunner(sink.create_app())
+    await runner.setup()
+    await web.TCPSite(runner, args.sink_host, args.sink_port).start()
+    try:
+        driver = LoadDriver(args.service_url, args.fake_url, f"http://{args.sink_public_host or args.sink_host}:{args.sink_port}/webhook",
+                            sink, args.methods.split(","), args.user_webhook_timeout)
+        elapsed = await driver.run_async(args.rate, args.duration, args.max_in_flight)
+    finally:
+        await runner.cleanup()
+
+    print(format_report(driver, elapsed))
+    print(f"user webhooks received: {sink.received}, duplicates: {sink.duplicates}")
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump({stage: {"ok": len(s.latencies), "errors": s.errors, "p50": s.percentile(50), "p95": s.percentile(95),
+                               "p99": s.percentile(99)} for stage, s in driver.stats.items()}, f, indent=2)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Payment service load test driver")
+    parser.add_argument("--service-url", default="http://127.0.0.1:8000")
+    parser.add_argument("--fake-url", default="http://127.0.0.1:9100", help="loadtest.fake_providers base URL")
+    parser.add_argument("--methods", default="enot,nicepay,pally,aaio", help="comma-separated method ids, used round-robin")
+    parser.add_argument("--rate", type=float, default=10, help="flows started per second")
+    parser.add_argument("--duration", type=float, default=30, help="seconds to keep starting flows")
+    parser.add_argument("--max-in-flight", type=int, default=500)
+    parser.add_argument("--sink-host", default="127.0.0.1")
+    parser.add_argument("--sink-public-host", default=None, help="host the service should use to reach the sink")
+    parser.add_argument("--sink-port", type=int, default=9200)
+    parser.add_argument("--user-webhook-timeout", type=float, default=30)
+    parser.add_argument("--json", default=None, help="also write the per-stage summary to this file")
+    asyncio.run(main_async(parser.parse_args()))
+
+
+if __name__ == "__main__":
+    main()
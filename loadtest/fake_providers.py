@@ -0,0 +1,221 @@
+"""
+Имитация API платежных систем (enot, nicepay, pally, lava, aaio) с настраиваемыми задержкой и долей ошибок.
+
+Маршруты:
+    POST /enot/invoice/create, /nicepay/public/api/payment, /pally/api/v1/bill/create, /lava/business/invoice/create
+        создание счета в формате соответствующей платежной системы
+    POST /{method_id}/_pay {"order_id": ..., "amount": ...}
+        имитирует оплату: отправляет сервису подписанный вебхук и возвращает код его ответа
+    GET/POST /_control
+        текущие настройки; POST {"enot": {"latency_ms": 500, "error_rate": 0.2}} меняет их во время теста
+
+Запуск: python -m loadtest.fake_providers --help
+"""
+import argparse
+import asyncio
+import datetime
+import hashlib
+import hmac
+import json
+import random
+import time
+import uuid
+from dataclasses import dataclass, asdict
+
+import aiohttp
+from aiohttp import web
+
+import config
+
+METHODS = ("enot", "nicepay", "pally", "lava", "aaio")
+
+
+@dataclass
+class FakeProviderSettings:
+    latency_ms: float = 0    # задержка ответа на создание счета
+    jitter_ms: float = 0    # случайная добавка к задержке, от 0 до jitter_ms
+    error_rate: float = 0    # доля ответов с ошибкой
+
+
+class FakeProviders:
+
+    _service_url: str
+    _settings: dict[str, FakeProviderSettings]
+    _session: aiohttp.ClientSession | None
+
+    def __init__(self, service_url: str, settings: dict[str, FakeProviderSettings]):
+        """
+        :param service_url: адрес платежного сервиса, на который отправляются вебхуки
+        :param settings: настройки по платежным системам
+        """
+        self._service_url = service_url.rstrip("/")
+        self._settings = settings
+        self._session = None
+
+    def create_app(self) -> web.Application:
+        app = web.Application()
+        app.add_routes([
+            web.post("/enot/invoice/create", self._enot_create),
+            web.post("/nicepay/public/api/payment", self._nicepay_create),
+            web.post("/pally/api/v1/bill/create", self._pally_create),
+            web.post("/lava/business/invoice/create", self._lava_create),
+            web.post("/{method_id}/_pay", self._pay),
+            web.get("/_control", self._get_control),
+            web.post("/_control", self._set_control),
+        ])
+        app.on_startup.append(self._on_startup)
+        app.on_cleanup.append(self._on_cleanup)
+        return app
+
+    async def _on_startup(self, app: web.Application):
+        self._session = aiohttp.ClientSession(connector=aiohttp.TCPConnector(limit=0))
+
+    async def _on_cleanup(self, app: web.Application):
+        await self._session.close()
+
+    async def _simulate(self, method_id: str) -> bool:
+        """
+        Выдерживает задержку. Возвращает False, если нужно ответить ошибкой.
+        """
+        settings = self._settings[method_id]
+        delay = settings.latency_ms + random.uniform(0, settings.jitter_ms)
+        if delay > 0:
+            await asyncio.sleep(delay / 1000)
+        return random.random() >= settings.error_rate
+
+    async def _enot_create(self, request: web.Request) -> web.Response:
+        data = await request.json()
+        if not await self._simulate("enot"):
+            return web.json_response({"status": 500, "error": "Injected error"}, status=500)
+        invoice_id = str(uuid.uuid4())
+        expired = datetime.datetime.now() + datetime.timedelta(hours=1)
+        return web.json_response({"status": 200, "data": {
+            "id": invoice_id,
+            "amount": data["amount"],
+            "currency": data.get("currency", "RUB"),
+            "url": f"https://fake.enot/pay/{invoice_id}",
+            "expired": expired.strftime("%Y-%m-%d %H:%M:%S"),
+        }})
+
+    async def _nicepay_create(self, request: web.Request) -> web.Response:
+        data = await request.json()
+        if not await self._simulate("nicepay"):
+            return web.json_response({"status": "error", "data": {"message": "Injected error"}})
+        payment_id = str(uuid.uuid4())
+        return web.json_response({"status": "success", "data": {
+            "payment_id": payment_id,
+            "amount": data["amount"],
+            "currency": data["currency"],
+            "link": f"https://fake.nicepay/pay/{payment_id}",
+            "expired": time.time() + 3600,
+        }})
+
+    async def _pally_create(self, request: web.Request) -> web.Response:
+        await request.post()
+        if not await self._simulate("pally"):
+            return web.json_response({"success": "false", "message": "Injected error"}, status=400)
+        bill_id = uuid.uuid4().hex[:10]
+        return web.json_response({"success": "true", "bill_id": bill_id, "link_page_url": f"https://fake.pally/pay/{bill_id}"})
+
+    async def _lava_create(self, request: web.Request) -> web.Response:
+        data = await request.json()
+        if not await self._simulate("lava"):
+            return web.json_response({"error": "Injected error", "status": 500}, status=500)
+        invoice_id = str(uuid.uuid4())
+        return web.json_response({"status": 200, "status_check": True, "data": {
+            "id": invoice_id, "amount": data.get("sum"), "url": f"https://fake.lava/pay/{invoice_id}", "status": "created",
+        }})
+
+    async def _pay(self, request: web.Request) -> web.Response:
+        method_id = request.match_info["method_id"]
+        if method_id not in METHODS:
+            raise web.HTTPNotFound()
+        data = await request.json()
+        order_id = str(data["order_id"])
+        amount = float(data["amount"])
+
+        url = f"{self._service_url}/payment_service/{method_id}_webhook"
+        match method_id:
+            case "enot":
+                body = {"invoice_id": str(uuid.uuid4()), "status": "success", "amount": f"{amount:.2f}", "currency": "RUB",
+                        "order_id": order_id, "type": 1, "credited": f"{amount:.2f}", "code": 1,
+                        "pay_time": datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")}
+                headers = {}
+                secret = getattr(config, "ENOT_WEBHOOK_SECRET", None)
+                if secret:
+                    signed = json.dumps(body, sort_keys=True, separators=(", ", ": ")).encode("utf-8")
+                    headers["x-api-sha256-signature"] = hmac.new(secret.encode("utf-8"), signed, hashlib.sha256).hexdigest()
+                response = self._session.post(url, json=body, headers=headers)
+            case "nicepay":
+                cents = int(round(amount * 100))
+                params = {"result": "success", "payment_id": str(uuid.uuid4()), "merchant_id": config.NICEPAY_MERCHANT_ID,
+                          "order_id": order_id, "amount": str(cents), "amount_currency": "RUB", "profit": str(cents),
+                          "profit_currency": "RUB", "method": "fake"}
+                values = [params[key] for key in sorted(params)] + [config.NICEPAY_SECRET_KEY]
+                params["hash"] = hashlib.sha256("{np}".join(values).encode()).hexdigest()
+                response = self._session.get(url, params=params)
+            case "pally":
+                out_sum = f"{amount:.2f}"
+                sign = hashlib.md5(f"{out_sum}:{order_id}:{config.PALLY_SECRET_KEY}".encode("utf-8")).hexdigest().upper()
+                response = self._session.post(url, data={"InvId": order_id, "OutSum": out_sum, "Commission": "0",
+                                                         "TrsId": uuid.uuid4().hex, "Status": "SUCCESS", "SignatureValue": sign})
+            case "lava":
+                response = self._session.post(url, json={"invoice_id": str(uuid.uuid4()), "order_id": order_id, "status": "success",
+                                                         "pay_time": datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
+                                                         "amount": amount, "credited": amount})
+            case _:
+                amount_str = f"{amount:.2f}"
+                sign = hashlib.sha256(f"{config.AAIO_SHOP_ID}:{amount_str}:RUB:{config.AAIO_KEY2}:{order_id}".encode("utf-8")).hexdigest()
+                response = self._session.post(url, data={"merchant_id": config.AAIO_SHOP_ID, "invoice_id": str(uuid.uuid4()),
+                                                         "order_id": order_id, "amount": amount_str, "currency": "RUB",
+                                                         "profit": amount_str, "sign": sign})
+
+        async with response as resp:
+            return web.json_response({"status": resp.status, "body": await resp.text()})
+
+    async def _get_control(self, request: web.Request) -> web.Response:
+        return web.json_response({method_id: asdict(s) for method_id, s in self._settings.items()})
+
+    async def _set_control(self, request: web.Request) -> web.Response:
+        for method_id, values in (await request.json()).items():
+            settings = self._settings[method_id]
+            for key, value in values.items():
+                setattr(settings, key, type(getattr(settings, key))(value))
+        return await self._get_control(request)
+
+
+def parse_overrides(values: list[str]) -> dict[str, float]:
+    """
+    ["enot=500", "pally=20"] -> {"enot": 500.0, "pally": 20.0}
+    """
+    result = {}
+    for value in values:
+        method_id, number = value.split("=", 1)
+        if method_id not in METHODS:
+            raise argparse.ArgumentTypeError(f"Unknown payment method '{method_id}'")
+        result[method_id] = float(number)
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Fake payment providers for load testing")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=9100)
+    parser.add_argument("--service-url", default="http://127.0.0.1:8000", help="payment service base URL for provider webhooks")
+    parser.add_argument("--latency-ms", type=float, default=0)
+    parser.add_argument("--jitter-ms", type=float, default=0)
+    parser.add_argument("--error-rate", type=float, default=0)
+    parser.add_argument("--method-latency-ms", nargs="*", default=[], metavar="METHOD=MS")
+    parser.add_argument("--method-error-rate", nargs="*", default=[], metavar="METHOD=RATE")
+    args = parser.parse_args()
+
+    latency = parse_overrides(args.method_latency_ms)
+    error_rate = parse_overrides(args.method_error_rate)
+    settings = {method_id: FakeProviderSettings(latency.get(method_id, args.latency_ms), args.jitter_ms,
+                                                error_rate.get(method_id, args.error_rate))
+                for method_id in METHODS}
+    web.run_app(FakeProviders(args.service_url, settings).create_app(), host=args.host, port=args.port)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,75 @@
+"""
+Имитация сервера игры, принимающего вебхуки об оплате. Запоминает время получения вебхука по invoice_id.
+Обычно запускается драйвером (loadtest.driver) в его процессе; отдельный запуск - python -m loadtest.webhook_sink.
+"""
+import argparse
+import asyncio
+import time
+
+from aiohttp import web
+
+
+class WebhookSink:
+
+    received: int
+    duplicates: int
+    _arrivals: dict[str, float]    # invoice_id -> момент получения (time.perf_counter)
+    _waiters: dict[str, asyncio.Future]
+    _status: int
+
+    def __init__(self, status: int = 200):
+        """
+        :param status: код ответа на вебхук; не 200 заставляет сервис повторять доставку
+        """
+        self.received = 0
+        self.duplicates = 0
+        self._arrivals = {}
+        self._waiters = {}
+        self._status = status
+
+    def create_app(self) -> web.Application:
+        app = web.Application()
+        app.add_routes([web.post("/{tail:.*}", self._handle)])
+        return app
+
+    async def _handle(self, request: web.Request) -> web.Response:
+        arrived = time.perf_counter()
+        payload = await request.json()
+        invoice_id = str(payload.get("invoice_id"))
+        self.received += 1
+        if invoice_id in self._arrivals:
+            self.duplicates += 1
+        else:
+            self._arrivals[invoice_id] = arrived
+            waiter = self._waiters.pop(invoice_id, None)
+            if waiter is not None and not waiter.done():
+                waiter.set_result(arrived)
+        return web.json_response({"success": self._status == 200}, status=self._status)
+
+    async def wait_async(self, invoice_id: str, timeout: float) -> float:
+        """
+        Ждет вебхук по счету и возвращает момент его получения (time.perf_counter).
+        :raises asyncio.TimeoutError: вебхук не пришел за timeout секунд
+        """
+        arrived = self._arrivals.get(invoice_id)
+        if arrived is not None:
+            return arrived
+        waiter = self._waiters.setdefault(invoice_id, asyncio.get_running_loop().create_future())
+        try:
+            return await asyncio.wait_for(asyncio.shield(waiter), timeout)
+        finally:
+            if not waiter.done():
+                self._waiters.pop(invoice_id, None)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Fake game server webhook receiver")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=9200)
+    parser.add_argument("--status", type=int, default=200)
+    args = parser.parse_args()
+    web.run_app(WebhookSink(args.status).create_app(), host=args.host, port=args.port)
+
+
+if __name__ == "__main__":
+    main()
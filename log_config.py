@@ -0,0 +1,95 @@
+"""
+Настройка логирования. Обработчики логгера не пишут на диск сами: записи кладутся в очередь,
+а форматирование и запись выполняет отдельный поток (QueueListener). Поэтому запись в лог не блокирует цикл событий.
+Аргументы подставляются в сообщение тоже в потоке записи, поэтому в качестве аргументов нужно передавать неизменяемые значения
+(айди, статус, сумму), а не изменяемые объекты вроде InvoiceInfo или WebhookEvent: к моменту записи они уже могут измениться.
+"""
+import datetime
+import json
+import logging
+import logging.handlers
+import os
+import queue
+
+from tracing import get_trace_id
+
+# атрибуты LogRecord, которые не являются дополнительными полями (extra=)
+_RECORD_ATTRS = frozenset(vars(logging.LogRecord("", 0, "", 0, "", None, None))) | {"message", "asctime", "trace_id"}
+
+
+class JsonFormatter(logging.Formatter):
+    """
+    Одна запись - одна строка JSON. Поля, переданные через extra=, добавляются в запись.
+    """
+
+    def format(self, record: logging.LogRecord) -> str:
+        data = {
+            "time": datetime.datetime.fromtimestamp(record.created).isoformat(timespec="milliseconds"),
+            "level": record.levelname,
+            "logger": record.name,
+            "message": record.getMessage(),
+            "module": record.module,
+            "line": record.lineno,
+        }
+        trace_id = getattr(record, "trace_id", None)
+        if trace_id is not None:
+            data["trace_id"] = trace_id
+        for key, value in record.__dict__.items():
+            if key not in _RECORD_ATTRS and not key.startswith("_"):
+                data[key] = value
+        if record.exc_info:
+            data["exc"] = self.formatException(record.exc_info)
+        elif record.exc_text:
+            data["exc"] = record.exc_text
+        if record.stack_info:
+            data["stack"] = self.formatStack(record.stack_info)
+        return json.dumps(data, ensure_ascii=False, default=str)
+
+
+class _LazyQueueHandler(logging.handlers.QueueHandler):
+    """
+    В отличие от QueueHandler не форматирует запись перед постановкой в очередь, а только запоминает идентификатор
+    текущего запроса: contextvar недоступен в потоке записи.
+    """
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        record.trace_id = get_trace_id()
+        return record
+
+
+def setup_logging(logger: logging.Logger,
+                  level: int = logging.DEBUG,
+                  file_path: str | None = None,
+                  max_bytes: int = 50 * 1024 * 1024,
+                  backup_count: int = 10,
+                  console: bool = True) -> logging.handlers.QueueListener:
+    """
+    Подключает к логгеру очередь и запускает поток записи. Перед завершением процесса у возвращенного
+    QueueListener нужно вызвать stop(), чтобы записать оставшиеся в очереди записи.
+    Записи логгера больше не передаются обработчикам корневого логгера (propagate = False): иначе они бы дублировались
+    и записывались синхронно в цикле событий. Если нужен еще один получатель записей, его обработчик нужно добавить сюда.
+    :param file_path: файл для записей в формате JSON; None - не писать в файл
+    :param max_bytes: размер файла, после которого он переименовывается в .1, .2, ... и начинается новый
+    :param backup_count: сколько старых файлов хранить
+    :param console: дублировать записи в stderr в текстовом виде
+    """
+    handlers: list[logging.Handler] = []
+    if file_path is not None:
+        os.makedirs(os.path.dirname(file_path) or ".", exist_ok=True)
+        file_handler = logging.handlers.RotatingFileHandler(file_path, maxBytes=max_bytes, backupCount=backup_count,
+                                                            encoding="utf-8", delay=True)
+        file_handler.setFormatter(JsonFormatter())
+        handlers.append(file_handler)
+    if console:
+        console_handler = logging.StreamHandler()
+        console_handler.setFormatter(logging.Formatter(fmt='[%(asctime)s: %(levelname)s] %(message)s'))
+        handlers.append(console_handler)
+
+    log_queue = queue.SimpleQueue()
+    logger.setLevel(level)
+    logger.addHandler(_LazyQueueHandler(log_queue))
+    logger.propagate = False
+
+    listener = logging.handlers.QueueListener(log_queue, *handlers, respect_handler_level=True)
+    listener.start()
+    return listener
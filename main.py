@@ -2,46 +2,150 @@
 Основной файл.
 Команда для запуска: uvicorn main:app --reload
 """
-import threading
-import time
-
 import fastapi
-import requests
 import datetime
-import os
-from fastapi import FastAPI, Request, Form, Response, Query
+import hashlib
+import json
+from fastapi import FastAPI, Request, Response, Header
 from fastapi.responses import JSONResponse
 from fastapi.exceptions import HTTPException
 from fastapi.middleware.cors import CORSMiddleware
 from pydantic import BaseModel, Field
 import config
 import db as database
+import storage
 import logging
-from typing import Optional, Annotated
+from typing import Optional, Annotated, Literal
 import asyncio
 import config as cfg
 from starlette.datastructures import Headers
-from dataclasses import dataclass
-from apis import enot, nicepay, pally
+from contextlib import asynccontextmanager
+from dataclasses import dataclass, asdict, replace
+from apis.base import WebhookEvent
+from apis.sessions import ProviderSessions
+from webhooks import WebhookDispatcher
+from sweeper import InvoiceSweeper
+from ingestion import WebhookIngestor
+from providers import ProviderRegistry
+from circuit import CircuitBreakers, CircuitBreakerSettings, CircuitState
+import metrics
+import tracing
+import profiling
+from log_config import setup_logging
 
 # настройка логгера до импорта других частей проекта, чтобы в них корректно работал logging.getLogger
 logger = logging.getLogger("payment_api_logger")
-logger.setLevel(logging.DEBUG)
-if not cfg.DEBUG:
-    fh = logging.FileHandler(f'logs/log_{datetime.datetime.now().strftime("%m-%d-%Y-%H-%M-%S")}.log')
-    fh.setFormatter(logging.Formatter(fmt='[%(asctime)s: %(levelname)s] %(message)s'))
-    fh.setLevel(logging.DEBUG)
-    logger.addHandler(fh)
-ch = logging.StreamHandler()
-ch.setLevel(logging.DEBUG)
-logger.addHandler(ch)
-
-from invoice_manager import InvoiceManager, InvalidInvoiceStatusError, InvalidInvoiceError, InvalidPaymentMethodError, PaymentSystemError
-
-
-app = FastAPI(docs_url=None, redoc_url=None)    # docs_url и redoc_url отключают автоматическую документацию
-db = database.DatabaseManager(cfg.MYSQL_HOST, cfg.MYSQL_USER, cfg.MYSQL_PASSWORD, cfg.MYSQL_DATABASE)    # экземпляр класса для доступа к данным из БД.
-invoice_manager = InvoiceManager(db)
+log_listener = setup_logging(logger,
+                             file_path=None if cfg.DEBUG else getattr(cfg, "LOG_FILE", "logs/payment_service.log"),
+                             max_bytes=getattr(cfg, "LOG_MAX_BYTES", 50 * 1024 * 1024),
+                             backup_count=getattr(cfg, "LOG_BACKUP_COUNT", 10))    # запись в лог выполняется в отдельном потоке
+
+from invoice_manager import InvoiceManager, InvalidInvoiceStatusError, InvalidInvoiceError, InvalidPaymentMethodError, PaymentSystemError, \
+    IdempotencyKeyReusedError
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    """
+    Запуск и остановка фоновых служб приложения (создаются ниже, при импорте модуля).
+    """
+    if getattr(cfg, "TRACING_ENABLED", True):
+        trace_writer.start()
+    if getattr(cfg, "LOOP_WATCHDOG_ENABLED", False):
+        await loop_watchdog.start_async()
+    await db.connect_async()
+    if storage_engine_name != "mysql":
+        # SQLite и память не требуют отдельной подготовки БД: таблицы и платежные системы создаются при запуске
+        await db.create_tables_async()
+        for method in getattr(cfg, "STORAGE_PAYMENT_METHODS", []):
+            await db.engine.save_payment_method_async(database.PaymentMethod(**method))
+    await webhook_dispatcher.start_async()
+    await webhook_ingestor.start_async()
+    await invoice_sweeper.start_async()
+
+    yield
+
+    await invoice_sweeper.stop_async()
+    await webhook_ingestor.stop_async(getattr(cfg, "INGESTION_SHUTDOWN_TIMEOUT", 10))
+    await webhook_dispatcher.stop_async(getattr(cfg, "WEBHOOK_SHUTDOWN_TIMEOUT", 10))
+    await webhook_sessions.close_async()
+    await provider_sessions.close_async()
+    await db.close_async()
+    await loop_watchdog.stop_async()
+    trace_writer.close()
+    log_listener.stop()
+
+
+app = FastAPI(docs_url=None, redoc_url=None, lifespan=lifespan)    # docs_url и redoc_url отключают автоматическую документацию
+storage_engine_name = getattr(cfg, "STORAGE_ENGINE", "mysql")    # mysql, sqlite или memory, см. storage
+match storage_engine_name:
+    case "mysql":
+        storage_options = dict(host=cfg.MYSQL_HOST, user=cfg.MYSQL_USER, password=cfg.MYSQL_PASSWORD, db_name=cfg.MYSQL_DATABASE,
+                               min_size=getattr(cfg, "MYSQL_POOL_MIN_SIZE", 1),
+                               max_size=getattr(cfg, "MYSQL_POOL_MAX_SIZE", 10),
+                               pool_recycle=getattr(cfg, "MYSQL_POOL_RECYCLE", 3600),
+                               connect_timeout=getattr(cfg, "MYSQL_CONNECT_TIMEOUT", 10),
+                               acquire_timeout=getattr(cfg, "MYSQL_POOL_ACQUIRE_TIMEOUT", 5))
+    case "sqlite":
+        storage_options = dict(path=getattr(cfg, "SQLITE_PATH", "payment_service.db"),
+                               busy_timeout=getattr(cfg, "SQLITE_BUSY_TIMEOUT", 5))
+    case _:
+        storage_options = {}
+db = database.DatabaseManager(storage.create_engine(storage_engine_name, **storage_options),
+                              payment_methods_cache_ttl=getattr(cfg, "PAYMENT_METHODS_CACHE_TTL", 300),
+                              invoice_cache_size=getattr(cfg, "INVOICE_CACHE_SIZE", 10000),
+                              invoice_cache_ttl=getattr(cfg, "INVOICE_CACHE_TTL", 300),
+                              write_batch_size=getattr(cfg, "DB_WRITE_BATCH_SIZE", 0),
+                              write_batch_wait=getattr(cfg, "DB_WRITE_BATCH_WAIT", 0.002))    # экземпляр класса для доступа к данным из БД.
+provider_sessions = ProviderSessions(limit_per_host=getattr(cfg, "PROVIDER_LIMIT_PER_HOST", 20),
+                                     keepalive_timeout=getattr(cfg, "PROVIDER_KEEPALIVE_TIMEOUT", 60),
+                                     dns_cache_ttl=getattr(cfg, "PROVIDER_DNS_CACHE_TTL", 300),
+                                     connect_timeout=getattr(cfg, "PROVIDER_CONNECT_TIMEOUT", 5),
+                                     read_timeout=getattr(cfg, "PROVIDER_READ_TIMEOUT", 15))    # HTTP-сессии для запросов к платежным системам
+providers = ProviderRegistry(db, provider_sessions)    # адаптеры платежных систем, загружаются при первом обращении
+breaker_settings = CircuitBreakerSettings(deadline=getattr(cfg, "PROVIDER_DEADLINE", 10),
+                                          window=getattr(cfg, "CIRCUIT_BREAKER_WINDOW", 60),
+                                          min_requests=getattr(cfg, "CIRCUIT_BREAKER_MIN_REQUESTS", 10),
+                                          error_rate=getattr(cfg, "CIRCUIT_BREAKER_ERROR_RATE", 0.5),
+                                          p95_latency=getattr(cfg, "CIRCUIT_BREAKER_P95_LATENCY", 8),
+                                          open_duration=getattr(cfg, "CIRCUIT_BREAKER_OPEN_DURATION", 30),
+                                          half_open_probes=getattr(cfg, "CIRCUIT_BREAKER_HALF_OPEN_PROBES", 1))
+provider_breakers = CircuitBreakers(breaker_settings,
+                                    {method_id: replace(breaker_settings, **overrides)
+                                     for method_id, overrides in getattr(cfg, "CIRCUIT_BREAKER_BY_METHOD", {}).items()})    # предохранители платежных систем
+invoice_manager = InvoiceManager(db, providers, provider_breakers,
+                                 idempotency_cache_size=getattr(cfg, "IDEMPOTENCY_CACHE_SIZE", 10000),
+                                 idempotency_cache_ttl=getattr(cfg, "IDEMPOTENCY_CACHE_TTL", 24 * 60 * 60),
+                                 dedupe_cache_size=getattr(cfg, "WEBHOOK_DEDUPE_CACHE_SIZE", 10000),
+                                 dedupe_window=getattr(cfg, "WEBHOOK_DEDUPE_WINDOW", 60 * 60),
+                                 ranking_half_life=getattr(cfg, "PAYMENT_METHODS_RANKING_HALF_LIFE", 300),
+                                 ranking_latency_reference=getattr(cfg, "PAYMENT_METHODS_RANKING_LATENCY_REFERENCE", 2))
+webhook_sessions = ProviderSessions(limit_per_host=getattr(cfg, "WEBHOOK_LIMIT_PER_HOST", 4),
+                                    connect_timeout=getattr(cfg, "WEBHOOK_CONNECT_TIMEOUT", 5),
+                                    read_timeout=getattr(cfg, "WEBHOOK_READ_TIMEOUT", 10))    # HTTP-сессии для отправки вебхуков на сервера игры
+webhook_dispatcher = WebhookDispatcher(db, webhook_sessions, config.AUTH_TOKEN,
+                                       workers=getattr(cfg, "WEBHOOK_WORKERS", 8),
+                                       per_destination_limit=getattr(cfg, "WEBHOOK_LIMIT_PER_HOST", 4),
+                                       batch_size=getattr(cfg, "WEBHOOK_BATCH_SIZE", 50),
+                                       poll_interval=getattr(cfg, "WEBHOOK_POLL_INTERVAL", 5),
+                                       lease_seconds=getattr(cfg, "WEBHOOK_LEASE_SECONDS", 120),
+                                       max_attempts=getattr(cfg, "WEBHOOK_MAX_ATTEMPTS", 10),
+                                       base_delay=getattr(cfg, "WEBHOOK_RETRY_BASE_DELAY", 5),
+                                       max_delay=getattr(cfg, "WEBHOOK_RETRY_MAX_DELAY", 3600))
+webhook_ingestor = WebhookIngestor(db, invoice_manager, webhook_dispatcher.notify,
+                                   workers=getattr(cfg, "INGESTION_WORKERS", 4),
+                                   queue_size=getattr(cfg, "INGESTION_QUEUE_SIZE", 1000),
+                                   batch_size=getattr(cfg, "INGESTION_BATCH_SIZE", 50),
+                                   poll_interval=getattr(cfg, "INGESTION_POLL_INTERVAL", 5),
+                                   lease_seconds=getattr(cfg, "INGESTION_LEASE_SECONDS", 60),
+                                   retry_delay=getattr(cfg, "INGESTION_RETRY_DELAY", 2),
+                                   max_retry_delay=getattr(cfg, "INGESTION_MAX_RETRY_DELAY", 300))    # применяет события от платежных систем в фоне
+invoice_sweeper = InvoiceSweeper(db,
+                                 interval=getattr(cfg, "INVOICE_SWEEP_INTERVAL", 300),
+                                 batch_size=getattr(cfg, "INVOICE_SWEEP_BATCH_SIZE", 500),
+                                 default_ttl=datetime.timedelta(minutes=getattr(cfg, "INVOICE_TTL_MINUTES", 24 * 60)),
+                                 method_ttls={method_id: datetime.timedelta(minutes=minutes)
+                                              for method_id, minutes in getattr(cfg, "INVOICE_TTL_MINUTES_BY_METHOD", {}).items()})    # закрывает просроченные счета
 
 
 origins = [
@@ -49,6 +153,18 @@ origins = [
     "null"
 ]
 
+trace_writer = tracing.TraceWriter(getattr(cfg, "TRACE_FILE", "logs/traces.jsonl"))    # медленные и выборочные трассы запросов
+if getattr(cfg, "TRACING_ENABLED", True):
+    app.add_middleware(tracing.TracingMiddleware, writer=trace_writer,
+                       slow_threshold=getattr(cfg, "TRACE_SLOW_THRESHOLD_MS", 1000) / 1000,
+                       sample_rate=getattr(cfg, "TRACE_SAMPLE_RATE", 0.01))
+request_profiler = profiling.RequestProfiler(getattr(cfg, "PROFILE_DIR", "logs/profiles"),
+                                             threshold=getattr(cfg, "PROFILER_THRESHOLD_MS", 1000) / 1000,
+                                             max_files=getattr(cfg, "PROFILER_MAX_FILES", 100),
+                                             enabled=getattr(cfg, "PROFILER_ENABLED", False))    # профилирование медленных запросов
+loop_watchdog = profiling.LoopWatchdog(threshold=getattr(cfg, "LOOP_WATCHDOG_THRESHOLD_MS", 100) / 1000)    # обнаружение блокировок цикла событий
+app.add_middleware(profiling.ProfilerMiddleware, profiler=request_profiler)
+app.add_middleware(metrics.MetricsMiddleware)
 app.add_middleware(
     CORSMiddleware,
     allow_origins=origins,
@@ -70,185 +186,55 @@ def api_exception_handler(request: Request, exc: APIException):
                         content={"status": "error", "code": str(exc.code), "message": exc.message, "detail": exc.message})
 
 
-def send_webhook(invoice_info: database.InvoiceInfo):
-    retryings = 5
-    pause = 5
-
-    for trying in range(retryings):
-
-        try:
-            webhook_data = {
-                "invoice_id": invoice_info.invoice_id,
-                "sum": invoice_info.amount,
-                "comment": invoice_info.comment,
-                "custom_field": invoice_info.custom_fields,
-            }
-            resp = requests.post(invoice_info.webhook_url, json=webhook_data, headers={"User-Id": config.AUTH_TOKEN})
-            if resp.status_code != 200:
-                logger.error(f"Failed to send webhook with status code {resp.status_code}: id = {invoice_info.invoice_id}")
-                time.sleep(pause)
-                continue
-            logger.info(f"[USER WEBHOOK] Sended successfully: id = {invoice_info.invoice_id}")
-            return
-        except Exception as ex:
-            logger.exception(f"Internal error occured while sending webhook: id = {invoice_info.invoice_id}", exc_info=ex)
-            time.sleep(pause)
-            continue
-
-
-@app.post("/payment_service/aaio_webhook/")
-@app.post("/payment_service/aaio_webhook")
-async def aaio_webhook(invoice_id=Form(), order_id=Form(), amount=Form(), currency=Form(), sign=Form(), profit=Form()):
-    if not InvoiceManager.check_aaio_sign(str(sign), str(amount), str(currency), str(order_id)):
-        logger.error(f"[AAIO WEBHOOK] Failed to check sign: invoice_id={invoice_id}, order_id={order_id}, amount={amount}, currency={currency}, sign={sign}")
-
-    try:
-        invoice = await invoice_manager.set_invoice_payed_async(str(order_id), float(profit), payment_method_invoice_id=str(invoice_id))
-    except Exception as ex:
-        logger.error(f"[AAIO WEBHOOK] Failed to handle: invoice_id={invoice_id}, order_id={order_id}, amount={amount}, currency={currency}, sign={sign}", exc_info=ex)
-        return
+def check_user_token(user_token: str):
+    if user_token != config.AUTH_TOKEN:
+        raise APIException(403, "Invalid user token")
 
-    if invoice.webhook_url:
-        send_webhook_thread = threading.Thread(target=send_webhook, args=(invoice,))
-        send_webhook_thread.start()
 
+def ingest_webhook(event: WebhookEvent) -> JSONResponse:
+    """
+    Передает событие от платежной системы обработчикам и формирует ответ ей, не дожидаясь применения события.
+    Если очередь обработчиков переполнена, отвечает 503, чтобы платежная система повторила вебхук позже.
+    """
+    if not webhook_ingestor.submit(event):
+        return JSONResponse({"success": False, "error": "Service is unavailable"}, status_code=503)
+    return JSONResponse({"success": True})
 
-class LavaWebhook(BaseModel):
-    invoice_id: str
-    order_id: str
-    status: str
-    pay_time: str
-    amount: float
-    custom_fields: Optional[str | None] = None
-    credited: float
 
+@app.api_route("/payment_service/{method_id}_webhook/", methods=["GET", "POST"])
+@app.api_route("/payment_service/{method_id}_webhook", methods=["GET", "POST"])
+async def provider_webhook(request: Request, method_id: str):
+    """
+    Вебхук платежной системы. Разбор и проверку подписи выполняет адаптер платежной системы (см. providers.py).
+    """
+    # отключенная платежная система все равно принимает вебхуки по уже выставленным счетам
+    adapter = await providers.get_async(method_id, require_enabled=False)
+    if adapter is None:
+        raise HTTPException(status_code=404, detail="Unknown payment method")
 
-@app.post("/payment_service/lava_webhook/")
-@app.post("/payment_service/lava_webhook")
-async def lava_webhook(webhook: LavaWebhook, response: Response):
-    pay_time = None
     try:
-        pay_time = datetime.datetime.strptime(webhook.pay_time, "%Y-%m-%d %H:%M:%S")
+        data = await adapter.read_webhook_data(request)
     except ValueError as ex:
-        logger.error(f"[LAVA WEBHOOK] Failed to parse pay time '{webhook.pay_time}'", exc_info=ex)
-
-    try:
-        invoice = await invoice_manager.set_invoice_payed_async(str(webhook.order_id), float(webhook.credited), payed=pay_time, payment_method_invoice_id=str(webhook.invoice_id))
-    except Exception as ex:
-        logger.error(f"[LAVA WEBHOOK] Failed to handle: invoice_id={webhook.invoice_id}, order_id={webhook.order_id}, amount={webhook.amount}", exc_info=ex)
-        response.status_code = 500
-        return JSONResponse({"success": False, "error": str(ex)})
-
-    if invoice.webhook_url:
-        send_webhook_thread = threading.Thread(target=send_webhook, args=(invoice,))
-        send_webhook_thread.start()
-
-    response.status_code = 200
-    return JSONResponse({"success": True})
-
-
-@app.post("/payment_service/enot_webhook/")
-@app.post("/payment_service/enot_webhook")
-async def enot_webhook(webhook: enot.EnotWebhook, response: Response):
-    if webhook.status == enot.EnotWebhookStatus.success:
-        try:
-            invoice = await invoice_manager.set_invoice_payed_async(str(webhook.order_id), float(webhook.credited), payed=webhook.pay_time, payment_method_invoice_id=str(webhook.invoice_id))
-        except Exception as ex:
-            logger.error(f"[ENOT WEBHOOK] Failed to handle: invoice_id={webhook.invoice_id}, order_id={webhook.order_id}, amount={webhook.amount}", exc_info=ex)
-            response.status_code = 500
-            return JSONResponse({"success": False, "error": str(ex)})
-
-        if invoice.webhook_url:
-            send_webhook_thread = threading.Thread(target=send_webhook, args=(invoice,))
-            send_webhook_thread.start()
-
-        response.status_code = 200
-        return JSONResponse({"success": True})
-    elif webhook.status != enot.EnotWebhookStatus.refund:
-        try:
-            status = database.InvoiceStatus.TIMEOUT if webhook.status == webhook.status.expired else database.InvoiceStatus.ERROR
-            invoice = await invoice_manager.set_invoice_status_async(str(webhook.order_id), status)
-        except Exception as ex:
-            logger.error(
-                f"[ENOT WEBHOOK] Failed to handle: status={webhook.status}, invoice_id={webhook.invoice_id}, order_id={webhook.order_id}, amount={webhook.amount}",exc_info=ex)
-            response.status_code = 500
-            return JSONResponse({"success": False, "error": str(ex)})
-        response.status_code = 200
-        return JSONResponse({"success": True})
-
+        logger.error("[%s WEBHOOK] Failed to read request body", method_id.upper(), exc_info=ex)
+        raise HTTPException(status_code=422, detail="Invalid webhook data")
 
-@app.get("/payment_service/nicepay_webhook/")
-@app.get("/payment_service/nicepay_webhook")
-async def nicepay_webhook(request: Request, webhook: Annotated[nicepay.NicepayWebhook, Query()], response: Response):
-    if not nicepay.is_hash_valid(config.NICEPAY_SECRET_KEY, dict(request.query_params)):
-        raise HTTPException(status_code=401, detail="Invalid hash")
-
-    if webhook.result == nicepay.WebhookInvoiceStatus.success:
-        try:
-            invoice = await invoice_manager.set_invoice_payed_async(str(webhook.order_id), float(webhook.profit), payment_method_invoice_id=webhook.payment_id)
-        except Exception as ex:
-            logger.error(f"[NICEPAY WEBHOOK] Failed to handle: payment_id={webhook.payment_id}, order_id={webhook.order_id}, amount={webhook.amount}", exc_info=ex)
-            response.status_code = 500
-            return JSONResponse({"success": False, "error": str(ex)})
-
-        if invoice.webhook_url:
-            send_webhook_thread = threading.Thread(target=send_webhook, args=(invoice,))
-            send_webhook_thread.start()
-
-        response.status_code = 200
-        return JSONResponse({"success": True})
-    else:
-        try:
-            invoice = await invoice_manager.set_invoice_status_async(webhook.order_id, database.InvoiceStatus.ERROR)
-        except Exception as ex:
-            logger.error(
-                f"[NICEPAY WEBHOOK] Failed to handle: status={webhook.result}, payment_id={webhook.payment_id}, order_id={webhook.order_id}, amount={webhook.amount}",exc_info=ex)
-            response.status_code = 500
-            return JSONResponse({"success": False, "error": str(ex)})
-        response.status_code = 200
-        return JSONResponse({"success": True})
-
-
-@app.post("/payment_service/pally_webhook/")
-@app.post("/payment_service/pally_webhook")
-async def pally_webhook(request: Request, webhook: Annotated[pally.PostbackForm, Form()], response: Response):
-    if not pally.is_signature_valid(webhook.SignatureValue, webhook.OutSum, webhook.InvId):
+    if not adapter.verify_signature(data, request.headers):
+        logger.error("[%s WEBHOOK] Invalid signature: %s", method_id.upper(), data)
         raise HTTPException(status_code=401, detail="Invalid signature")
 
-    if webhook.Status in ("SUCCESS", "OVERPAID"):
-        try:
-            invoice = await invoice_manager.set_invoice_payed_async(
-                str(webhook.InvId),
-                float(webhook.OutSum),
-            )
-        except Exception as ex:
-            logger.error(
-                f"[PALLY WEBHOOK] Failed to handle: InvId={webhook.InvId}, OutSum={webhook.OutSum}",
-                exc_info=ex,
-            )
-            response.status_code = 500
-            return JSONResponse({"success": False, "error": str(ex)})
-
-        if invoice.webhook_url:
-            send_webhook_thread = threading.Thread(target=send_webhook, args=(invoice,))
-            send_webhook_thread.start()
-
-        response.status_code = 200
-        return JSONResponse({"success": True})
-    else:
-        try:
-            invoice = await invoice_manager.set_invoice_status_async(
-                webhook.InvId, database.InvoiceStatus.ERROR
-            )
-        except Exception as ex:
-            logger.error(
-                f"[PALLY WEBHOOK] Failed to handle: Status={webhook.Status}, InvId={webhook.InvId}, ErrorCode={webhook.ErrorCode}, ErrorMessage={webhook.ErrorMessage}",
-                exc_info=ex,
-            )
-            response.status_code = 500
-            return JSONResponse({"success": False, "error": str(ex)})
-        response.status_code = 200
+    try:
+        event = adapter.parse_webhook(data)
+    except ValueError as ex:
+        logger.error("[%s WEBHOOK] Failed to parse: %s", method_id.upper(), data, exc_info=ex)
+        raise HTTPException(status_code=422, detail="Invalid webhook data")
+
+    if event is None:
         return JSONResponse({"success": True})
+    if invoice_manager.is_applied_event(event.method_id, event.transaction_id, event.status):
+        return JSONResponse({"success": True})    # повтор уже примененного вебхука
+    if event.status != database.InvoiceStatus.SUCCESS:
+        logger.warning("[%s WEBHOOK] Payment failed: %s", method_id.upper(), data)
+    return ingest_webhook(event)
 
 
 @dataclass
@@ -268,18 +254,53 @@ class CreateInvoiceRequest(BaseModel):
 
 @app.post("/payment_service/create_invoice/")
 @app.post("/payment_service/create_invoice")
-async def create_invoice(request: fastapi.Request, invoice_request: CreateInvoiceRequest) -> ResponseCreateInvoice:
-    if invoice_request.user_token != config.AUTH_TOKEN:
-        raise APIException(403, "Invalid user token")
+async def create_invoice(request: fastapi.Request, invoice_request: CreateInvoiceRequest,
+                         idempotency_key: Annotated[str | None, Header(alias="Idempotency-Key", max_length=64)] = None) -> ResponseCreateInvoice:
+    """
+    Если передан заголовок Idempotency-Key, повторный запрос с тем же ключом вернет уже созданный счет;
+    запрос с тем же ключом, но другими параметрами счета отклоняется с кодом 422.
+    """
+    check_user_token(invoice_request.user_token)
 
     try:
-        invoice = await invoice_manager.create_invoice_async(invoice_request.amount, invoice_request.comment, invoice_request.webhook_field, invoice_request.webhook_url)
-        return ResponseCreateInvoice("success", invoice.invoice_id, invoice.payment_url)
+        invoice = await invoice_manager.create_invoice_async(invoice_request.amount, invoice_request.comment, invoice_request.webhook_field, invoice_request.webhook_url,
+                                                             idempotency_key=idempotency_key)
+        # url страницы выбора способа оплаты, а не invoice.payment_url: при повторном запросе счет может быть уже обработан
+        return ResponseCreateInvoice("success", invoice.invoice_id, InvoiceManager.get_choose_method_url(invoice.invoice_id))
+    except IdempotencyKeyReusedError as ex:
+        raise APIException(422, str(ex))
     except Exception as ex:
         logger.exception("An error occured in create_invoice", exc_info=ex)
         raise APIException(500, "Internal server error")
 
 
+@dataclass
+class ResponseCreateInvoices:
+    status: str
+    invoices: list[ResponseCreateInvoice]
+
+
+@app.post("/payment_service/create_invoices/")
+@app.post("/payment_service/create_invoices")
+async def create_invoices(invoice_requests: list[CreateInvoiceRequest]) -> ResponseCreateInvoices:
+    """
+    Создает несколько счетов одним запросом к БД: либо все, либо ни одного. Счета возвращаются в порядке запроса.
+    """
+    for invoice_request in invoice_requests:
+        check_user_token(invoice_request.user_token)
+    max_items = getattr(cfg, "BULK_INVOICE_MAX_ITEMS", 1000)
+    if not 0 < len(invoice_requests) <= max_items:
+        raise APIException(422, f"Expected from 1 to {max_items} invoices")
+
+    try:
+        invoices = await invoice_manager.create_invoices_async([(r.amount, r.comment, r.webhook_field, r.webhook_url) for r in invoice_requests])
+        return ResponseCreateInvoices("success", [ResponseCreateInvoice("success", invoice.invoice_id, InvoiceManager.get_choose_method_url(invoice.invoice_id))
+                                                  for invoice in invoices])
+    except Exception as ex:
+        logger.exception("An error occured in create_invoices", exc_info=ex)
+        raise APIException(500, "Internal server error")
+
+
 @dataclass
 class RequestProcessInvoice:
     invoice_id: str
@@ -324,13 +345,179 @@ class PaymentMethod:
     description: str
     icon_url: str
     instructions: str
+    available: bool    # False, пока предохранитель платежной системы разомкнут
+
+
+@dataclass
+class MethodsResponseCache:
+    """
+    Готовое тело ответа /methods и его ETag. Пересчитывается только после перезагрузки платежных систем из БД,
+    изменения доступности платежных систем или их порядка.
+    """
+    version: int = -1
+    order: tuple[str, ...] = ()
+    unavailable: frozenset[str] = frozenset()
+    body: bytes = b""
+    etag: str = ""
+
+
+methods_response_cache = {
+    "db": MethodsResponseCache(),    # в порядке таблицы payment_methods
+    "score": MethodsResponseCache(),    # по оценке InvoiceManager.rank_methods
+}
+
+
+async def get_methods_response_async(order_by: str) -> MethodsResponseCache:
+    methods = await db.get_payment_methods_async()
+    unavailable = provider_breakers.get_unavailable()
+    if order_by == "score":
+        methods = invoice_manager.rank_methods(methods)
+        methods.sort(key=lambda m: m.method_id in unavailable)
+    order = tuple(m.method_id for m in methods)
+
+    cache = methods_response_cache[order_by]
+    if cache.version != db.payment_methods_version or cache.order != order or cache.unavailable != unavailable:
+        content = [asdict(PaymentMethod(m.method_id, m.name, m.description, m.icon_url, m.instructions or "",
+                                        m.method_id not in unavailable)) for m in methods]
+        body = json.dumps(content, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+        cache.body = body
+        cache.etag = f'"{hashlib.sha1(body).hexdigest()}"'
+        cache.version = db.payment_methods_version
+        cache.order = order
+        cache.unavailable = unavailable
+    return cache
+
+
+def is_etag_matched(if_none_match: str | None, etag: str) -> bool:
+    if not if_none_match:
+        return False
+    if if_none_match.strip() == "*":
+        return True
+    return any(tag.strip().removeprefix("W/") == etag for tag in if_none_match.split(","))
 
 
 @app.get("/payment_service/methods/")
 @app.get("/payment_service/methods")
-async def get_payment_methods() -> list[PaymentMethod]:
-    methods = await db.get_payment_methods_async()
-    return [PaymentMethod(m.method_id, m.name, m.description, m.icon_url, m.instructions or "") for m in methods]
+async def get_payment_methods(request: Request,
+                              order_by: Literal["db", "score"] = getattr(cfg, "PAYMENT_METHODS_ORDER", "db")) -> Response:
+    """
+    :param order_by: db - в порядке таблицы payment_methods; score - сначала платежные системы, которые быстро и успешно создают счета.
+        Порядок score меняется вместе со статистикой, а с ним и ETag, поэтому он включается явно (параметром или PAYMENT_METHODS_ORDER)
+    """
+    cached = await get_methods_response_async(order_by)
+    headers = {"ETag": cached.etag, "Cache-Control": "no-cache"}
+    if is_etag_matched(request.headers.get("if-none-match"), cached.etag):
+        return Response(status_code=304, headers=headers)
+    return Response(cached.body, media_type="application/json", headers=headers)
+
+
+@app.post("/payment_service/methods/invalidate/")
+@app.post("/payment_service/methods/invalidate")
+async def invalidate_payment_methods(user_token: str):
+    """
+    Сбрасывает кеш платежных систем после изменения таблицы payment_methods.
+    Действует на процесс, принявший запрос; остальные воркеры обновятся по истечении PAYMENT_METHODS_CACHE_TTL.
+    """
+    check_user_token(user_token)
+    db.invalidate_payment_methods_cache()
+    return JSONResponse({"success": True})
+
+
+@app.get("/payment_service/stats/")
+@app.get("/payment_service/stats")
+async def get_stats(user_token: str) -> dict:
+    check_user_token(user_token)
+    coalescer_stats = db.get_write_coalescer_stats()
+    return {
+        "db_pool": asdict(db.get_pool_stats()),
+        "invoice_cache": asdict(db.get_invoice_cache_stats()),
+        "write_coalescer": asdict(coalescer_stats) if coalescer_stats is not None else None,
+        "provider_sessions": [asdict(s) for s in provider_sessions.get_stats()],
+        "circuit_breakers": [asdict(s) for s in provider_breakers.get_stats()],
+        "payment_method_ranking": [asdict(s) for s in invoice_manager.get_method_stats()],
+        "providers": {method_id: asdict(h) for method_id, h in (await providers.get_health_async()).items()},
+        "webhook_ingestion": asdict(webhook_ingestor.get_stats()),
+        "webhook_dedupe": asdict(invoice_manager.get_dedupe_stats()),
+        "webhooks": asdict(webhook_dispatcher.get_stats()),
+        "webhook_outbox": asdict(await db.get_outbox_backlog_async()),
+    }
+
+
+def get_pool_metrics() -> dict[tuple[str], int]:
+    stats = db.get_pool_stats()
+    return {("in_use",): stats.in_use, ("free",): stats.free, ("waiters",): stats.waiters}
+
+
+metrics.REGISTRY.gauge("payment_db_pool_connections", "Storage connections by state.", get_pool_metrics, ("state",))
+metrics.REGISTRY.gauge("payment_webhook_ingestion_queue", "Provider webhook events waiting to be applied.",
+                       lambda: {(): webhook_ingestor.get_stats().queued})
+metrics.REGISTRY.gauge("payment_webhook_delivery_queue", "Outgoing webhooks claimed from the outbox and not yet sent.",
+                       lambda: {(): webhook_dispatcher.get_stats().queued})
+metrics.REGISTRY.gauge("payment_circuit_breaker_open", "1 while the payment method circuit breaker is open.",
+                       lambda: {(s.name,): int(s.state == CircuitState.OPEN) for s in provider_breakers.get_stats()},
+                       ("payment_method",))
+
+
+@app.get("/payment_service/metrics/")
+@app.get("/payment_service/metrics")
+async def get_metrics(user_token: str) -> Response:
+    """
+    Метрики в текстовом формате Prometheus.
+    """
+    check_user_token(user_token)
+    return Response(metrics.REGISTRY.render(), media_type="text/plain; version=0.0.4; charset=utf-8")
+
+
+@dataclass
+class DiagnosticsState:
+    profiler_enabled: bool
+    profiler_threshold_ms: float
+    profiles_saved: int
+    watchdog: dict
+
+
+class DiagnosticsRequest(BaseModel):
+    user_token: str
+    profiler_enabled: Optional[bool] = None
+    profiler_threshold_ms: Optional[float] = Field(None, ge=0)
+    watchdog_enabled: Optional[bool] = None
+    watchdog_threshold_ms: Optional[float] = Field(None, gt=0)
+
+
+def get_diagnostics_state() -> DiagnosticsState:
+    return DiagnosticsState(request_profiler.enabled, request_profiler.threshold * 1000, request_profiler.saved,
+                            asdict(loop_watchdog.get_stats()))
+
+
+@app.get("/payment_service/admin/diagnostics/")
+@app.get("/payment_service/admin/diagnostics")
+async def get_diagnostics(user_token: str) -> DiagnosticsState:
+    check_user_token(user_token)
+    return get_diagnostics_state()
+
+
+@app.post("/payment_service/admin/diagnostics/")
+@app.post("/payment_service/admin/diagnostics")
+async def set_diagnostics(request: DiagnosticsRequest) -> DiagnosticsState:
+    """
+    Включает и выключает профилирование медленных запросов и обнаружение блокировок цикла событий.
+    Действует на процесс, принявший запрос. Не переданные параметры не меняются.
+    """
+    check_user_token(request.user_token)
+
+    if request.profiler_threshold_ms is not None:
+        request_profiler.threshold = request.profiler_threshold_ms / 1000
+    if request.profiler_enabled is not None:
+        request_profiler.enabled = request.profiler_enabled
+    if request.watchdog_threshold_ms is not None:
+        loop_watchdog.threshold = request.watchdog_threshold_ms / 1000
+    if request.watchdog_enabled is True:
+        await loop_watchdog.start_async()
+    elif request.watchdog_enabled is False:
+        await loop_watchdog.stop_async()
+
+    logger.info("Diagnostics changed: %s", get_diagnostics_state())
+    return get_diagnostics_state()
 
 
 # только для тестирования
@@ -0,0 +1,254 @@
+"""
+Метрики в текстовом формате Prometheus.
+Значения хранятся в обычных словарях без блокировок: вся запись выполняется из одного цикла событий,
+а запись одного значения - это поиск в словаре и сложение.
+"""
+import bisect
+import functools
+import time
+from abc import ABC, abstractmethod
+from typing import Callable, Iterable
+
+from starlette.types import ASGIApp, Scope, Receive, Send, Message
+
+LabelValues = tuple[str, ...]
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+
+def _format_labels(names: tuple[str, ...], values: LabelValues, extra: str = "") -> str:
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+def _escape(value: str) -> str:
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _format_value(value: float) -> str:
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class _Metric(ABC):
+    type: str
+
+    name: str
+    help: str
+    label_names: tuple[str, ...]
+
+    def __init__(self, name: str, help: str, labels: Iterable[str] = ()):
+        self.name = name
+        self.help = help
+        self.label_names = tuple(labels)
+
+    def render(self) -> list[str]:
+        return [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.type}", *self._render_samples()]
+
+    @abstractmethod
+    def _render_samples(self) -> list[str]:
+        ...
+
+
+class Counter(_Metric):
+    type = "counter"
+
+    _values: dict[LabelValues, float]
+
+    def __init__(self, name: str, help: str, labels: Iterable[str] = ()):
+        super().__init__(name, help, labels)
+        self._values = {}
+
+    def inc(self, *labels: str, value: float = 1):
+        self._values[labels] = self._values.get(labels, 0) + value
+
+    def get(self, *labels: str) -> float:
+        return self._values.get(labels, 0)
+
+    def _render_samples(self) -> list[str]:
+        return [f"{self.name}{_format_labels(self.label_names, labels)} {_format_value(value)}"
+                for labels, value in self._values.items()]
+
+
+class Gauge(_Metric):
+    """
+    Значение вычисляется функцией в момент запроса /metrics.
+    """
+    type = "gauge"
+
+    _func: Callable[[], dict[LabelValues, float]]
+
+    def __init__(self, name: str, help: str, func: Callable[[], dict[LabelValues, float]], labels: Iterable[str] = ()):
+        """
+        :param func: возвращает значения по наборам меток
+        """
+        super().__init__(name, help, labels)
+        self._func = func
+
+    def _render_samples(self) -> list[str]:
+        return [f"{self.name}{_format_labels(self.label_names, labels)} {_format_value(value)}"
+                for labels, value in self._func().items()]
+
+
+class Histogram(_Metric):
+    type = "histogram"
+
+    _buckets: tuple[float, ...]
+    _values: dict[LabelValues, list]    # метки -> [количество по корзинам (не накопленное)..., сумма, количество]
+
+    def __init__(self, name: str, help: str, labels: Iterable[str] = (), buckets: Iterable[float] = DEFAULT_BUCKETS):
+        super().__init__(name, help, labels)
+        self._buckets = tuple(sorted(buckets))
+        self._values = {}
+
+    def observe(self, value: float, *labels: str):
+        item = self._values.get(labels)
+        if item is None:
+            item = self._values[labels] = [0] * (len(self._buckets) + 1) + [0.0, 0]
+        item[bisect.bisect_left(self._buckets, value)] += 1
+        item[-2] += value
+        item[-1] += 1
+
+    def time(self, *labels: str) -> "_Timer":
+        """
+        Измеряет время выполнения блока with.
+        """
+        return _Timer(self, labels)
+
+    def _render_samples(self) -> list[str]:
+        lines = []
+        for labels, item in self._values.items():
+            cumulative = 0
+            for bound, count in zip(self._buckets + (float("inf"),), item):
+                cumulative += count
+                le = f'le="{_format_value(float(bound))}"'
+                lines.append(f"{self.name}_bucket{_format_labels(self.label_names, labels, le)} {cumulative}")
+            lines.append(f"{self.name}_sum{_format_labels(self.label_names, labels)} {_format_value(item[-2])}")
+            lines.append(f"{self.name}_count{_format_labels(self.label_names, labels)} {item[-1]}")
+        return lines
+
+
+class _Timer:
+    __slots__ = ("_histogram", "_labels", "_started")
+
+    def __init__(self, histogram: Histogram, labels: LabelValues):
+        self._histogram = histogram
+        self._labels = labels
+
+    def __enter__(self):
+        self._started = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self._histogram.observe(time.perf_counter() - self._started, *self._labels)
+
+
+class Registry:
+
+    _metrics: dict[str, _Metric]
+
+    def __init__(self):
+        self._metrics = {}
+
+    def register(self, metric: _Metric):
+        if metric.name in self._metrics:
+            raise ValueError(f"Metric '{metric.name}' is already registered.")
+        self._metrics[metric.name] = metric
+        return metric
+
+    def counter(self, name: str, help: str, labels: Iterable[str] = ()) -> Counter:
+        return self.register(Counter(name, help, labels))
+
+    def histogram(self, name: str, help: str, labels: Iterable[str] = (), buckets: Iterable[float] = DEFAULT_BUCKETS) -> Histogram:
+        return self.register(Histogram(name, help, labels, buckets))
+
+    def gauge(self, name: str, help: str, func: Callable[[], dict[LabelValues, float]], labels: Iterable[str] = ()) -> Gauge:
+        return self.register(Gauge(name, help, func, labels))
+
+    def render(self) -> str:
+        lines = []
+        for metric in self._metrics.values():
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+
+REGISTRY = Registry()
+
+HTTP_REQUEST_SECONDS = REGISTRY.histogram("payment_http_request_duration_seconds", "HTTP request latency by route.",
+                                          ("method", "route", "status"))
+DB_QUERY_SECONDS = REGISTRY.histogram("payment_db_method_duration_seconds", "DatabaseManager method latency.",
+                                      ("method",))
+DB_ERRORS = REGISTRY.counter("payment_db_method_errors_total", "DatabaseManager method calls that raised.", ("method",))
+PROVIDER_BILL_SECONDS = REGISTRY.histogram("payment_provider_bill_duration_seconds", "Bill creation latency by payment method.",
+                                           ("payment_method",))
+PROVIDER_BILL_ERRORS = REGISTRY.counter("payment_provider_bill_errors_total", "Failed bill creations by payment method.",
+                                        ("payment_method", "reason"))
+WEBHOOK_DELIVERY_SECONDS = REGISTRY.histogram("payment_webhook_delivery_duration_seconds", "Outgoing webhook request latency.")
+WEBHOOK_DELIVERIES = REGISTRY.counter("payment_webhook_deliveries_total", "Outgoing webhook delivery attempts by outcome.",
+                                      ("outcome",))
+INVOICE_TRANSITIONS = REGISTRY.counter("payment_invoice_transitions_total", "Invoice status transitions.",
+                                       ("to_status", "result"))
+
+
+def timed_async(histogram: Histogram, errors: Counter | None = None):
+    """
+    Декоратор асинхронных функций: время выполнения записывается в histogram с меткой - именем функции.
+    """
+    def decorator(func):
+        label = func.__name__
+
+        @functools.wraps(func)
+        async def wrapper(*args, **kwargs):
+            started = time.perf_counter()
+            try:
+                return await func(*args, **kwargs)
+            except Exception:
+                if errors is not None:
+                    errors.inc(label)
+                raise
+            finally:
+                histogram.observe(time.perf_counter() - started, label)
+        return wrapper
+    return decorator
+
+
+class MetricsMiddleware:
+    """
+    ASGI middleware, записывающее время обработки HTTP-запросов в HTTP_REQUEST_SECONDS.
+    Метка route - шаблон пути (/payment_service/{method_id}_webhook), а не сам путь, чтобы количество рядов было ограничено.
+    """
+
+    def __init__(self, app: ASGIApp):
+        self.app = app
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        status = "500"
+
+        async def send_wrapper(message: Message):
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = str(message["status"])
+            await send(message)
+
+        started = time.perf_counter()
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            HTTP_REQUEST_SECONDS.observe(time.perf_counter() - started, scope["method"], _get_route(scope), status)
+
+
+def _get_route(scope: Scope) -> str:
+    route = scope.get("route")
+    if route is not None:
+        return getattr(route, "path", "unknown")
+    endpoint = scope.get("endpoint")
+    if endpoint is not None:
+        return endpoint.__name__
+    return "unmatched"
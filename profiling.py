@@ -0,0 +1,205 @@
+"""
+Диагностика производительности: профилирование медленных запросов и обнаружение блокировок цикла событий.
+Оба инструмента выключены по умолчанию и включаются во время работы через /payment_service/admin/diagnostics.
+"""
+import asyncio
+import cProfile
+import datetime
+import logging
+import os
+import re
+import sys
+import threading
+import time
+import traceback
+from dataclasses import dataclass
+
+from starlette.types import ASGIApp, Scope, Receive, Send
+
+
+class RequestProfiler:
+    """
+    Настройки и состояние профилировщика запросов. Профили сохраняются в формате pstats (.prof),
+    их можно открыть через python -m pstats или snakeviz.
+    """
+
+    enabled: bool
+    threshold: float    # профили запросов быстрее этого времени, сек, не сохраняются
+    directory: str
+    max_files: int
+    saved: int
+    _active: bool    # cProfile профилирует весь поток, поэтому одновременно профилируется только один запрос
+    _logger: logging.Logger
+
+    def __init__(self, directory: str, threshold: float = 1, max_files: int = 100, enabled: bool = False):
+        """
+        :param directory: каталог для профилей
+        :param threshold: сохранять профили запросов дольше этого времени, сек
+        :param max_files: сколько последних профилей хранить
+        """
+        self.enabled = enabled
+        self.threshold = threshold
+        self.directory = directory
+        self.max_files = max_files
+        self.saved = 0
+        self._active = False
+        self._logger = logging.getLogger("payment_api_logger")
+
+    def try_start(self) -> cProfile.Profile | None:
+        if not self.enabled or self._active:
+            return None
+        self._active = True
+        profile = cProfile.Profile()
+        profile.enable()
+        return profile
+
+    async def finish_async(self, profile: cProfile.Profile, duration: float, name: str):
+        profile.disable()
+        self._active = False
+        if duration < self.threshold:
+            return
+        try:
+            path = await asyncio.to_thread(self._save, profile, duration, name)
+            self.saved += 1
+            self._logger.warning("[PROFILER] Slow request %s (%.0f ms), profile saved to %s", name, duration * 1000, path)
+        except Exception as ex:
+            self._logger.exception("[PROFILER] Failed to save profile", exc_info=ex)
+
+    def _save(self, profile: cProfile.Profile, duration: float, name: str) -> str:
+        os.makedirs(self.directory, exist_ok=True)
+        safe_name = re.sub(r"[^A-Za-z0-9_.-]+", "_", name).strip("_")[:80]
+        file_name = f"{datetime.datetime.now():%Y%m%d-%H%M%S-%f}_{round(duration * 1000)}ms_{safe_name}.prof"
+        path = os.path.join(self.directory, file_name)
+        profile.dump_stats(path)
+
+        profiles = sorted(f for f in os.listdir(self.directory) if f.endswith(".prof"))
+        for old in profiles[:max(0, len(profiles) - self.max_files)]:
+            os.remove(os.path.join(self.directory, old))
+        return path
+
+
+class ProfilerMiddleware:
+    """
+    ASGI middleware, профилирующее запросы, пока RequestProfiler включен.
+    """
+
+    def __init__(self, app: ASGIApp, profiler: RequestProfiler):
+        self.app = app
+        self._profiler = profiler
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send):
+        profile = self._profiler.try_start() if scope["type"] == "http" else None
+        if profile is None:
+            await self.app(scope, receive, send)
+            return
+
+        started = time.perf_counter()
+        try:
+            await self.app(scope, receive, send)
+        finally:
+            await self._profiler.finish_async(profile, time.perf_counter() - started, f"{scope['method']} {scope['path']}")
+
+
+@dataclass
+class LoopWatchdogStats:
+    enabled: bool
+    threshold_ms: float
+    blocks: int    # сколько раз цикл событий был заблокирован дольше threshold
+    max_lag_ms: float
+
+
+class LoopWatchdog:
+    """
+    Обнаруживает блокировки цикла событий. Задача в цикле событий регулярно отмечается, а отдельный поток проверяет,
+    как давно была последняя отметка. Если дольше threshold - в лог записывается стек, который сейчас выполняется
+    в потоке цикла событий, то есть код, который его блокирует.
+    """
+
+    _threshold: float
+    _interval: float
+    _logger: logging.Logger
+
+    _loop: asyncio.AbstractEventLoop | None
+    _loop_thread_id: int | None
+    _last_beat: float
+    _reported_beat: float    # для какой отметки уже записан стек, чтобы одна блокировка не попадала в лог много раз
+    _task: asyncio.Task | None
+    _thread: threading.Thread | None
+    _stop: threading.Event
+    _blocks: int
+    _max_lag: float
+
+    def __init__(self, threshold: float = 0.1, interval: float = 0.02):
+        """
+        :param threshold: блокировка дольше этого времени, сек, записывается в лог
+        :param interval: период отметок и проверок, сек
+        """
+        self._threshold = threshold
+        self._interval = interval
+        self._logger = logging.getLogger("payment_api_logger")
+        self._loop = None
+        self._loop_thread_id = None
+        self._last_beat = 0
+        self._reported_beat = 0
+        self._task = None
+        self._thread = None
+        self._stop = threading.Event()
+        self._blocks = 0
+        self._max_lag = 0
+
+    @property
+    def enabled(self) -> bool:
+        return self._task is not None
+
+    @property
+    def threshold(self) -> float:
+        return self._threshold
+
+    @threshold.setter
+    def threshold(self, value: float):
+        self._threshold = value
+
+    async def start_async(self):
+        if self._task is not None:
+            return
+        self._loop = asyncio.get_running_loop()
+        self._loop_thread_id = threading.get_ident()
+        self._last_beat = time.monotonic()
+        self._stop.clear()
+        self._task = asyncio.create_task(self._beat_async())
+        self._thread = threading.Thread(target=self._watch, name="loop-watchdog", daemon=True)
+        self._thread.start()
+
+    async def stop_async(self):
+        if self._task is None:
+            return
+        self._stop.set()
+        self._task.cancel()
+        await asyncio.gather(self._task, return_exceptions=True)
+        self._task = None
+        await asyncio.to_thread(self._thread.join)
+        self._thread = None
+
+    async def _beat_async(self):
+        while True:
+            now = time.monotonic()
+            lag = now - self._last_beat - self._interval    # на сколько отметка опоздала
+            if lag > self._max_lag:
+                self._max_lag = lag
+            self._last_beat = now
+            await asyncio.sleep(self._interval)
+
+    def _watch(self):
+        while not self._stop.wait(self._interval):
+            beat = self._last_beat
+            blocked = time.monotonic() - beat
+            if blocked < self._threshold + self._interval or beat == self._reported_beat:
+                continue
+            self._reported_beat = beat
+            self._blocks += 1
+            frame = sys._current_frames().get(self._loop_thread_id)
+            stack = "".join(traceback.format_stack(frame)) if frame is not None else "<unavailable>"
+            self._logger.warning("[WATCHDOG] Event loop blocked for %.0f ms so far:\n%s", blocked * 1000, stack)
+
+    def get_stats(self) -> LoopWatchdogStats:
+        return LoopWatchdogStats(self.enabled, self._threshold * 1000, self._blocks, self._max_lag * 1000)
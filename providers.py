@@ -0,0 +1,89 @@
+"""
+Реестр адаптеров платежных систем.
+Модуль адаптера импортируется, а сам адаптер создается только при первом обращении. Для создания счетов адаптер
+выдается, только если платежная система есть в таблице payment_methods, поэтому неиспользуемые SDK (AaioAsync, lava_api)
+не загружаются в процессы воркеров. Вебхуки принимаются и от отключенных платежных систем: по уже выставленным
+счетам еще могут прийти оплаты.
+"""
+import asyncio
+import importlib
+import logging
+
+from apis.base import ProviderAdapter, ProviderHealth
+from apis.sessions import ProviderSessions
+from db import DatabaseManager
+
+
+# method_id -> "модуль:класс"
+ADAPTERS = {
+    "aaio": "apis.aaio:AaioAdapter",
+    "lava": "apis.lava:LavaAdapter",
+    "enot": "apis.enot:EnotAdapter",
+    "nicepay": "apis.nicepay:NicepayAdapter",
+    "pally": "apis.pally:PallyAdapter",
+}
+
+
+class ProviderRegistry:
+
+    _db_manager: DatabaseManager
+    _sessions: ProviderSessions
+    _paths: dict[str, str]
+    _adapters: dict[str, ProviderAdapter]
+    _lock: asyncio.Lock
+    _logger: logging.Logger
+
+    def __init__(self, db_manager: DatabaseManager, sessions: ProviderSessions, paths: dict[str, str] | None = None):
+        """
+        :param paths: соответствие method_id и класса адаптера ("модуль:класс"); по умолчанию ADAPTERS
+        """
+        self._db_manager = db_manager
+        self._sessions = sessions
+        self._paths = dict(ADAPTERS if paths is None else paths)
+        self._adapters = {}
+        self._lock = asyncio.Lock()
+        self._logger = logging.getLogger("payment_api_logger")
+
+    async def get_async(self, method_id: str, require_enabled: bool = True) -> ProviderAdapter | None:
+        """
+        Возвращает адаптер платежной системы.
+        None, если для нее нет адаптера (счета такой системы делегируются) или ее нет в БД.
+        :param require_enabled: False - вернуть адаптер, даже если платежной системы нет в БД (для приема вебхуков)
+        """
+        path = self._paths.get(method_id)
+        if path is None:
+            return None
+        if require_enabled and await self._db_manager.get_payment_method_async(method_id) is None:
+            return None
+
+        adapter = self._adapters.get(method_id)
+        if adapter is not None:
+            return adapter
+
+        async with self._lock:
+            adapter = self._adapters.get(method_id)
+            if adapter is None:
+                adapter = self._load(path)
+                self._adapters[method_id] = adapter
+                self._logger.info("[PROVIDERS] Loaded adapter '%s' (%s)", method_id, path)
+        return adapter
+
+    def _load(self, path: str) -> ProviderAdapter:
+        module_name, class_name = path.split(":")
+        adapter_class = getattr(importlib.import_module(module_name), class_name)
+        return adapter_class(self._sessions)
+
+    def get_loaded(self) -> list[str]:
+        return list(self._adapters.keys())
+
+    async def get_health_async(self) -> dict[str, ProviderHealth]:
+        """
+        Состояние загруженных адаптеров.
+        """
+        health = {}
+        for method_id, adapter in list(self._adapters.items()):
+            try:
+                health[method_id] = await adapter.health()
+            except Exception as ex:
+                health[method_id] = ProviderHealth(False, repr(ex))
+        return health
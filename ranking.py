@@ -0,0 +1,88 @@
+"""
+Статистика создания счетов по платежным системам и порядок способов оплаты на странице выбора.
+Старые измерения экспоненциально теряют вес, поэтому оценка отражает текущее состояние платежной системы.
+"""
+import time
+from dataclasses import dataclass
+from typing import Iterable, TypeVar
+
+T = TypeVar("T")
+
+
+@dataclass
+class MethodStats:
+    method_id: str
+    samples: float    # взвешенное количество измерений
+    success_rate: float
+    avg_latency_ms: float
+    score: float    # от 0 до 1, чем больше, тем выше способ оплаты в списке
+
+
+class _DecayedCounters:
+    __slots__ = ("updated", "count", "successes", "latency")
+
+    def __init__(self, now: float):
+        self.updated = now
+        self.count = 0.0
+        self.successes = 0.0
+        self.latency = 0.0    # сумма времени создания счета, сек
+
+    def decayed(self, now: float, half_life: float) -> tuple[float, float, float]:
+        factor = 0.5 ** ((now - self.updated) / half_life)
+        return self.count * factor, self.successes * factor, self.latency * factor
+
+
+class MethodRanking:
+    """
+    Оценка платежной системы - доля успешных счетов, умноженная на latency_reference / (latency_reference + среднее время).
+    К измерениям добавляется prior_weight условных измерений "успех за latency_reference", поэтому система без
+    измерений (в том числе делегированная) получает оценку 0.5, а единичный сбой не роняет ее в конец списка.
+    """
+
+    _half_life: float
+    _latency_reference: float
+    _prior_weight: float
+    _counters: dict[str, _DecayedCounters]
+
+    def __init__(self, half_life: float = 300, latency_reference: float = 2, prior_weight: float = 1):
+        """
+        :param half_life: через сколько секунд вес измерения уменьшается вдвое
+        :param latency_reference: время создания счета, сек, при котором успешная платежная система получает оценку 0.5
+        :param prior_weight: вес начального предположения, в измерениях
+        """
+        self._half_life = half_life
+        self._latency_reference = latency_reference
+        self._prior_weight = prior_weight
+        self._counters = {}
+
+    def record(self, method_id: str, success: bool, latency: float):
+        now = time.monotonic()
+        counters = self._counters.get(method_id)
+        if counters is None:
+            counters = self._counters[method_id] = _DecayedCounters(now)
+        counters.count, counters.successes, counters.latency = counters.decayed(now, self._half_life)
+        counters.updated = now
+        counters.count += 1
+        counters.successes += success
+        counters.latency += latency
+
+    def get_stats(self, method_id: str, now: float | None = None) -> MethodStats:
+        counters = self._counters.get(method_id)
+        count, successes, latency = (0, 0, 0) if counters is None else counters.decayed(now or time.monotonic(), self._half_life)
+
+        success_rate = (successes + self._prior_weight) / (count + self._prior_weight)
+        avg_latency = (latency + self._prior_weight * self._latency_reference) / (count + self._prior_weight)
+        score = success_rate * self._latency_reference / (self._latency_reference + avg_latency)
+        return MethodStats(method_id, count, success_rate, avg_latency * 1000, score)
+
+    def get_all_stats(self) -> list[MethodStats]:
+        now = time.monotonic()
+        return [self.get_stats(method_id, now) for method_id in self._counters]
+
+    def rank(self, items: Iterable[T], key: str = "method_id") -> list[T]:
+        """
+        Сортирует объекты с атрибутом key (айди платежной системы) по убыванию оценки.
+        При равной оценке сохраняется исходный порядок.
+        """
+        now = time.monotonic()
+        return sorted(items, key=lambda item: -self.get_stats(getattr(item, key), now).score)
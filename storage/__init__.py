@@ -0,0 +1,27 @@
+"""
+Хранилища данных сервиса. Движок выбирается параметром STORAGE_ENGINE в config:
+"mysql" - основной вариант для продакшена, "sqlite" - файл на диске без отдельного сервера БД,
+"memory" - данные в памяти процесса (тесты и нагрузочные замеры).
+Модуль движка импортируется только при выборе, поэтому драйверы остальных движков устанавливать не обязательно.
+"""
+import importlib
+
+from storage.base import StorageEngine, INVOICE_COLUMNS, ColumnRef, PaymentMethod, OutboxEntry, OutboxBacklog, InboxEntry, \
+    PoolStats, DuplicateInvoiceError, DatabaseNotConnectedError, WriteOp, InsertInvoice, UpdateInvoice, TransitionInvoice
+
+ENGINES = {
+    "mysql": "storage.mysql:MySQLEngine",
+    "sqlite": "storage.sqlite:SQLiteEngine",
+    "memory": "storage.memory:MemoryEngine",
+}
+
+
+def create_engine(name: str, **options) -> StorageEngine:
+    """
+    :param options: параметры конструктора выбранного движка
+    :raises ValueError: неизвестный движок
+    """
+    if name not in ENGINES:
+        raise ValueError(f"Unknown storage engine '{name}'. Available: {', '.join(ENGINES)}")
+    module_name, class_name = ENGINES[name].split(":")
+    return getattr(importlib.import_module(module_name), class_name)(**options)
@@ -0,0 +1,294 @@
+"""
+Интерфейс хранилища счетов, платежных систем и очередей вебхуков.
+Хранилище работает со строками таблицы invoices (кортежи в порядке INVOICE_COLUMNS, статус - строкой);
+кеширование, метрики и преобразование в InvoiceInfo выполняет db.DatabaseManager.
+"""
+import datetime
+from abc import ABC, abstractmethod
+from dataclasses import dataclass
+from typing import Any, AsyncContextManager
+
+INVOICE_COLUMNS = ("invoice_id", "status", "amount", "credited", "created", "payed", "comment", "custom_fields",
+                   "webhook_url", "payment_method", "payment_url", "payment_method_invoice_id", "idempotency_key")
+
+
+@dataclass(frozen=True)
+class ColumnRef:
+    """
+    Значение, которое берется из другого столбца той же строки при обновлении счета (например, credited = amount).
+    """
+    column: str
+
+
+@dataclass
+class PaymentMethod:
+    method_id: str
+    name: str
+    description: str
+    icon_url: str
+    instructions: str | None
+    delegate_url: str = ""
+
+
+@dataclass
+class OutboxEntry:
+    """
+    Вебхук на сервер игры, ожидающий доставки.
+    """
+    id: int
+    invoice_id: str
+    url: str
+    payload: dict
+    attempts: int    # количество попыток доставки, включая текущую
+
+
+@dataclass
+class InboxEntry:
+    """
+    Событие от платежной системы, принятое, но еще не примененное к счету.
+    """
+    id: int
+    method_id: str
+    invoice_id: str
+    payload: dict
+    attempts: int    # количество попыток применения, включая текущую
+
+
+@dataclass
+class OutboxBacklog:
+    pending: int    # недоставленные вебхуки
+    due: int    # из них те, время попытки которых уже наступило
+    oldest_created: datetime.datetime | None    # время создания самого старого недоставленного вебхука
+
+
+@dataclass
+class PoolStats:
+    """
+    Состояние пула соединений с БД.
+    """
+    size: int    # всего открытых соединений
+    in_use: int    # соединения, выданные запросам
+    free: int    # простаивающие соединения
+    waiters: int    # запросы, ожидающие свободного соединения
+    min_size: int
+    max_size: int
+
+
+@dataclass
+class InsertInvoice:
+    row: tuple
+
+
+@dataclass
+class UpdateInvoice:
+    invoice_id: str
+    changes: dict[str, Any]
+
+
+@dataclass
+class TransitionInvoice:
+    invoice_id: str
+    from_statuses: list[str]
+    to_status: str
+    changes: dict[str, Any]
+    require_no_payment_method: bool = False
+    enqueue_webhook: bool = False
+
+
+WriteOp = InsertInvoice | UpdateInvoice | TransitionInvoice
+
+
+def group_writes(ops: list[WriteOp]) -> list[list[int]]:
+    """
+    Делит операции на идущие подряд группы, которые можно выполнить одним executemany:
+    вставки и обновления одних и тех же столбцов. Каждый переход выполняется отдельно - его результат зависит от rowcount.
+    Порядок операций сохраняется.
+    """
+    groups: list[list[int]] = []
+    last_key = None
+    for i, op in enumerate(ops):
+        match op:
+            case InsertInvoice():
+                key = "insert"
+            case UpdateInvoice():
+                key = ("update", tuple(op.changes))
+            case _:
+                key = None
+        if key is not None and key == last_key:
+            groups[-1].append(i)
+        else:
+            groups.append([i])
+        last_key = key
+    return groups
+
+
+class DuplicateInvoiceError(Exception):
+    def __init__(self, invoice_id: str, *args):
+        super().__init__(f"Invoice '{invoice_id}' conflicts with an existing one.", *args)
+
+
+class DatabaseNotConnectedError(Exception):
+    def __init__(self, *args):
+        super().__init__("Database is not connected. Call 'connect_async' first.", *args)
+
+
+class StorageEngine(ABC):
+    """
+    Все реализации должны проходить tests/test_storage_conformance.py.
+    """
+
+    @abstractmethod
+    async def connect_async(self):
+        ...
+
+    @abstractmethod
+    async def close_async(self):
+        ...
+
+    @abstractmethod
+    async def create_tables_async(self):
+        """
+        Создает недостающие таблицы и индексы.
+        """
+
+    @abstractmethod
+    def get_pool_stats(self) -> PoolStats:
+        ...
+
+    @abstractmethod
+    async def get_invoice_row_async(self, invoice_id: str) -> tuple | None:
+        ...
+
+    @abstractmethod
+    async def get_invoice_row_by_idempotency_key_async(self, idempotency_key: str) -> tuple | None:
+        ...
+
+    @abstractmethod
+    async def get_invoice_row_by_provider_id_async(self, method_id: str, provider_invoice_id: str) -> tuple | None:
+        ...
+
+    @abstractmethod
+    async def get_invoice_rows_by_status_async(self, status: str, older_than: datetime.datetime,
+                                               after: tuple[datetime.datetime, str], limit: int) -> list[tuple]:
+        """
+        Счета в статусе status, созданные раньше older_than, в порядке (created, invoice_id), начиная после after.
+        """
+
+    @abstractmethod
+    async def insert_invoice_async(self, row: tuple):
+        """
+        :raises DuplicateInvoiceError: счет с таким invoice_id или idempotency_key уже есть
+        """
+
+    @abstractmethod
+    async def insert_invoices_async(self, rows: list[tuple]):
+        """
+        Добавляет несколько счетов одним запросом. Если хотя бы один счет конфликтует с существующим, не добавляется ни один.
+        :raises DuplicateInvoiceError: счет с таким invoice_id или idempotency_key уже есть
+        """
+
+    @abstractmethod
+    async def update_invoice_async(self, invoice_id: str, changes: dict[str, Any]):
+        ...
+
+    @abstractmethod
+    async def transition_invoice_async(self, invoice_id: str, from_statuses: list[str], to_status: str,
+                                       changes: dict[str, Any], require_no_payment_method: bool,
+                                       enqueue_webhook: bool) -> bool:
+        """
+        Атомарно меняет статус счета, если он в одном из from_statuses (см. DatabaseManager.transition_invoice_async).
+        Значения changes уже проверены и приведены к типам БД; значение может быть ColumnRef.
+        При enqueue_webhook в той же транзакции добавляет вебхук в очередь, если у счета задан webhook_url.
+        """
+
+    async def execute_writes_async(self, ops: list[WriteOp]) -> list[Any]:
+        """
+        Выполняет пачку записей, по возможности одной транзакцией. Используется storage.coalescer.WriteCoalescer.
+        Возвращает результаты в порядке ops: True/False для переходов, None для остальных операций
+        или DuplicateInvoiceError, если операция нарушила уникальность (остальные операции пачки при этом выполняются).
+        Другие ошибки прерывают всю пачку.
+        """
+        results = []
+        for op in ops:
+            try:
+                results.append(await self.execute_write_async(op))
+            except DuplicateInvoiceError as ex:
+                results.append(ex)
+        return results
+
+    async def execute_write_async(self, op: WriteOp) -> Any:
+        match op:
+            case InsertInvoice():
+                await self.insert_invoice_async(op.row)
+            case UpdateInvoice():
+                await self.update_invoice_async(op.invoice_id, op.changes)
+            case TransitionInvoice():
+                return await self.transition_invoice_async(op.invoice_id, op.from_statuses, op.to_status, op.changes,
+                                                           op.require_no_payment_method, op.enqueue_webhook)
+
+    @abstractmethod
+    async def expire_invoices_async(self, from_status: str, to_status: str, created_before: datetime.datetime, limit: int,
+                                    payment_method: str | None, exclude_methods: list[str]) -> list[str]:
+        """
+        Переводит в to_status не более limit самых старых счетов и возвращает их айди.
+        Счета без платежной системы не исключаются exclude_methods.
+        """
+
+    @abstractmethod
+    def named_lock_async(self, name: str) -> AsyncContextManager[bool]:
+        """
+        Блокировка, общая для всех процессов, работающих с хранилищем. Не ждет; возвращает, получена ли она.
+        """
+
+    @abstractmethod
+    async def claim_outbox_async(self, limit: int, lease_seconds: int) -> list[OutboxEntry]:
+        ...
+
+    @abstractmethod
+    async def mark_outbox_delivered_async(self, entry_id: int):
+        ...
+
+    @abstractmethod
+    async def reschedule_outbox_async(self, entry_id: int, delay_seconds: int, error: str, give_up: bool):
+        ...
+
+    @abstractmethod
+    async def release_outbox_async(self, entry_id: int):
+        ...
+
+    @abstractmethod
+    async def get_outbox_backlog_async(self) -> OutboxBacklog:
+        ...
+
+    @abstractmethod
+    async def add_inbox_async(self, method_id: str, invoice_id: str, payload: dict, lease_seconds: int) -> int:
+        """
+        Записывает событие и возвращает его id. Если lease_seconds > 0, событие сразу считается забранным
+        на это время (первая попытка уже идет), иначе его заберет ближайший claim_inbox_async.
+        """
+
+    @abstractmethod
+    async def claim_inbox_async(self, limit: int, lease_seconds: int) -> list[InboxEntry]:
+        ...
+
+    @abstractmethod
+    async def mark_inbox_processed_async(self, entry_id: int):
+        ...
+
+    @abstractmethod
+    async def reschedule_inbox_async(self, entry_id: int, delay_seconds: int, error: str, give_up: bool):
+        ...
+
+    @abstractmethod
+    async def release_inbox_async(self, entry_id: int):
+        ...
+
+    @abstractmethod
+    async def get_payment_methods_async(self) -> list[PaymentMethod]:
+        ...
+
+    @abstractmethod
+    async def save_payment_method_async(self, method: PaymentMethod):
+        """
+        Добавляет платежную систему или заменяет существующую с тем же method_id.
+        """
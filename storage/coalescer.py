@@ -0,0 +1,105 @@
+"""
+Групповая запись: операции, пришедшие почти одновременно, выполняются одной транзакцией с одним COMMIT.
+При сотнях одновременных вебхуков это заменяет сотни синхронизаций журнала БД с диском одной.
+"""
+import asyncio
+from dataclasses import dataclass
+from typing import Any
+
+from storage.base import StorageEngine, WriteOp
+
+
+@dataclass
+class WriteCoalescerStats:
+    batches: int    # выполненные пачки
+    writes: int    # операции в них
+    largest_batch: int
+    pending: int    # операции, ожидающие отправки
+    max_batch_size: int
+    max_wait: float
+
+
+class WriteCoalescer:
+    _engine: StorageEngine
+    _max_batch_size: int
+    _max_wait: float
+    _pending: list[tuple[WriteOp, asyncio.Future]]
+    _timer: asyncio.TimerHandle | None
+    _flushes: set[asyncio.Task]
+    _batches: int
+    _writes: int
+    _largest_batch: int
+
+    def __init__(self, engine: StorageEngine, max_batch_size: int = 100, max_wait: float = 0.002):
+        """
+        :param max_batch_size: пачка отправляется сразу, как только в ней набирается столько операций
+        :param max_wait: сколько ждать других операций после первой операции пачки, сек
+        """
+        self._engine = engine
+        self._max_batch_size = max_batch_size
+        self._max_wait = max_wait
+        self._pending = []
+        self._timer = None
+        self._flushes = set()
+        self._batches = 0
+        self._writes = 0
+        self._largest_batch = 0
+
+    async def submit_async(self, op: WriteOp) -> Any:
+        """
+        Добавляет операцию в текущую пачку и ждет, пока пачка будет зафиксирована.
+        Возвращает результат операции (см. StorageEngine.execute_writes_async).
+        :raises DuplicateInvoiceError: операция нарушила уникальность
+        """
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        self._pending.append((op, future))
+        if len(self._pending) >= self._max_batch_size:
+            self._flush()
+        elif self._timer is None:
+            self._timer = loop.call_later(self._max_wait, self._flush)
+        return await future
+
+    def _flush(self):
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        if not self._pending:
+            return
+        batch, self._pending = self._pending, []
+        task = asyncio.create_task(self._write_batch_async(batch))
+        self._flushes.add(task)
+        task.add_done_callback(self._flushes.discard)
+
+    async def _write_batch_async(self, batch: list[tuple[WriteOp, asyncio.Future]]):
+        try:
+            results = await self._engine.execute_writes_async([op for op, _ in batch])
+        except Exception as ex:
+            results = [ex] * len(batch)
+        except BaseException:
+            for _, future in batch:
+                future.cancel()
+            raise
+
+        self._batches += 1
+        self._writes += len(batch)
+        self._largest_batch = max(self._largest_batch, len(batch))
+        for (_, future), result in zip(batch, results):
+            if future.done():    # вызывающий перестал ждать, но операция уже выполнена
+                continue
+            if isinstance(result, Exception):
+                future.set_exception(result)
+            else:
+                future.set_result(result)
+
+    async def flush_async(self):
+        """
+        Отправляет накопленные операции и дожидается фиксации всех пачек. Вызывается перед закрытием хранилища.
+        """
+        self._flush()
+        if self._flushes:
+            await asyncio.gather(*self._flushes, return_exceptions=True)
+
+    def get_stats(self) -> WriteCoalescerStats:
+        return WriteCoalescerStats(self._batches, self._writes, self._largest_batch, len(self._pending),
+                                   self._max_batch_size, self._max_wait)
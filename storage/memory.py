@@ -0,0 +1,233 @@
+"""
+Хранилище в памяти процесса. Данные теряются при перезапуске; подходит для тестов и замеров пропускной способности
+приложения без влияния БД. Методы не уступают управление циклу событий, поэтому каждый из них атомарен.
+"""
+import contextlib
+import datetime
+import itertools
+from dataclasses import replace
+from typing import Any
+
+from storage.base import StorageEngine, INVOICE_COLUMNS, ColumnRef, PaymentMethod, OutboxEntry, OutboxBacklog, InboxEntry, \
+    PoolStats, DuplicateInvoiceError
+
+_CREATED = INVOICE_COLUMNS.index("created")
+
+
+class MemoryEngine(StorageEngine):
+    _invoices: dict[str, dict[str, Any]]
+    _idempotency_keys: dict[str, str]    # idempotency_key -> invoice_id
+    _outbox: dict[int, dict[str, Any]]
+    _outbox_ids: itertools.count
+    _inbox: dict[int, dict[str, Any]]
+    _inbox_ids: itertools.count
+    _payment_methods: dict[str, PaymentMethod]
+    _locks: set[str]
+
+    def __init__(self):
+        self._invoices = {}
+        self._idempotency_keys = {}
+        self._outbox = {}
+        self._outbox_ids = itertools.count(1)
+        self._inbox = {}
+        self._inbox_ids = itertools.count(1)
+        self._payment_methods = {}
+        self._locks = set()
+
+    async def connect_async(self):
+        pass
+
+    async def close_async(self):
+        pass
+
+    async def create_tables_async(self):
+        pass
+
+    def get_pool_stats(self) -> PoolStats:
+        return PoolStats(0, 0, 0, 0, 0, 0)
+
+    @staticmethod
+    def _to_row(values: dict[str, Any]) -> tuple:
+        return tuple(values[column] for column in INVOICE_COLUMNS)
+
+    def _get_row(self, invoice_id: str | None) -> tuple | None:
+        values = self._invoices.get(invoice_id)
+        return self._to_row(values) if values is not None else None
+
+    async def get_invoice_row_async(self, invoice_id: str) -> tuple | None:
+        return self._get_row(invoice_id)
+
+    async def get_invoice_row_by_idempotency_key_async(self, idempotency_key: str) -> tuple | None:
+        return self._get_row(self._idempotency_keys.get(idempotency_key))
+
+    async def get_invoice_row_by_provider_id_async(self, method_id: str, provider_invoice_id: str) -> tuple | None:
+        for values in self._invoices.values():
+            if values["payment_method"] == method_id and values["payment_method_invoice_id"] == provider_invoice_id:
+                return self._to_row(values)
+        return None
+
+    async def get_invoice_rows_by_status_async(self, status, older_than, after, limit) -> list[tuple]:
+        rows = [self._to_row(values) for values in self._invoices.values()
+                if values["status"] == status and values["created"] < older_than and (values["created"], values["invoice_id"]) > after]
+        rows.sort(key=lambda row: (row[_CREATED], row[0]))
+        return rows[:limit]
+
+    async def insert_invoice_async(self, row: tuple):
+        values = dict(zip(INVOICE_COLUMNS, row))
+        key = values["idempotency_key"]
+        if values["invoice_id"] in self._invoices or (key is not None and key in self._idempotency_keys):
+            raise DuplicateInvoiceError(values["invoice_id"])
+        self._invoices[values["invoice_id"]] = values
+        if key is not None:
+            self._idempotency_keys[key] = values["invoice_id"]
+
+    async def insert_invoices_async(self, rows: list[tuple]):
+        invoice_ids = [row[0] for row in rows]
+        keys = [key for key in (row[INVOICE_COLUMNS.index("idempotency_key")] for row in rows) if key is not None]
+        if len(set(invoice_ids)) < len(invoice_ids) or len(set(keys)) < len(keys) \
+                or any(invoice_id in self._invoices for invoice_id in invoice_ids) or any(key in self._idempotency_keys for key in keys):
+            raise DuplicateInvoiceError(invoice_ids[0])
+        for row in rows:
+            await self.insert_invoice_async(row)
+
+    async def update_invoice_async(self, invoice_id: str, changes: dict[str, Any]):
+        values = self._invoices.get(invoice_id)
+        if values is None:
+            return
+        self._update(values, changes)
+
+    def _update(self, values: dict[str, Any], changes: dict[str, Any]):
+        new_values = values | {column: values[value.column] if isinstance(value, ColumnRef) else value
+                               for column, value in changes.items()}
+        old_key, new_key = values["idempotency_key"], new_values["idempotency_key"]
+        if new_key != old_key:
+            if new_key is not None and new_key in self._idempotency_keys:
+                raise DuplicateInvoiceError(values["invoice_id"])
+            self._idempotency_keys.pop(old_key, None)
+            if new_key is not None:
+                self._idempotency_keys[new_key] = values["invoice_id"]
+        values.update(new_values)
+
+    async def transition_invoice_async(self, invoice_id, from_statuses, to_status, changes,
+                                       require_no_payment_method, enqueue_webhook) -> bool:
+        values = self._invoices.get(invoice_id)
+        if values is None or values["status"] not in from_statuses:
+            return False
+        if require_no_payment_method and values["payment_method"] is not None:
+            return False
+
+        self._update(values, {"status": to_status} | changes)
+        if enqueue_webhook and values["webhook_url"]:
+            now = datetime.datetime.now()
+            entry_id = next(self._outbox_ids)
+            self._outbox[entry_id] = {
+                "id": entry_id,
+                "invoice_id": invoice_id,
+                "url": values["webhook_url"],
+                "payload": {"invoice_id": invoice_id, "sum": values["amount"], "comment": values["comment"],
+                            "custom_field": values["custom_fields"]},
+                "status": "pending",
+                "attempts": 0,
+                "next_attempt": now,
+                "created": now,
+                "last_error": None,
+            }
+        return True
+
+    async def expire_invoices_async(self, from_status, to_status, created_before, limit,
+                                    payment_method, exclude_methods) -> list[str]:
+        candidates = [values for values in self._invoices.values()
+                      if values["status"] == from_status and values["created"] < created_before
+                      and (payment_method is None or values["payment_method"] == payment_method)
+                      and (values["payment_method"] is None or values["payment_method"] not in exclude_methods)]
+        candidates.sort(key=lambda values: values["created"])
+        for values in candidates[:limit]:
+            values["status"] = to_status
+        return [values["invoice_id"] for values in candidates[:limit]]
+
+    @contextlib.asynccontextmanager
+    async def named_lock_async(self, name: str):
+        if name in self._locks:
+            yield False
+            return
+        self._locks.add(name)
+        try:
+            yield True
+        finally:
+            self._locks.discard(name)
+
+    async def claim_outbox_async(self, limit: int, lease_seconds: int) -> list[OutboxEntry]:
+        now = datetime.datetime.now()
+        due = sorted((entry for entry in self._outbox.values() if entry["status"] == "pending" and entry["next_attempt"] <= now),
+                     key=lambda entry: entry["next_attempt"])[:limit]
+        for entry in due:
+            entry["attempts"] += 1
+            entry["next_attempt"] = now + datetime.timedelta(seconds=lease_seconds)
+        return [OutboxEntry(entry["id"], entry["invoice_id"], entry["url"], dict(entry["payload"]), entry["attempts"])
+                for entry in due]
+
+    async def mark_outbox_delivered_async(self, entry_id: int):
+        entry = self._outbox.get(entry_id)
+        if entry is not None:
+            entry.update(status="delivered", last_error=None)
+
+    async def reschedule_outbox_async(self, entry_id: int, delay_seconds: int, error: str, give_up: bool):
+        entry = self._outbox.get(entry_id)
+        if entry is not None:
+            entry.update(status="failed" if give_up else "pending",
+                         next_attempt=datetime.datetime.now() + datetime.timedelta(seconds=delay_seconds),
+                         last_error=error[:256])
+
+    async def release_outbox_async(self, entry_id: int):
+        entry = self._outbox.get(entry_id)
+        if entry is not None and entry["status"] == "pending":
+            entry.update(attempts=entry["attempts"] - 1, next_attempt=datetime.datetime.now())
+
+    async def get_outbox_backlog_async(self) -> OutboxBacklog:
+        now = datetime.datetime.now()
+        pending = [entry for entry in self._outbox.values() if entry["status"] == "pending"]
+        return OutboxBacklog(len(pending), sum(entry["next_attempt"] <= now for entry in pending),
+                             min((entry["created"] for entry in pending), default=None))
+
+    async def add_inbox_async(self, method_id: str, invoice_id: str, payload: dict, lease_seconds: int) -> int:
+        now = datetime.datetime.now()
+        entry_id = next(self._inbox_ids)
+        self._inbox[entry_id] = {
+            "id": entry_id, "method_id": method_id, "invoice_id": invoice_id, "payload": dict(payload), "status": "pending",
+            "attempts": 1 if lease_seconds > 0 else 0, "next_attempt": now + datetime.timedelta(seconds=lease_seconds),
+            "created": now, "last_error": None,
+        }
+        return entry_id
+
+    async def claim_inbox_async(self, limit: int, lease_seconds: int) -> list[InboxEntry]:
+        now = datetime.datetime.now()
+        due = sorted((entry for entry in self._inbox.values() if entry["status"] == "pending" and entry["next_attempt"] <= now),
+                     key=lambda entry: entry["next_attempt"])[:limit]
+        for entry in due:
+            entry["attempts"] += 1
+            entry["next_attempt"] = now + datetime.timedelta(seconds=lease_seconds)
+        return [InboxEntry(entry["id"], entry["method_id"], entry["invoice_id"], dict(entry["payload"]), entry["attempts"])
+                for entry in due]
+
+    async def mark_inbox_processed_async(self, entry_id: int):
+        entry = self._inbox.get(entry_id)
+        if entry is not None:
+            entry.update(status="processed", last_error=None)
+
+    async def reschedule_inbox_async(self, entry_id: int, delay_seconds: int, error: str, give_up: bool):
+        entry = self._inbox.get(entry_id)
+        if entry is not None:
+            entry.update(status="failed" if give_up else "pending",
+                         next_attempt=datetime.datetime.now() + datetime.timedelta(seconds=delay_seconds),
+                         last_error=error[:256])
+
+    async def release_inbox_async(self, entry_id: int):
+        entry = self._inbox.get(entry_id)
+        if entry is not None and entry["status"] == "pending":
+            entry.update(attempts=entry["attempts"] - 1, next_attempt=datetime.datetime.now())
+
+    async def get_payment_methods_async(self) -> list[PaymentMethod]:
+        return [replace(method) for method in self._payment_methods.values()]
+
+    async def save_payment_method_async(self, method: PaymentMethod):
+        self._payment_methods[method.method_id] = replace(method)
@@ -0,0 +1,450 @@
+"""
+Хранилище в MySQL (aiomysql).
+"""
+import asyncio
+import contextlib
+import json
+from typing import Any
+
+import aiomysql
+from aiomysql import Pool
+from pymysql.constants import CLIENT, ER
+from pymysql.err import IntegrityError
+
+from storage.base import StorageEngine, INVOICE_COLUMNS, ColumnRef, PaymentMethod, OutboxEntry, OutboxBacklog, InboxEntry, PoolStats, \
+    DuplicateInvoiceError, DatabaseNotConnectedError, WriteOp, InsertInvoice, TransitionInvoice, group_writes
+from tracing import span
+
+
+class MySQLEngine(StorageEngine):
+    _host: str
+    _user: str
+    _password: str
+    _db_name: str
+    _pool: Pool | None
+    _min_size: int
+    _max_size: int
+    _pool_recycle: int
+    _connect_timeout: float
+    _acquire_timeout: float | None
+    _waiters: int
+
+    _GET_INVOICES_QUERY = "SELECT * FROM invoices WHERE invoice_id = %s;"
+    _GET_INVOICE_BY_IDEMPOTENCY_KEY_QUERY = "SELECT * FROM invoices WHERE idempotency_key = %s;"
+    _GET_INVOICE_BY_PROVIDER_ID_QUERY = "SELECT * FROM invoices WHERE payment_method = %s AND payment_method_invoice_id = %s LIMIT 1;"
+    # постраничный обход по (created, invoice_id) вместо OFFSET: каждая страница - поиск по индексу idx_invoices_status_created
+    _GET_INVOICES_BY_STATUS_QUERY = "SELECT * FROM invoices WHERE status = %s AND created < %s " \
+                                    "AND (created > %s OR (created = %s AND invoice_id > %s)) ORDER BY created, invoice_id LIMIT %s;"
+    _INSERT_INVOICE_QUERY = f"INSERT INTO invoices ({', '.join(INVOICE_COLUMNS)}) VALUES ({', '.join(['%s'] * len(INVOICE_COLUMNS))});"
+    _UPDATE_INVOICE_QUERY = "UPDATE invoices SET {} WHERE invoice_id = %s;"
+    _GET_PAYMENT_METHODS_QUERY = "SELECT * FROM payment_methods;"
+    _SAVE_PAYMENT_METHOD_QUERY = "REPLACE INTO payment_methods (method_id, name, description, icon_url, instructions) VALUES (%s, %s, %s, %s, %s);"
+
+    # ORDER BY created LIMIT - пачка берется из начала диапазона индекса idx_invoices_status_created
+    _EXPIRE_INVOICES_QUERY = "SELECT invoice_id FROM invoices WHERE status = %s AND created < %s{} ORDER BY created LIMIT %s FOR UPDATE SKIP LOCKED;"
+    _SET_INVOICES_STATUS_QUERY = "UPDATE invoices SET status = %s WHERE invoice_id IN ({});"
+
+    _INVOICE_INDEXES = {
+        "idx_invoices_provider": ("KEY", "(payment_method, payment_method_invoice_id)"),    # сопоставление вебхуков платежных систем
+        "idx_invoices_status_created": ("KEY", "(status, created)"),    # поиск зависших счетов по статусу и возрасту
+        "idx_invoices_created": ("KEY", "(created)"),    # выборки за период
+        "uq_invoices_idempotency_key": ("UNIQUE KEY", "(idempotency_key)"),    # повторные запросы на создание счета
+    }
+
+    _TRANSITION_INVOICE_QUERY = "UPDATE invoices SET {} WHERE invoice_id = %s AND status IN ({}){};"
+    # тело вебхука собирается из строки счета, поэтому переход в SUCCESS не требует предварительного чтения счета
+    _ENQUEUE_WEBHOOK_QUERY = "INSERT INTO webhook_outbox (invoice_id, url, payload, next_attempt, created) " \
+                             "SELECT invoice_id, webhook_url, JSON_OBJECT('invoice_id', invoice_id, 'sum', amount, 'comment', comment, 'custom_field', custom_fields), NOW(), NOW() " \
+                             "FROM invoices WHERE invoice_id = %s AND webhook_url <> '';"
+    # SKIP LOCKED позволяет нескольким воркерам забирать разные пачки одновременно, не дожидаясь друг друга
+    _CLAIM_OUTBOX_QUERY = "SELECT id, invoice_id, url, payload, attempts FROM webhook_outbox " \
+                          "WHERE status = 'pending' AND next_attempt <= NOW() ORDER BY next_attempt LIMIT %s FOR UPDATE SKIP LOCKED;"
+    _LEASE_OUTBOX_QUERY = "UPDATE webhook_outbox SET attempts = attempts + 1, next_attempt = NOW() + INTERVAL %s SECOND WHERE id IN ({});"
+    _OUTBOX_DELIVERED_QUERY = "UPDATE webhook_outbox SET status = 'delivered', delivered = NOW(), last_error = NULL WHERE id = %s;"
+    _OUTBOX_RESCHEDULE_QUERY = "UPDATE webhook_outbox SET status = %s, next_attempt = NOW() + INTERVAL %s SECOND, last_error = %s WHERE id = %s;"
+    _OUTBOX_RELEASE_QUERY = "UPDATE webhook_outbox SET attempts = attempts - 1, next_attempt = NOW() WHERE id = %s AND status = 'pending';"
+    _OUTBOX_BACKLOG_QUERY = "SELECT COUNT(*), COALESCE(SUM(next_attempt <= NOW()), 0), MIN(created) FROM webhook_outbox WHERE status = 'pending';"
+    _ADD_INBOX_QUERY = "INSERT INTO webhook_inbox (method_id, invoice_id, payload, attempts, next_attempt, created) " \
+                       "VALUES (%s, %s, %s, %s, NOW() + INTERVAL %s SECOND, NOW());"
+    _CLAIM_INBOX_QUERY = "SELECT id, method_id, invoice_id, payload, attempts FROM webhook_inbox " \
+                         "WHERE status = 'pending' AND next_attempt <= NOW() ORDER BY next_attempt LIMIT %s FOR UPDATE SKIP LOCKED;"
+    _LEASE_INBOX_QUERY = "UPDATE webhook_inbox SET attempts = attempts + 1, next_attempt = NOW() + INTERVAL %s SECOND WHERE id IN ({});"
+    _INBOX_PROCESSED_QUERY = "UPDATE webhook_inbox SET status = 'processed', last_error = NULL WHERE id = %s;"
+    _INBOX_RESCHEDULE_QUERY = "UPDATE webhook_inbox SET status = %s, next_attempt = NOW() + INTERVAL %s SECOND, last_error = %s WHERE id = %s;"
+    _INBOX_RELEASE_QUERY = "UPDATE webhook_inbox SET attempts = attempts - 1, next_attempt = NOW() WHERE id = %s AND status = 'pending';"
+
+    def __init__(self, host: str, user: str, password: str, db_name: str,
+                 min_size: int = 1,
+                 max_size: int = 10,
+                 pool_recycle: int = 3600,
+                 connect_timeout: float = 10,
+                 acquire_timeout: float | None = 5):
+        """
+        :param min_size: минимальное количество соединений, которые пул держит открытыми
+        :param max_size: максимальное количество одновременно открытых соединений
+        :param pool_recycle: через сколько секунд соединение пересоздается (должно быть меньше wait_timeout в MySQL)
+        :param connect_timeout: таймаут установки нового соединения, сек
+        :param acquire_timeout: сколько ждать свободного соединения из пула, сек (None - бесконечно)
+        """
+        self._host = host
+        self._user = user
+        self._password = password
+        self._db_name = db_name
+        self._pool = None
+        self._min_size = min_size
+        self._max_size = max_size
+        self._pool_recycle = pool_recycle
+        self._connect_timeout = connect_timeout
+        self._acquire_timeout = acquire_timeout
+        self._waiters = 0
+
+    async def connect_async(self):
+        """
+        Открывает пул соединений. Вызывается один раз при запуске приложения.
+        """
+        if self._pool is not None:
+            return
+        # autocommit нужен, чтобы соединение не возвращалось в пул с открытой транзакцией после SELECT:
+        # aiomysql закрывает такие соединения вместо переиспользования.
+        # FOUND_ROWS: rowcount у UPDATE считает найденные строки, а не измененные - на этом построены условные переходы статусов
+        self._pool = await aiomysql.create_pool(host=self._host, user=self._user, password=self._password,
+                                                db=self._db_name, minsize=self._min_size, maxsize=self._max_size,
+                                                pool_recycle=self._pool_recycle,
+                                                connect_timeout=self._connect_timeout,
+                                                autocommit=True, client_flag=CLIENT.FOUND_ROWS)
+
+    async def close_async(self):
+        """
+        Закрывает пул, дожидаясь возврата всех выданных соединений.
+        """
+        if self._pool is None:
+            return
+        pool, self._pool = self._pool, None
+        pool.close()
+        await pool.wait_closed()
+
+    @contextlib.asynccontextmanager
+    async def _get_connection(self):
+        if self._pool is None:
+            raise DatabaseNotConnectedError()
+
+        self._waiters += 1
+        try:
+            with span("db.acquire"):
+                conn = await asyncio.wait_for(self._pool.acquire(), self._acquire_timeout)
+        finally:
+            self._waiters -= 1
+
+        try:
+            yield conn
+        finally:
+            self._pool.release(conn)
+
+    @contextlib.asynccontextmanager
+    async def _transaction(self):
+        """
+        Соединение с открытой транзакцией: COMMIT при выходе, ROLLBACK при исключении (в том числе при отмене задачи),
+        чтобы соединение не вернулось в пул посреди транзакции с удержанными блокировками строк.
+        """
+        async with self._get_connection() as conn:
+            await conn.begin()
+            try:
+                yield conn
+            except BaseException:
+                await conn.rollback()
+                raise
+            await conn.commit()
+
+    def get_pool_stats(self) -> PoolStats:
+        if self._pool is None:
+            return PoolStats(0, 0, 0, self._waiters, self._min_size, self._max_size)
+        size = self._pool.size
+        free = self._pool.freesize
+        return PoolStats(size, size - free, free, self._waiters, self._min_size, self._max_size)
+
+    async def _fetch_one_async(self, query: str, params: Any) -> tuple | None:
+        async with self._get_connection() as conn:
+            async with conn.cursor() as cur:
+                await cur.execute(query, params)
+                row = await cur.fetchone()
+        return tuple(row) if row is not None else None
+
+    async def get_invoice_row_async(self, invoice_id: str) -> tuple | None:
+        return await self._fetch_one_async(self._GET_INVOICES_QUERY, invoice_id)
+
+    async def get_invoice_row_by_idempotency_key_async(self, idempotency_key: str) -> tuple | None:
+        return await self._fetch_one_async(self._GET_INVOICE_BY_IDEMPOTENCY_KEY_QUERY, idempotency_key)
+
+    async def get_invoice_row_by_provider_id_async(self, method_id: str, provider_invoice_id: str) -> tuple | None:
+        return await self._fetch_one_async(self._GET_INVOICE_BY_PROVIDER_ID_QUERY, (method_id, provider_invoice_id))
+
+    async def get_invoice_rows_by_status_async(self, status, older_than, after, limit) -> list[tuple]:
+        last_created, last_id = after
+        async with self._get_connection() as conn:
+            async with conn.cursor() as cur:
+                await cur.execute(self._GET_INVOICES_BY_STATUS_QUERY,
+                                  (status, older_than, last_created, last_created, last_id, limit))
+                rows = await cur.fetchall()
+        return [tuple(row) for row in rows]
+
+    async def _execute_invoice_write_async(self, invoice_id: str, query: str, params: Any):
+        async with self._get_connection() as conn:
+            async with conn.cursor() as cur:
+                try:
+                    await cur.execute(query, params)
+                except IntegrityError as ex:
+                    if ex.args and ex.args[0] == ER.DUP_ENTRY:
+                        raise DuplicateInvoiceError(invoice_id) from ex
+                    raise
+                await conn.commit()
+
+    async def insert_invoice_async(self, row: tuple):
+        await self._execute_invoice_write_async(row[0], self._INSERT_INVOICE_QUERY, row)
+
+    async def insert_invoices_async(self, rows: list[tuple]):
+        # aiomysql объединяет executemany для INSERT ... VALUES в один запрос с несколькими строками;
+        # очень большой список делится на несколько запросов, поэтому они выполняются в одной транзакции
+        try:
+            async with self._transaction() as conn:
+                async with conn.cursor() as cur:
+                    await cur.executemany(self._INSERT_INVOICE_QUERY, rows)
+        except IntegrityError as ex:
+            if ex.args and ex.args[0] == ER.DUP_ENTRY:
+                raise DuplicateInvoiceError(rows[0][0]) from ex
+            raise
+
+    async def update_invoice_async(self, invoice_id: str, changes: dict[str, Any]):
+        query = self._UPDATE_INVOICE_QUERY.format(", ".join(f"{column} = %s" for column in changes))
+        await self._execute_invoice_write_async(invoice_id, query, [*changes.values(), invoice_id])
+
+    def _build_transition_query(self, invoice_id, from_statuses, to_status, changes, require_no_payment_method) -> tuple[str, list]:
+        assignments = ["status = %s"]
+        params: list[Any] = [to_status]
+        for column, value in changes.items():
+            if isinstance(value, ColumnRef):
+                assignments.append(f"{column} = {value.column}")
+            else:
+                assignments.append(f"{column} = %s")
+                params.append(value)
+
+        query = self._TRANSITION_INVOICE_QUERY.format(", ".join(assignments), ", ".join(["%s"] * len(from_statuses)),
+                                                      " AND payment_method IS NULL" if require_no_payment_method else "")
+        params += [invoice_id, *from_statuses]
+        return query, params
+
+    async def transition_invoice_async(self, invoice_id, from_statuses, to_status, changes,
+                                       require_no_payment_method, enqueue_webhook) -> bool:
+        query, params = self._build_transition_query(invoice_id, from_statuses, to_status, changes, require_no_payment_method)
+        if not enqueue_webhook:
+            async with self._get_connection() as conn:
+                async with conn.cursor() as cur:
+                    await cur.execute(query, params)
+                    return cur.rowcount == 1
+
+        async with self._transaction() as conn:
+            async with conn.cursor() as cur:
+                await cur.execute(query, params)
+                applied = cur.rowcount == 1
+                if applied:
+                    await cur.execute(self._ENQUEUE_WEBHOOK_QUERY, invoice_id)
+        return applied
+
+    async def execute_writes_async(self, ops: list[WriteOp]) -> list[Any]:
+        """
+        Все операции выполняются в одной транзакции с одним COMMIT. Подряд идущие вставки и одинаковые обновления
+        отправляются одним executemany; если в такой группе нарушена уникальность, группа повторяется по одной строке,
+        чтобы ошибку получила только операция, которая ее вызвала.
+        """
+        results: list[Any] = [None] * len(ops)
+        async with self._transaction() as conn:
+            async with conn.cursor() as cur:
+                for group in group_writes(ops):
+                    op = ops[group[0]]
+                    if isinstance(op, TransitionInvoice):
+                        query, params = self._build_transition_query(op.invoice_id, op.from_statuses, op.to_status,
+                                                                     op.changes, op.require_no_payment_method)
+                        await cur.execute(query, params)
+                        results[group[0]] = cur.rowcount == 1
+                        if results[group[0]] and op.enqueue_webhook:
+                            await cur.execute(self._ENQUEUE_WEBHOOK_QUERY, op.invoice_id)
+                    elif isinstance(op, InsertInvoice):
+                        await self._executemany_async(cur, self._INSERT_INVOICE_QUERY, [ops[i].row for i in group],
+                                                      [ops[i].row[0] for i in group], group, results)
+                    else:
+                        query = self._UPDATE_INVOICE_QUERY.format(", ".join(f"{column} = %s" for column in op.changes))
+                        await self._executemany_async(cur, query, [[*ops[i].changes.values(), ops[i].invoice_id] for i in group],
+                                                      [ops[i].invoice_id for i in group], group, results)
+        return results
+
+    @staticmethod
+    async def _executemany_async(cur, query: str, params: list, invoice_ids: list[str], indices: list[int], results: list):
+        try:
+            await cur.executemany(query, params)
+            return
+        except IntegrityError as ex:
+            if not ex.args or ex.args[0] != ER.DUP_ENTRY:
+                raise
+        # InnoDB откатывает только неудавшийся запрос, транзакция продолжается
+        for i, invoice_id, row_params in zip(indices, invoice_ids, params):
+            try:
+                await cur.execute(query, row_params)
+            except IntegrityError as ex:
+                if not ex.args or ex.args[0] != ER.DUP_ENTRY:
+                    raise
+                results[i] = DuplicateInvoiceError(invoice_id)
+
+    async def expire_invoices_async(self, from_status, to_status, created_before, limit,
+                                    payment_method, exclude_methods) -> list[str]:
+        conditions = ""
+        params: list[Any] = [from_status, created_before]
+        if payment_method is not None:
+            conditions += " AND payment_method = %s"
+            params.append(payment_method)
+        if exclude_methods:
+            conditions += f" AND (payment_method IS NULL OR payment_method NOT IN ({', '.join(['%s'] * len(exclude_methods))}))"
+            params += exclude_methods
+        params.append(limit)
+
+        async with self._transaction() as conn:
+            async with conn.cursor() as cur:
+                await cur.execute(self._EXPIRE_INVOICES_QUERY.format(conditions), params)
+                invoice_ids = [r[0] for r in await cur.fetchall()]
+                if invoice_ids:
+                    await cur.execute(self._SET_INVOICES_STATUS_QUERY.format(", ".join(["%s"] * len(invoice_ids))), (to_status, *invoice_ids))
+        return invoice_ids
+
+    @contextlib.asynccontextmanager
+    async def named_lock_async(self, name: str):
+        """
+        Блокировка MySQL GET_LOCK. Пока блокировка удерживается, занимает одно соединение из пула.
+        """
+        async with self._get_connection() as conn:
+            async with conn.cursor() as cur:
+                await cur.execute("SELECT GET_LOCK(%s, 0);", name)
+                acquired = (await cur.fetchone())[0] == 1
+            try:
+                yield acquired
+            finally:
+                if acquired:
+                    async with conn.cursor() as cur:
+                        await cur.execute("SELECT RELEASE_LOCK(%s);", name)
+
+    async def claim_outbox_async(self, limit: int, lease_seconds: int) -> list[OutboxEntry]:
+        async with self._transaction() as conn:
+            async with conn.cursor() as cur:
+                await cur.execute(self._CLAIM_OUTBOX_QUERY, limit)
+                rows = await cur.fetchall()
+                if not any(rows):
+                    return []
+
+                ids = [r[0] for r in rows]
+                await cur.execute(self._LEASE_OUTBOX_QUERY.format(", ".join(["%s"] * len(ids))), (lease_seconds, *ids))
+
+        return [OutboxEntry(r[0], r[1], r[2], json.loads(r[3]), r[4] + 1) for r in rows]
+
+    async def _execute_async(self, query: str, params: Any):
+        async with self._get_connection() as conn:
+            async with conn.cursor() as cur:
+                await cur.execute(query, params)
+                await conn.commit()
+
+    async def mark_outbox_delivered_async(self, entry_id: int):
+        await self._execute_async(self._OUTBOX_DELIVERED_QUERY, entry_id)
+
+    async def reschedule_outbox_async(self, entry_id: int, delay_seconds: int, error: str, give_up: bool):
+        await self._execute_async(self._OUTBOX_RESCHEDULE_QUERY,
+                                  ("failed" if give_up else "pending", delay_seconds, error[:256], entry_id))
+
+    async def release_outbox_async(self, entry_id: int):
+        await self._execute_async(self._OUTBOX_RELEASE_QUERY, entry_id)
+
+    async def get_outbox_backlog_async(self) -> OutboxBacklog:
+        row = await self._fetch_one_async(self._OUTBOX_BACKLOG_QUERY, None)
+        return OutboxBacklog(int(row[0]), int(row[1]), row[2])
+
+    async def add_inbox_async(self, method_id: str, invoice_id: str, payload: dict, lease_seconds: int) -> int:
+        async with self._get_connection() as conn:
+            async with conn.cursor() as cur:
+                await cur.execute(self._ADD_INBOX_QUERY, (method_id, invoice_id, json.dumps(payload), 1 if lease_seconds > 0 else 0, lease_seconds))
+                await conn.commit()
+                return cur.lastrowid
+
+    async def claim_inbox_async(self, limit: int, lease_seconds: int) -> list[InboxEntry]:
+        async with self._transaction() as conn:
+            async with conn.cursor() as cur:
+                await cur.execute(self._CLAIM_INBOX_QUERY, limit)
+                rows = await cur.fetchall()
+                if not any(rows):
+                    return []
+
+                ids = [r[0] for r in rows]
+                await cur.execute(self._LEASE_INBOX_QUERY.format(", ".join(["%s"] * len(ids))), (lease_seconds, *ids))
+
+        return [InboxEntry(r[0], r[1], r[2], json.loads(r[3]), r[4] + 1) for r in rows]
+
+    async def mark_inbox_processed_async(self, entry_id: int):
+        await self._execute_async(self._INBOX_PROCESSED_QUERY, entry_id)
+
+    async def reschedule_inbox_async(self, entry_id: int, delay_seconds: int, error: str, give_up: bool):
+        await self._execute_async(self._INBOX_RESCHEDULE_QUERY, ("failed" if give_up else "pending", delay_seconds, error[:256], entry_id))
+
+    async def release_inbox_async(self, entry_id: int):
+        await self._execute_async(self._INBOX_RELEASE_QUERY, entry_id)
+
+    async def get_payment_methods_async(self) -> list[PaymentMethod]:
+        async with self._get_connection() as conn:
+            async with conn.cursor() as cur:
+                await cur.execute(self._GET_PAYMENT_METHODS_QUERY)
+                rows = await cur.fetchall()
+        return [PaymentMethod(*r) for r in rows]
+
+    async def save_payment_method_async(self, method: PaymentMethod):
+        await self._execute_async(self._SAVE_PAYMENT_METHOD_QUERY,
+                                  (method.method_id, method.name, method.description, method.icon_url, method.instructions))
+
+    async def create_tables_async(self):
+        async with self._get_connection() as conn:
+            async with conn.cursor() as cur:
+                await cur.execute(
+                    "CREATE TABLE IF NOT EXISTS invoices "
+                    "(invoice_id VARCHAR(36) NOT NULL, status VARCHAR(32) NOT NULL DEFAULT 'created', "
+                    "amount REAL NOT NULL, credited REAL NOT NULL, created DATETIME NOT NULL, "
+                    "payed DATETIME, comment VARCHAR(256) NOT NULL DEFAULT '',"
+                    "custom_fields VARCHAR(128) NOT NULL DEFAULT '{}', webhook_url VARCHAR(128) NOT NULL DEFAULT '', payment_method VARCHAR(32), payment_url VARCHAR(512) NOT NULL, payment_method_invoice_id VARCHAR(128), idempotency_key VARCHAR(64), PRIMARY KEY (invoice_id), "
+                    + ", ".join(f"{kind} {name} {columns}" for name, (kind, columns) in self._INVOICE_INDEXES.items()) + ");")
+                await cur.execute(
+                    "CREATE TABLE IF NOT EXISTS payment_methods "
+                    "(method_id VARCHAR(32) NOT NULL, name VARCHAR(64) NOT NULL, description VARCHAR(256) NOT NULL DEFAULT '', icon_url VARCHAR(256) NOT NULL, instructions TEXT, PRIMARY KEY (method_id));"
+                )
+                await cur.execute(
+                    "CREATE TABLE IF NOT EXISTS webhook_outbox "
+                    "(id BIGINT NOT NULL AUTO_INCREMENT, invoice_id VARCHAR(36) NOT NULL, url VARCHAR(128) NOT NULL, payload TEXT NOT NULL, "
+                    "status VARCHAR(16) NOT NULL DEFAULT 'pending', attempts INT NOT NULL DEFAULT 0, next_attempt DATETIME NOT NULL, "
+                    "created DATETIME NOT NULL, delivered DATETIME, last_error VARCHAR(256), "
+                    "PRIMARY KEY (id), KEY idx_outbox_due (status, next_attempt));"
+                )
+                await cur.execute(
+                    "CREATE TABLE IF NOT EXISTS webhook_inbox "
+                    "(id BIGINT NOT NULL AUTO_INCREMENT, method_id VARCHAR(32) NOT NULL, invoice_id VARCHAR(36) NOT NULL, payload TEXT NOT NULL, "
+                    "status VARCHAR(16) NOT NULL DEFAULT 'pending', attempts INT NOT NULL DEFAULT 0, next_attempt DATETIME NOT NULL, "
+                    "created DATETIME NOT NULL, last_error VARCHAR(256), "
+                    "PRIMARY KEY (id), KEY idx_inbox_due (status, next_attempt));"
+                )
+                await conn.commit()
+
+                # таблица invoices могла быть создана до появления новых столбцов и индексов
+                await self._ensure_column_async(cur, "invoices", "idempotency_key", "VARCHAR(64)")
+                for name, (kind, columns) in self._INVOICE_INDEXES.items():
+                    await self._ensure_index_async(cur, "invoices", name, kind, columns)
+
+    async def _ensure_column_async(self, cur, table: str, name: str, definition: str):
+        await cur.execute("SELECT 1 FROM information_schema.columns WHERE table_schema = %s AND table_name = %s AND column_name = %s LIMIT 1;",
+                          (self._db_name, table, name))
+        if await cur.fetchone() is None:
+            await cur.execute(f"ALTER TABLE {table} ADD COLUMN {name} {definition};")
+
+    async def _ensure_index_async(self, cur, table: str, name: str, kind: str, columns: str):
+        await cur.execute("SELECT 1 FROM information_schema.statistics WHERE table_schema = %s AND table_name = %s AND index_name = %s LIMIT 1;",
+                          (self._db_name, table, name))
+        if await cur.fetchone() is None:
+            await cur.execute(f"ALTER TABLE {table} ADD {kind} {name} {columns};")
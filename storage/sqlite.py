@@ -0,0 +1,391 @@
+"""
+Хранилище в файле SQLite (aiosqlite) в режиме WAL: не требует отдельного сервера БД.
+Все запросы процесса идут через одно соединение по очереди; WAL позволяет другим процессам читать файл во время записи.
+"""
+import asyncio
+import contextlib
+import datetime
+import json
+import sqlite3
+import time
+from typing import Any
+
+import aiosqlite
+
+from storage.base import StorageEngine, INVOICE_COLUMNS, ColumnRef, PaymentMethod, OutboxEntry, OutboxBacklog, InboxEntry, PoolStats, \
+    DuplicateInvoiceError, DatabaseNotConnectedError, WriteOp, InsertInvoice, TransitionInvoice, group_writes
+
+_DATETIME_COLUMNS = tuple(INVOICE_COLUMNS.index(column) for column in ("created", "payed"))
+
+
+def _to_sql(value: Any) -> Any:
+    # время хранится строкой фиксированного формата: такие строки сравниваются в том же порядке, что и datetime
+    return value.isoformat(sep=" ") if isinstance(value, datetime.datetime) else value
+
+
+def _from_sql(value: str | None) -> datetime.datetime | None:
+    return datetime.datetime.fromisoformat(value) if value is not None else None
+
+
+def _now_sql(delay_seconds: float = 0) -> str:
+    return _to_sql(datetime.datetime.now() + datetime.timedelta(seconds=delay_seconds))
+
+
+class SQLiteEngine(StorageEngine):
+    _path: str
+    _busy_timeout: float
+    _lock_ttl: float
+    _conn: aiosqlite.Connection | None
+    _lock: asyncio.Lock
+    _waiters: int
+
+    _INSERT_INVOICE_QUERY = f"INSERT INTO invoices ({', '.join(INVOICE_COLUMNS)}) VALUES ({', '.join(['?'] * len(INVOICE_COLUMNS))});"
+    _GET_INVOICES_BY_STATUS_QUERY = f"SELECT {', '.join(INVOICE_COLUMNS)} FROM invoices WHERE status = ? AND created < ? " \
+                                    "AND (created > ? OR (created = ? AND invoice_id > ?)) ORDER BY created, invoice_id LIMIT ?;"
+    _TRANSITION_INVOICE_QUERY = "UPDATE invoices SET {} WHERE invoice_id = ? AND status IN ({}){};"
+    _ENQUEUE_WEBHOOK_QUERY = "INSERT INTO webhook_outbox (invoice_id, url, payload, next_attempt, created) " \
+                             "SELECT invoice_id, webhook_url, json_object('invoice_id', invoice_id, 'sum', amount, 'comment', comment, 'custom_field', custom_fields), ?, ? " \
+                             "FROM invoices WHERE invoice_id = ? AND webhook_url <> '';"
+    # UPDATE ... ORDER BY LIMIT доступен не во всех сборках SQLite, поэтому пачка выбирается подзапросом
+    _EXPIRE_INVOICES_QUERY = "SELECT invoice_id FROM invoices WHERE status = ? AND created < ?{} ORDER BY created LIMIT ?;"
+    _CLAIM_OUTBOX_QUERY = "SELECT id, invoice_id, url, payload, attempts FROM webhook_outbox " \
+                          "WHERE status = 'pending' AND next_attempt <= ? ORDER BY next_attempt LIMIT ?;"
+    _CLAIM_INBOX_QUERY = "SELECT id, method_id, invoice_id, payload, attempts FROM webhook_inbox " \
+                         "WHERE status = 'pending' AND next_attempt <= ? ORDER BY next_attempt LIMIT ?;"
+
+    _SCHEMA = (
+        "CREATE TABLE IF NOT EXISTS invoices "
+        "(invoice_id TEXT NOT NULL PRIMARY KEY, status TEXT NOT NULL DEFAULT 'created', amount REAL NOT NULL, credited REAL NOT NULL, "
+        "created TEXT NOT NULL, payed TEXT, comment TEXT NOT NULL DEFAULT '', custom_fields TEXT NOT NULL DEFAULT '{}', "
+        "webhook_url TEXT NOT NULL DEFAULT '', payment_method TEXT, payment_url TEXT NOT NULL, payment_method_invoice_id TEXT, "
+        "idempotency_key TEXT);",
+        "CREATE INDEX IF NOT EXISTS idx_invoices_provider ON invoices (payment_method, payment_method_invoice_id);",
+        "CREATE INDEX IF NOT EXISTS idx_invoices_status_created ON invoices (status, created);",
+        "CREATE INDEX IF NOT EXISTS idx_invoices_created ON invoices (created);",
+        "CREATE UNIQUE INDEX IF NOT EXISTS uq_invoices_idempotency_key ON invoices (idempotency_key);",
+        "CREATE TABLE IF NOT EXISTS payment_methods "
+        "(method_id TEXT NOT NULL PRIMARY KEY, name TEXT NOT NULL, description TEXT NOT NULL DEFAULT '', icon_url TEXT NOT NULL, instructions TEXT);",
+        "CREATE TABLE IF NOT EXISTS webhook_outbox "
+        "(id INTEGER PRIMARY KEY AUTOINCREMENT, invoice_id TEXT NOT NULL, url TEXT NOT NULL, payload TEXT NOT NULL, "
+        "status TEXT NOT NULL DEFAULT 'pending', attempts INTEGER NOT NULL DEFAULT 0, next_attempt TEXT NOT NULL, "
+        "created TEXT NOT NULL, delivered TEXT, last_error TEXT);",
+        "CREATE INDEX IF NOT EXISTS idx_outbox_due ON webhook_outbox (status, next_attempt);",
+        "CREATE TABLE IF NOT EXISTS webhook_inbox "
+        "(id INTEGER PRIMARY KEY AUTOINCREMENT, method_id TEXT NOT NULL, invoice_id TEXT NOT NULL, payload TEXT NOT NULL, "
+        "status TEXT NOT NULL DEFAULT 'pending', attempts INTEGER NOT NULL DEFAULT 0, next_attempt TEXT NOT NULL, "
+        "created TEXT NOT NULL, last_error TEXT);",
+        "CREATE INDEX IF NOT EXISTS idx_inbox_due ON webhook_inbox (status, next_attempt);",
+        # аналог GET_LOCK: строка существует, пока блокировка удерживается
+        "CREATE TABLE IF NOT EXISTS named_locks (name TEXT NOT NULL PRIMARY KEY, acquired REAL NOT NULL);",
+    )
+
+    def __init__(self, path: str, busy_timeout: float = 5, lock_ttl: float = 600):
+        """
+        :param path: путь к файлу БД
+        :param busy_timeout: сколько ждать, пока другой процесс закончит запись, сек
+        :param lock_ttl: через сколько секунд блокировка named_lock_async считается брошенной (процесс упал, не сняв ее)
+        """
+        self._path = path
+        self._busy_timeout = busy_timeout
+        self._lock_ttl = lock_ttl
+        self._conn = None
+        self._lock = asyncio.Lock()
+        self._waiters = 0
+
+    async def connect_async(self):
+        if self._conn is not None:
+            return
+        # isolation_level=None: транзакции открываются явно, остальные запросы выполняются в autocommit
+        conn = await aiosqlite.connect(self._path, isolation_level=None)
+        await conn.execute("PRAGMA journal_mode=WAL;")
+        await conn.execute("PRAGMA synchronous=NORMAL;")    # в режиме WAL не теряет целостность при сбое, только последние транзакции
+        await conn.execute(f"PRAGMA busy_timeout={int(self._busy_timeout * 1000)};")
+        self._conn = conn
+
+    async def close_async(self):
+        if self._conn is None:
+            return
+        async with self._lock:
+            conn, self._conn = self._conn, None
+            await conn.close()
+
+    @contextlib.asynccontextmanager
+    async def _get_connection(self):
+        """
+        Выдает соединение в монопольное пользование: aiosqlite выполняет запросы одного соединения последовательно,
+        и чужой запрос не должен попасть внутрь открытой транзакции.
+        """
+        if self._conn is None:
+            raise DatabaseNotConnectedError()
+
+        self._waiters += 1
+        try:
+            await self._lock.acquire()
+        finally:
+            self._waiters -= 1
+
+        try:
+            yield self._conn
+        finally:
+            self._lock.release()
+
+    @contextlib.asynccontextmanager
+    async def _transaction(self):
+        async with self._get_connection() as conn:
+            await conn.execute("BEGIN IMMEDIATE;")    # сразу берет блокировку записи, чтобы не получить SQLITE_BUSY посреди транзакции
+            try:
+                yield conn
+            except BaseException:
+                await conn.rollback()
+                raise
+            await conn.commit()
+
+    def get_pool_stats(self) -> PoolStats:
+        if self._conn is None:
+            return PoolStats(0, 0, 0, self._waiters, 1, 1)
+        in_use = int(self._lock.locked())
+        return PoolStats(1, in_use, 1 - in_use, self._waiters, 1, 1)
+
+    @staticmethod
+    def _invoice_from_sql(row) -> tuple:
+        row = list(row)
+        for i in _DATETIME_COLUMNS:
+            row[i] = _from_sql(row[i])
+        return tuple(row)
+
+    async def _fetch_invoice_async(self, condition: str, params: tuple) -> tuple | None:
+        async with self._get_connection() as conn:
+            async with conn.execute(f"SELECT {', '.join(INVOICE_COLUMNS)} FROM invoices WHERE {condition} LIMIT 1;", params) as cur:
+                row = await cur.fetchone()
+        return self._invoice_from_sql(row) if row is not None else None
+
+    async def get_invoice_row_async(self, invoice_id: str) -> tuple | None:
+        return await self._fetch_invoice_async("invoice_id = ?", (invoice_id,))
+
+    async def get_invoice_row_by_idempotency_key_async(self, idempotency_key: str) -> tuple | None:
+        return await self._fetch_invoice_async("idempotency_key = ?", (idempotency_key,))
+
+    async def get_invoice_row_by_provider_id_async(self, method_id: str, provider_invoice_id: str) -> tuple | None:
+        return await self._fetch_invoice_async("payment_method = ? AND payment_method_invoice_id = ?", (method_id, provider_invoice_id))
+
+    async def get_invoice_rows_by_status_async(self, status, older_than, after, limit) -> list[tuple]:
+        last_created, last_id = _to_sql(after[0]), after[1]
+        async with self._get_connection() as conn:
+            async with conn.execute(self._GET_INVOICES_BY_STATUS_QUERY,
+                                    (status, _to_sql(older_than), last_created, last_created, last_id, limit)) as cur:
+                rows = await cur.fetchall()
+        return [self._invoice_from_sql(row) for row in rows]
+
+    async def _execute_invoice_write_async(self, invoice_id: str, query: str, params: list):
+        async with self._get_connection() as conn:
+            try:
+                await conn.execute(query, [_to_sql(value) for value in params])
+            except sqlite3.IntegrityError as ex:
+                if str(ex).startswith("UNIQUE"):
+                    raise DuplicateInvoiceError(invoice_id) from ex
+                raise
+
+    async def insert_invoice_async(self, row: tuple):
+        await self._execute_invoice_write_async(row[0], self._INSERT_INVOICE_QUERY, list(row))
+
+    async def insert_invoices_async(self, rows: list[tuple]):
+        async with self._transaction() as conn:
+            try:
+                await conn.executemany(self._INSERT_INVOICE_QUERY, [[_to_sql(value) for value in row] for row in rows])
+            except sqlite3.IntegrityError as ex:
+                if str(ex).startswith("UNIQUE"):
+                    raise DuplicateInvoiceError(rows[0][0]) from ex
+                raise
+
+    async def update_invoice_async(self, invoice_id: str, changes: dict[str, Any]):
+        query = f"UPDATE invoices SET {', '.join(f'{column} = ?' for column in changes)} WHERE invoice_id = ?;"
+        await self._execute_invoice_write_async(invoice_id, query, [*changes.values(), invoice_id])
+
+    def _build_transition_query(self, invoice_id, from_statuses, to_status, changes, require_no_payment_method) -> tuple[str, list]:
+        assignments = ["status = ?"]
+        params: list[Any] = [to_status]
+        for column, value in changes.items():
+            if isinstance(value, ColumnRef):
+                assignments.append(f"{column} = {value.column}")
+            else:
+                assignments.append(f"{column} = ?")
+                params.append(_to_sql(value))
+
+        query = self._TRANSITION_INVOICE_QUERY.format(", ".join(assignments), ", ".join(["?"] * len(from_statuses)),
+                                                      " AND payment_method IS NULL" if require_no_payment_method else "")
+        params += [invoice_id, *from_statuses]
+        return query, params
+
+    async def _transition_async(self, conn: aiosqlite.Connection, invoice_id, from_statuses, to_status, changes,
+                                require_no_payment_method, enqueue_webhook) -> bool:
+        query, params = self._build_transition_query(invoice_id, from_statuses, to_status, changes, require_no_payment_method)
+        async with conn.execute(query, params) as cur:
+            applied = cur.rowcount == 1
+        if applied and enqueue_webhook:
+            now = _now_sql()
+            await conn.execute(self._ENQUEUE_WEBHOOK_QUERY, (now, now, invoice_id))
+        return applied
+
+    async def transition_invoice_async(self, invoice_id, from_statuses, to_status, changes,
+                                       require_no_payment_method, enqueue_webhook) -> bool:
+        async with self._transaction() as conn:
+            return await self._transition_async(conn, invoice_id, from_statuses, to_status, changes,
+                                                require_no_payment_method, enqueue_webhook)
+
+    async def execute_writes_async(self, ops: list[WriteOp]) -> list[Any]:
+        """
+        Все операции выполняются в одной транзакции. Подряд идущие вставки и одинаковые обновления отправляются
+        одним executemany; если в такой группе нарушена уникальность, группа повторяется по одной строке.
+        """
+        results: list[Any] = [None] * len(ops)
+        async with self._transaction() as conn:
+            for group in group_writes(ops):
+                op = ops[group[0]]
+                if isinstance(op, TransitionInvoice):
+                    results[group[0]] = await self._transition_async(conn, op.invoice_id, op.from_statuses, op.to_status, op.changes,
+                                                                     op.require_no_payment_method, op.enqueue_webhook)
+                elif isinstance(op, InsertInvoice):
+                    await self._executemany_async(conn, self._INSERT_INVOICE_QUERY, [ops[i].row for i in group],
+                                                  [ops[i].row[0] for i in group], group, results)
+                else:
+                    query = f"UPDATE invoices SET {', '.join(f'{column} = ?' for column in op.changes)} WHERE invoice_id = ?;"
+                    await self._executemany_async(conn, query, [[*ops[i].changes.values(), ops[i].invoice_id] for i in group],
+                                                  [ops[i].invoice_id for i in group], group, results)
+        return results
+
+    @staticmethod
+    async def _executemany_async(conn: aiosqlite.Connection, query: str, params: list, invoice_ids: list[str],
+                                 indices: list[int], results: list):
+        params = [[_to_sql(value) for value in row_params] for row_params in params]
+        # executemany не откатывает строки, вставленные до ошибки, поэтому группа выполняется внутри точки сохранения
+        await conn.execute("SAVEPOINT write_group;")
+        try:
+            await conn.executemany(query, params)
+            await conn.execute("RELEASE write_group;")
+            return
+        except sqlite3.IntegrityError as ex:
+            await conn.execute("ROLLBACK TO write_group;")
+            await conn.execute("RELEASE write_group;")
+            if not str(ex).startswith("UNIQUE"):
+                raise
+
+        for i, invoice_id, row_params in zip(indices, invoice_ids, params):
+            try:
+                await conn.execute(query, row_params)
+            except sqlite3.IntegrityError as ex:
+                if not str(ex).startswith("UNIQUE"):
+                    raise
+                results[i] = DuplicateInvoiceError(invoice_id)
+
+    async def expire_invoices_async(self, from_status, to_status, created_before, limit,
+                                    payment_method, exclude_methods) -> list[str]:
+        conditions = ""
+        params: list[Any] = [from_status, _to_sql(created_before)]
+        if payment_method is not None:
+            conditions += " AND payment_method = ?"
+            params.append(payment_method)
+        if exclude_methods:
+            conditions += f" AND (payment_method IS NULL OR payment_method NOT IN ({', '.join(['?'] * len(exclude_methods))}))"
+            params += exclude_methods
+        params.append(limit)
+
+        async with self._transaction() as conn:
+            async with conn.execute(self._EXPIRE_INVOICES_QUERY.format(conditions), params) as cur:
+                invoice_ids = [r[0] for r in await cur.fetchall()]
+            if invoice_ids:
+                await conn.execute(f"UPDATE invoices SET status = ? WHERE invoice_id IN ({', '.join(['?'] * len(invoice_ids))});",
+                                   (to_status, *invoice_ids))
+        return invoice_ids
+
+    @contextlib.asynccontextmanager
+    async def named_lock_async(self, name: str):
+        """
+        Блокировка через таблицу named_locks. Соединение не удерживается, пока блокировка взята.
+        """
+        now = time.time()
+        async with self._transaction() as conn:
+            await conn.execute("DELETE FROM named_locks WHERE name = ? AND acquired < ?;", (name, now - self._lock_ttl))
+            async with conn.execute("INSERT OR IGNORE INTO named_locks (name, acquired) VALUES (?, ?);", (name, now)) as cur:
+                acquired = cur.rowcount == 1
+        try:
+            yield acquired
+        finally:
+            if acquired:
+                async with self._get_connection() as conn:
+                    await conn.execute("DELETE FROM named_locks WHERE name = ? AND acquired = ?;", (name, now))
+
+    async def claim_outbox_async(self, limit: int, lease_seconds: int) -> list[OutboxEntry]:
+        async with self._transaction() as conn:
+            async with conn.execute(self._CLAIM_OUTBOX_QUERY, (_now_sql(), limit)) as cur:
+                rows = await cur.fetchall()
+            if rows:
+                await conn.execute(f"UPDATE webhook_outbox SET attempts = attempts + 1, next_attempt = ? WHERE id IN ({', '.join(['?'] * len(rows))});",
+                                   (_now_sql(lease_seconds), *(r[0] for r in rows)))
+
+        return [OutboxEntry(r[0], r[1], r[2], json.loads(r[3]), r[4] + 1) for r in rows]
+
+    async def _execute_async(self, query: str, params: tuple):
+        async with self._get_connection() as conn:
+            await conn.execute(query, params)
+
+    async def mark_outbox_delivered_async(self, entry_id: int):
+        await self._execute_async("UPDATE webhook_outbox SET status = 'delivered', delivered = ?, last_error = NULL WHERE id = ?;",
+                                  (_now_sql(), entry_id))
+
+    async def reschedule_outbox_async(self, entry_id: int, delay_seconds: int, error: str, give_up: bool):
+        await self._execute_async("UPDATE webhook_outbox SET status = ?, next_attempt = ?, last_error = ? WHERE id = ?;",
+                                  ("failed" if give_up else "pending", _now_sql(delay_seconds), error[:256], entry_id))
+
+    async def release_outbox_async(self, entry_id: int):
+        await self._execute_async("UPDATE webhook_outbox SET attempts = attempts - 1, next_attempt = ? WHERE id = ? AND status = 'pending';",
+                                  (_now_sql(), entry_id))
+
+    async def get_outbox_backlog_async(self) -> OutboxBacklog:
+        async with self._get_connection() as conn:
+            async with conn.execute("SELECT COUNT(*), COALESCE(SUM(next_attempt <= ?), 0), MIN(created) FROM webhook_outbox WHERE status = 'pending';",
+                                    (_now_sql(),)) as cur:
+                row = await cur.fetchone()
+        return OutboxBacklog(int(row[0]), int(row[1]), _from_sql(row[2]))
+
+    async def add_inbox_async(self, method_id: str, invoice_id: str, payload: dict, lease_seconds: int) -> int:
+        async with self._get_connection() as conn:
+            async with conn.execute("INSERT INTO webhook_inbox (method_id, invoice_id, payload, attempts, next_attempt, created) VALUES (?, ?, ?, ?, ?, ?);",
+                                    (method_id, invoice_id, json.dumps(payload), 1 if lease_seconds > 0 else 0,
+                                     _now_sql(lease_seconds), _now_sql())) as cur:
+                return cur.lastrowid
+
+    async def claim_inbox_async(self, limit: int, lease_seconds: int) -> list[InboxEntry]:
+        async with self._transaction() as conn:
+            async with conn.execute(self._CLAIM_INBOX_QUERY, (_now_sql(), limit)) as cur:
+                rows = await cur.fetchall()
+            if rows:
+                await conn.execute(f"UPDATE webhook_inbox SET attempts = attempts + 1, next_attempt = ? WHERE id IN ({', '.join(['?'] * len(rows))});",
+                                   (_now_sql(lease_seconds), *(r[0] for r in rows)))
+
+        return [InboxEntry(r[0], r[1], r[2], json.loads(r[3]), r[4] + 1) for r in rows]
+
+    async def mark_inbox_processed_async(self, entry_id: int):
+        await self._execute_async("UPDATE webhook_inbox SET status = 'processed', last_error = NULL WHERE id = ?;", (entry_id,))
+
+    async def reschedule_inbox_async(self, entry_id: int, delay_seconds: int, error: str, give_up: bool):
+        await self._execute_async("UPDATE webhook_inbox SET status = ?, next_attempt = ?, last_error = ? WHERE id = ?;",
+                                  ("failed" if give_up else "pending", _now_sql(delay_seconds), error[:256], entry_id))
+
+    async def release_inbox_async(self, entry_id: int):
+        await self._execute_async("UPDATE webhook_inbox SET attempts = attempts - 1, next_attempt = ? WHERE id = ? AND status = 'pending';",
+                                  (_now_sql(), entry_id))
+
+    async def get_payment_methods_async(self) -> list[PaymentMethod]:
+        async with self._get_connection() as conn:
+            async with conn.execute("SELECT method_id, name, description, icon_url, instructions FROM payment_methods;") as cur:
+                rows = await cur.fetchall()
+        return [PaymentMethod(*r) for r in rows]
+
+    async def save_payment_method_async(self, method: PaymentMethod):
+        await self._execute_async("REPLACE INTO payment_methods (method_id, name, description, icon_url, instructions) VALUES (?, ?, ?, ?, ?);",
+                                  (method.method_id, method.name, method.description, method.icon_url, method.instructions))
+
+    async def create_tables_async(self):
+        async with self._get_connection() as conn:
+            for statement in self._SCHEMA:
+                await conn.execute(statement)
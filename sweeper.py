@@ -0,0 +1,93 @@
+"""
+Фоновая задача, которая переводит в TIMEOUT счета, оставшиеся в статусах CREATED и PROCESSING дольше допустимого.
+Большинство платежных систем не присылает вебхук об истечении счета, поэтому без нее такие счета висят вечно.
+"""
+import asyncio
+import datetime
+import logging
+
+from db import DatabaseManager, InvoiceStatus
+
+
+class InvoiceSweeper:
+    """
+    Периодически закрывает просроченные счета пачками. Между процессами координируется блокировкой в БД,
+    поэтому одновременно работает только один экземпляр.
+    """
+
+    LOCK_NAME = "payment_service_invoice_sweeper"
+
+    _db_manager: DatabaseManager
+    _interval: float
+    _batch_size: int
+    _default_ttl: datetime.timedelta
+    _method_ttls: dict[str, datetime.timedelta]
+    _logger: logging.Logger
+    _task: asyncio.Task | None
+
+    def __init__(self, db_manager: DatabaseManager,
+                 interval: float = 300,
+                 batch_size: int = 500,
+                 default_ttl: datetime.timedelta = datetime.timedelta(days=1),
+                 method_ttls: dict[str, datetime.timedelta] | None = None):
+        """
+        :param interval: пауза между проходами, сек
+        :param batch_size: сколько счетов закрывать одним запросом
+        :param default_ttl: время жизни счета, если для его платежной системы не задано другое
+        :param method_ttls: время жизни счетов по платежным системам (ключ - method_id)
+        """
+        self._db_manager = db_manager
+        self._interval = interval
+        self._batch_size = batch_size
+        self._default_ttl = default_ttl
+        self._method_ttls = method_ttls or {}
+        self._logger = logging.getLogger("payment_api_logger")
+        self._task = None
+
+    async def start_async(self):
+        self._task = asyncio.create_task(self._run_async())
+
+    async def stop_async(self):
+        if self._task is None:
+            return
+        self._task.cancel()
+        await asyncio.gather(self._task, return_exceptions=True)
+        self._task = None
+
+    async def _run_async(self):
+        while True:
+            try:
+                await self.sweep_async()
+            except Exception as ex:
+                self._logger.exception("[SWEEPER] Failed to expire invoices", exc_info=ex)
+            await asyncio.sleep(self._interval)
+
+    async def sweep_async(self) -> int:
+        """
+        Выполняет один проход. Возвращает количество закрытых счетов (0, если проход выполняет другой процесс).
+        """
+        async with self._db_manager.named_lock_async(self.LOCK_NAME) as acquired:
+            if not acquired:
+                return 0
+
+            now = datetime.datetime.now()
+            # у счета в CREATED платежная система еще не выбрана
+            expired = await self._expire_async(InvoiceStatus.CREATED, now - self._default_ttl)
+
+            for method_id, ttl in self._method_ttls.items():
+                expired += await self._expire_async(InvoiceStatus.PROCESSING, now - ttl, payment_method=method_id)
+            expired += await self._expire_async(InvoiceStatus.PROCESSING, now - self._default_ttl,
+                                                exclude_methods=self._method_ttls.keys())
+
+        if expired:
+            self._logger.info("[SWEEPER] Invoices timed out: %s", expired)
+        return expired
+
+    async def _expire_async(self, status: InvoiceStatus, created_before: datetime.datetime, **filters) -> int:
+        total = 0
+        while True:
+            count = await self._db_manager.expire_invoices_async(status, created_before, self._batch_size, **filters)
+            total += count
+            if count < self._batch_size:
+                return total
+            await asyncio.sleep(0)    # отдаем управление обработчикам запросов между пачками
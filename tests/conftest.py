@@ -0,0 +1,39 @@
+"""
+Общая подготовка тестов. config.py не хранится в репозитории; если его нет, подставляется конфигурация с тестовыми значениями,
+чтобы модули приложения импортировались без настоящих ключей платежных систем. В обоих случаях приложение работает
+с хранилищем в памяти, заполненным тестовыми платежными системами, и без записи трассировок на диск.
+"""
+import os
+import sys
+import types
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+try:
+    import config
+except ImportError:
+    config = types.ModuleType("config")
+    config.__dict__.update(
+        MYSQL_HOST="", MYSQL_USER="", MYSQL_PASSWORD="", MYSQL_DATABASE="",
+        AUTH_TOKEN="test-token",
+        CHOOSE_METHOD_URL="https://example.com/payment/{}",
+        SUCCESS_URL="https://example.com/success",
+        FAILED_URL="https://example.com/failed",
+        AAIO_API_KEY="aaio-api-key", AAIO_SHOP_ID="aaio-shop", AAIO_KEY1="aaio-key1", AAIO_KEY2="aaio-key2",
+        LAVA_SECRET_KEY="", LAVA_SHOP_ID="", LAVA_WEBHOOK_URL="",
+        ENOT_SHOP_ID="", ENOT_SECRET_KEY="", ENOT_WEBHOOK_URL="",
+        NICEPAY_MERCHANT_ID="nicepay-merchant", NICEPAY_SECRET_KEY="nicepay-secret",
+        PALLY_SHOP_ID="pally-shop", PALLY_SECRET_KEY="pally-secret",
+    )
+    sys.modules["config"] = config
+
+config.DEBUG = True
+config.STORAGE_ENGINE = "memory"
+config.TRACING_ENABLED = False
+config.LOOP_WATCHDOG_ENABLED = False
+config.STORAGE_PAYMENT_METHODS = [
+    {"method_id": "enot", "name": "Enot", "description": "Карты, СБП", "icon_url": "https://example.com/enot.png", "instructions": None},
+    {"method_id": "pally", "name": "Pally", "description": "Карты", "icon_url": "https://example.com/pally.png", "instructions": None},
+    {"method_id": "manual", "name": "Перевод", "description": "", "icon_url": "https://example.com/manual.png",
+     "instructions": "Инструкция по оплате", "delegate_url": "https://example.com/manual"},
+]
@@ -0,0 +1,130 @@
+"""
+HTTP API приложения (main.py). Приложение запускается один раз на модуль: при остановке закрываются
+общие для всех тестов сессии и поток записи логов.
+"""
+import asyncio
+import hashlib
+import time
+
+import pytest
+from fastapi.testclient import TestClient
+
+from ranking import MethodRanking
+
+
+@pytest.fixture(scope="module")
+def main():
+    import main
+    return main
+
+
+@pytest.fixture(scope="module")
+def client(main):
+    with TestClient(main.app) as client:
+        yield client
+
+
+def get_method_ids(response) -> list[str]:
+    assert response.status_code == 200
+    return [method["id"] for method in response.json()]
+
+
+def test_methods_default_order(client):
+    assert get_method_ids(client.get("/payment_service/methods")) == ["enot", "pally", "manual"]
+
+
+def test_methods_score_order(main, client, monkeypatch):
+    ranking = MethodRanking()
+    monkeypatch.setattr(main.invoice_manager, "_ranking", ranking)
+    for _ in range(10):
+        ranking.record("manual", True, 0.1)
+        ranking.record("enot", False, 5)
+
+    assert get_method_ids(client.get("/payment_service/methods", params={"order_by": "score"})) == ["manual", "pally", "enot"]
+    # статистика не влияет на порядок по умолчанию
+    assert get_method_ids(client.get("/payment_service/methods")) == ["enot", "pally", "manual"]
+
+
+def create_invoice(client, main, **headers):
+    return client.post("/payment_service/create_invoice", headers=headers,
+                       json={"user_token": main.config.AUTH_TOKEN, "amount": 100, "comment": "Пополнение баланса"})
+
+
+def test_create_invoice_idempotency_key(main, client):
+    first = create_invoice(client, main, **{"Idempotency-Key": "order-1"})
+    repeated = create_invoice(client, main, **{"Idempotency-Key": "order-1"})
+    assert first.status_code == repeated.status_code == 200
+    assert first.json() == repeated.json()
+
+    assert create_invoice(client, main, **{"Idempotency-Key": "order-2"}).json()["id"] != first.json()["id"]
+    assert create_invoice(client, main).json()["id"] != create_invoice(client, main).json()["id"]
+    assert create_invoice(client, main, **{"Idempotency-Key": "k" * 65}).status_code == 422
+
+    other_amount = client.post("/payment_service/create_invoice", headers={"Idempotency-Key": "order-1"},
+                               json={"user_token": main.config.AUTH_TOKEN, "amount": 200, "comment": "Пополнение баланса"})
+    assert other_amount.status_code == 422
+
+
+def test_methods_etag(main, client):
+    response = client.get("/payment_service/methods")
+    etag = response.headers["ETag"]
+    assert response.headers["Cache-Control"] == "no-cache"
+
+    for if_none_match in (etag, f"W/{etag}", f'"other", {etag}', "*"):
+        not_modified = client.get("/payment_service/methods", headers={"If-None-Match": if_none_match})
+        assert (not_modified.status_code, not_modified.content, not_modified.headers["ETag"]) == (304, b"", etag)
+    assert client.get("/payment_service/methods", headers={"If-None-Match": '"other"'}).status_code == 200
+
+    method = main.database.PaymentMethod("nicepay", "Nicepay", "", "https://example.com/nicepay.png", None)
+    asyncio.run(main.db.engine.save_payment_method_async(method))
+    try:
+        assert client.post("/payment_service/methods/invalidate", params={"user_token": main.config.AUTH_TOKEN}).status_code == 200
+        changed = client.get("/payment_service/methods", headers={"If-None-Match": etag})
+        assert changed.status_code == 200
+        assert changed.headers["ETag"] != etag
+        assert get_method_ids(changed)[-1] == "nicepay"
+    finally:
+        main.db.engine._payment_methods.pop("nicepay")
+        main.db.invalidate_payment_methods_cache()
+
+
+class RecordingEngine:
+    """
+    Пропускает обращения к хранилищу, запоминая имена вызванных методов.
+    """
+
+    def __init__(self, engine):
+        self.engine = engine
+        self.calls = []
+
+    def __getattr__(self, name):
+        self.calls.append(name)
+        return getattr(self.engine, name)
+
+
+def wait_until_processed(main, processed: int, timeout: float = 2):
+    deadline = time.monotonic() + timeout
+    while main.webhook_ingestor.get_stats().processed < processed:
+        assert time.monotonic() < deadline, "webhook was not applied in time"
+        time.sleep(0.01)
+
+
+def test_pally_webhook_replay_skips_storage(main, client, monkeypatch):
+    invoice_id = create_invoice(client, main).json()["id"]
+    asyncio.run(main.db.engine.update_invoice_async(invoice_id, {"status": "processing", "payment_method": "pally",
+                                                                 "payment_method_invoice_id": "bill-1"}))
+    signature = hashlib.md5(f"100.00:{invoice_id}:{main.config.PALLY_SECRET_KEY}".encode()).hexdigest()
+    postback = {"InvId": invoice_id, "OutSum": "100.00", "Commission": "3.50", "TrsId": f"trs-{invoice_id}",
+                "Status": "SUCCESS", "SignatureValue": signature}
+
+    processed = main.webhook_ingestor.get_stats().processed
+    assert client.post("/payment_service/pally_webhook", data=postback).status_code == 200
+    wait_until_processed(main, processed + 1)
+
+    engine = RecordingEngine(main.db.engine)
+    monkeypatch.setattr(main.db, "_engine", engine)
+    stats = main.webhook_ingestor.get_stats()
+    assert client.post("/payment_service/pally_webhook", data=postback).json() == {"success": True}
+
+    assert engine.calls == []
+    assert main.webhook_ingestor.get_stats() == stats    # повтор не попал в очередь обработчиков
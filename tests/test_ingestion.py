@@ -0,0 +1,159 @@
+"""
+Прием вебхуков платежных систем (ingestion.WebhookIngestor): принятое событие не должно теряться
+ни при временных ошибках, ни при недоступности БД, ни при остановке процесса.
+"""
+import asyncio
+import datetime
+
+from apis.base import WebhookEvent
+from db import DatabaseManager, InvoiceStatus
+from ingestion import WebhookIngestor
+from invoice_manager import InvalidInvoiceError
+from storage import create_engine
+from storage.memory import MemoryEngine
+
+
+class FakeInvoiceManager:
+    """
+    Запоминает примененные события; первые failures попыток завершаются ошибкой error.
+    """
+
+    def __init__(self, failures: int = 0, error: type[Exception] = ConnectionError):
+        self.failures = failures
+        self.error = error
+        self.attempts = 0
+        self.applied = []
+
+    async def _apply_async(self, invoice_id: str, status: InvoiceStatus, **values):
+        self.attempts += 1
+        if self.failures > 0:
+            self.failures -= 1
+            raise self.error(invoice_id)
+        self.applied.append((invoice_id, status, values))
+
+    async def set_invoice_payed_async(self, invoice_id: str, credited: float | None = None, **kwargs):
+        await self._apply_async(invoice_id, InvoiceStatus.SUCCESS, credited=credited, **kwargs)
+
+    async def set_invoice_status_async(self, invoice_id: str, status: InvoiceStatus, **kwargs):
+        await self._apply_async(invoice_id, status, **kwargs)
+
+
+class BrokenEngine(MemoryEngine):
+    """
+    Хранилище, в которое нельзя записать событие.
+    """
+
+    async def add_inbox_async(self, *args):
+        raise ConnectionError("database is unavailable")
+
+
+def make_ingestor(db: DatabaseManager, manager: FakeInvoiceManager, **options) -> WebhookIngestor:
+    options = {"workers": 2, "poll_interval": 0.01, "retry_delay": 0} | options
+    return WebhookIngestor(db, manager, lambda: None, **options)
+
+
+def make_event(invoice_id: str, status: InvoiceStatus = InvoiceStatus.SUCCESS) -> WebhookEvent:
+    return WebhookEvent("pally", invoice_id, status, 97.5, datetime.datetime(2024, 1, 15, 12, 30),
+                        payment_method_invoice_id=f"trs-{invoice_id}", transaction_id=f"trs-{invoice_id}")
+
+
+async def wait_for(condition, timeout: float = 2):
+    deadline = asyncio.get_running_loop().time() + timeout
+    while not condition():
+        assert asyncio.get_running_loop().time() < deadline, "condition was not met in time"
+        await asyncio.sleep(0.005)
+
+
+def test_transient_errors_are_retried_without_limit():
+    async def run_async():
+        db = DatabaseManager(create_engine("memory"))
+        manager = FakeInvoiceManager(failures=12)
+        ingestor = make_ingestor(db, manager)
+        await ingestor.start_async()
+
+        assert ingestor.submit(make_event("inv-1"))
+        await wait_for(lambda: manager.applied)
+        await ingestor.stop_async(1)
+
+        assert manager.attempts == 13
+        invoice_id, status, values = manager.applied[0]
+        assert (invoice_id, status, values["credited"], values["transaction_id"]) == ("inv-1", InvoiceStatus.SUCCESS, 97.5, "trs-inv-1")
+        assert values["payed"] == datetime.datetime(2024, 1, 15, 12, 30)
+        stats = ingestor.get_stats()
+        assert (stats.processed, stats.retried, stats.failed) == (1, 12, 0)
+        assert await db.claim_inbox_async(10, 60) == []
+
+    asyncio.run(run_async())
+
+
+def test_full_queue_rejects_events():
+    async def run_async():
+        db = DatabaseManager(create_engine("memory"))
+        manager = FakeInvoiceManager()
+        ingestor = make_ingestor(db, manager, queue_size=1)
+
+        # обработчики еще не запущены: первое событие занимает очередь, второе отклоняется, и платежная система его повторит
+        assert ingestor.submit(make_event("inv-1"))
+        assert not ingestor.submit(make_event("inv-2"))
+        await ingestor.start_async()
+        await wait_for(lambda: manager.applied)
+        await ingestor.stop_async(1)
+
+        assert [invoice_id for invoice_id, *_ in manager.applied] == ["inv-1"]
+        assert ingestor.get_stats().rejected == 1
+
+    asyncio.run(run_async())
+
+
+def test_events_survive_shutdown():
+    async def run_async():
+        db = DatabaseManager(create_engine("memory"))
+        stopped = make_ingestor(db, FakeInvoiceManager())
+        assert stopped.submit(make_event("inv-1"))
+        await stopped.stop_async(0.01)    # обработчики так и не были запущены
+
+        manager = FakeInvoiceManager()
+        restarted = make_ingestor(db, manager)
+        await restarted.start_async()
+        await wait_for(lambda: manager.applied)
+        await restarted.stop_async(1)
+
+        assert [invoice_id for invoice_id, *_ in manager.applied] == ["inv-1"]
+
+    asyncio.run(run_async())
+
+
+def test_unrecoverable_event_is_kept_as_failed():
+    async def run_async():
+        engine = create_engine("memory")
+        db = DatabaseManager(engine)
+        manager = FakeInvoiceManager(failures=100, error=InvalidInvoiceError)
+        ingestor = make_ingestor(db, manager)
+        await ingestor.start_async()
+
+        assert ingestor.submit(make_event("missing"))
+        await wait_for(lambda: ingestor.get_stats().failed)
+        await asyncio.sleep(0.05)
+        await ingestor.stop_async(1)
+
+        assert manager.attempts == 1
+        assert await db.claim_inbox_async(10, 60) == []
+        assert [entry["status"] for entry in engine._inbox.values()] == ["failed"]
+
+    asyncio.run(run_async())
+
+
+def test_retries_in_memory_when_inbox_is_unavailable():
+    async def run_async():
+        manager = FakeInvoiceManager(failures=2)
+        ingestor = make_ingestor(DatabaseManager(BrokenEngine()), manager)
+        await ingestor.start_async()
+
+        assert ingestor.submit(make_event("inv-1"))
+        await wait_for(lambda: manager.applied)
+        await ingestor.stop_async(1)
+
+        assert manager.attempts == 3
+        assert ingestor.get_stats().queued == 0
+
+    asyncio.run(run_async())
@@ -0,0 +1,227 @@
+"""
+Изменение статусов счетов через InvoiceManager. Каждый тест работает с отдельным хранилищем в памяти;
+несколько процессов приложения моделируются несколькими InvoiceManager со своими DatabaseManager над общим хранилищем.
+"""
+import asyncio
+import datetime
+
+import pytest
+
+from apis.base import ProviderAdapter, BillInfo, ProviderError
+from apis.pally import PallyAdapter
+from circuit import CircuitBreakers, CircuitBreakerSettings, CircuitState
+from db import DatabaseManager, InvoiceStatus, InvoiceInfo, PaymentMethod
+from invoice_manager import InvoiceManager, InvalidInvoiceStatusError, IdempotencyKeyReusedError, PaymentSystemError
+from providers import ProviderRegistry
+from storage import create_engine, StorageEngine, INVOICE_COLUMNS
+
+PALLY_POSTBACK = {
+    "OutSum": "100.00",
+    "Commission": "3.50",
+    "TrsId": "trs-1",
+    "Status": "SUCCESS",
+    "SignatureValue": "0" * 32,
+}
+
+
+class FakeAdapter(ProviderAdapter):
+    method_id = "fake"
+
+    def __init__(self, sessions):
+        super().__init__(sessions)
+        self.bills = []
+
+    async def create_bill(self, invoice_info: InvoiceInfo) -> BillInfo:
+        self.bills.append(invoice_info.invoice_id)
+        return BillInfo(f"https://fake/pay/{len(self.bills)}", f"bill-{len(self.bills)}")
+
+    def parse_webhook(self, data: dict):
+        return None
+
+
+class FailingAdapter(FakeAdapter):
+    """
+    Отказывает в создании счета; transient - как ошибка 5xx, иначе как отказ по существу запроса.
+    """
+    method_id = "failing"
+    transient = False
+
+    async def create_bill(self, invoice_info: InvoiceInfo) -> BillInfo:
+        raise ProviderError(self.method_id, transient=self.transient)
+
+
+def make_manager(engine: StorageEngine, breakers: CircuitBreakers | None = None) -> InvoiceManager:
+    db = DatabaseManager(engine)
+    providers = ProviderRegistry(db, None, {"fake": f"{__name__}:FakeAdapter", "failing": f"{__name__}:FailingAdapter",
+                                            "pally": "apis.pally:PallyAdapter"})
+    return InvoiceManager(db, providers, breakers or CircuitBreakers(CircuitBreakerSettings()))
+
+
+def get_value(row: tuple, column: str):
+    return row[INVOICE_COLUMNS.index(column)]
+
+
+async def create_pally_invoice_async(manager: InvoiceManager, engine: StorageEngine) -> str:
+    """
+    Создает счет, выставленный в pally: в payment_method_invoice_id записан айди счета в pally, а не транзакции.
+    """
+    invoice = await manager.create_invoice_async(100, "Пополнение баланса", '{"user": 1}', "https://example.com/webhook")
+    await engine.update_invoice_async(invoice.invoice_id, {"status": "processing", "payment_method": "pally",
+                                                           "payment_method_invoice_id": "bill-1"})
+    return invoice.invoice_id
+
+
+async def apply_pally_postback_async(manager: InvoiceManager, invoice_id: str, **values):
+    event = PallyAdapter(None).parse_webhook(dict(PALLY_POSTBACK, InvId=invoice_id, **values))
+    await manager.set_invoice_payed_async(event.invoice_id, event.credited, payment_method_invoice_id=event.payment_method_invoice_id,
+                                          method_id=event.method_id, transaction_id=event.transaction_id)
+
+
+def test_replay_is_ignored():
+    async def run_async():
+        engine = create_engine("memory")
+        manager = make_manager(engine)
+        invoice_id = await create_pally_invoice_async(manager, engine)
+
+        await apply_pally_postback_async(manager, invoice_id)
+        await apply_pally_postback_async(manager, invoice_id)
+
+        assert manager.get_dedupe_stats().hits == 1
+        row = await engine.get_invoice_row_async(invoice_id)
+        assert (get_value(row, "status"), get_value(row, "credited")) == ("success", 100.0)
+
+    asyncio.run(run_async())
+
+
+def test_pally_replay_in_another_process_is_ignored():
+    async def run_async():
+        engine = create_engine("memory")
+        worker_1, worker_2 = make_manager(engine), make_manager(engine)
+        invoice_id = await create_pally_invoice_async(worker_1, engine)
+
+        await apply_pally_postback_async(worker_1, invoice_id)
+        # второй процесс не видел первый вебхук: повтор распознается только по счету в БД
+        await apply_pally_postback_async(worker_2, invoice_id)
+
+        assert worker_2.get_dedupe_stats().hits == 0
+        assert get_value(await engine.get_invoice_row_async(invoice_id), "status") == "success"
+
+    asyncio.run(run_async())
+
+
+def test_second_payment_is_not_a_replay():
+    async def run_async():
+        engine = create_engine("memory")
+        worker_1, worker_2 = make_manager(engine), make_manager(engine)
+        invoice_id = await create_pally_invoice_async(worker_1, engine)
+
+        await apply_pally_postback_async(worker_1, invoice_id)
+        with pytest.raises(InvalidInvoiceStatusError):
+            await apply_pally_postback_async(worker_2, invoice_id, TrsId="trs-2")
+
+    asyncio.run(run_async())
+
+
+def test_process_invoice_processed_by_another_process():
+    async def run_async():
+        engine = create_engine("memory")
+        await engine.save_payment_method_async(PaymentMethod("fake", "Fake", "", "https://icons/fake.png", None))
+        worker_1, worker_2 = make_manager(engine), make_manager(engine)
+        invoice = await worker_1.create_invoice_async(100, "Пополнение баланса", "{}", "")
+        await worker_2._db_manager.get_invoice_info_async(invoice.invoice_id)    # в кеше второго процесса счет еще не обработан
+
+        await worker_1.process_invoice_async(invoice.invoice_id, "fake")
+        with pytest.raises(InvalidInvoiceStatusError):
+            await worker_2.process_invoice_async(invoice.invoice_id, "fake")
+
+        # второй процесс не должен создавать счет в платежной системе
+        assert (await worker_2._providers.get_async("fake")).bills == []
+        row = await engine.get_invoice_row_async(invoice.invoice_id)
+        assert (get_value(row, "status"), get_value(row, "payment_method_invoice_id")) == ("processing", "bill-1")
+
+    asyncio.run(run_async())
+
+
+def test_conflicting_status_change():
+    async def run_async():
+        engine = create_engine("memory")
+        worker_1, worker_2 = make_manager(engine), make_manager(engine)
+        invoice_id = await create_pally_invoice_async(worker_1, engine)
+        await worker_2._db_manager.get_invoice_info_async(invoice_id)
+
+        await worker_1.set_invoice_status_async(invoice_id, InvoiceStatus.ERROR, method_id="pally", transaction_id="trs-1")
+        with pytest.raises(InvalidInvoiceStatusError) as exc_info:
+            await apply_pally_postback_async(worker_2, invoice_id)
+
+        assert exc_info.value.invoice_status == InvoiceStatus.ERROR
+        assert get_value(await engine.get_invoice_row_async(invoice_id), "status") == "error"
+
+    asyncio.run(run_async())
+
+
+def test_expired_invoice_is_evicted_from_cache():
+    async def run_async():
+        manager = make_manager(create_engine("memory"))
+        invoice = await manager.create_invoice_async(100, "Пополнение баланса", "{}", "")
+        db = manager._db_manager
+
+        assert await db.expire_invoices_async(InvoiceStatus.CREATED, datetime.datetime.now() + datetime.timedelta(seconds=1), 10) == 1
+        assert (await db.get_invoice_info_async(invoice.invoice_id)).status == InvoiceStatus.TIMEOUT
+
+    asyncio.run(run_async())
+
+
+def test_create_invoice_idempotency_across_processes():
+    async def run_async():
+        engine = create_engine("memory")
+        worker_1, worker_2 = make_manager(engine), make_manager(engine)
+
+        first = await worker_1.create_invoice_async(100, "Пополнение баланса", "{}", "", idempotency_key="key-1")
+        repeated = await worker_1.create_invoice_async(100, "Пополнение баланса", "{}", "", idempotency_key="key-1")
+        # второй процесс не знает ключа и находит счет в БД
+        other_process = await worker_2.create_invoice_async(100, "Пополнение баланса", "{}", "", idempotency_key="key-1")
+        other_key = await worker_2.create_invoice_async(100, "Пополнение баланса", "{}", "", idempotency_key="key-2")
+
+        assert first.invoice_id == repeated.invoice_id == other_process.invoice_id
+        assert other_key.invoice_id != first.invoice_id
+        assert get_value(await engine.get_invoice_row_by_idempotency_key_async("key-1"), "invoice_id") == first.invoice_id
+
+    asyncio.run(run_async())
+
+
+def test_idempotency_key_reused_with_other_parameters():
+    async def run_async():
+        engine = create_engine("memory")
+        worker_1, worker_2 = make_manager(engine), make_manager(engine)
+        first = await worker_1.create_invoice_async(100, "Пополнение баланса", "{}", "", idempotency_key="key-1")
+
+        for worker in (worker_1, worker_2):
+            with pytest.raises(IdempotencyKeyReusedError):
+                await worker.create_invoice_async(200, "Пополнение баланса", "{}", "", idempotency_key="key-1")
+            with pytest.raises(IdempotencyKeyReusedError):
+                await worker.create_invoice_async(100, "Пополнение баланса", "{}", "https://example.com/webhook", idempotency_key="key-1")
+
+        repeated = await worker_2.create_invoice_async(100, "Пополнение баланса", "{}", "", idempotency_key="key-1")
+        assert repeated.invoice_id == first.invoice_id
+
+    asyncio.run(run_async())
+
+
+def test_only_provider_failures_open_circuit():
+    async def run_async():
+        engine = create_engine("memory")
+        await engine.save_payment_method_async(PaymentMethod("failing", "Failing", "", "https://icons/failing.png", None))
+        breakers = CircuitBreakers(CircuitBreakerSettings(min_requests=3))
+        manager = make_manager(engine, breakers)
+        adapter = await manager._providers.get_async("failing")
+
+        # отказы по существу запроса учитываются как ответы платежной системы, а не ее неисправность
+        for transient, state in ((False, CircuitState.CLOSED), (True, CircuitState.OPEN)):
+            adapter.transient = transient
+            for _ in range(3):
+                invoice = await manager.create_invoice_async(100, "Пополнение баланса", "{}", "")
+                with pytest.raises(PaymentSystemError):
+                    await manager.process_invoice_async(invoice.invoice_id, "failing")
+            assert breakers.get("failing").state == state
+
+    asyncio.run(run_async())
@@ -0,0 +1,26 @@
+"""
+Логирование через очередь и поток записи (log_config).
+"""
+import json
+import logging
+
+from log_config import setup_logging
+
+
+def test_arguments_are_formatted_by_listener(tmp_path):
+    logger = logging.getLogger("test_log_config")
+    listener = setup_logging(logger, file_path=str(tmp_path / "service.log"), console=False)
+    try:
+        # в очередь попадает запись с аргументами, сообщение формирует поток записи
+        record = logger.handlers[0].prepare(logger.makeRecord(logger.name, logging.INFO, __file__, 0, "[%s] status=%s", ("inv-1", "created"), None))
+        assert (record.msg, record.args) == ("[%s] status=%s", ("inv-1", "created"))
+
+        logger.info("Invoice: [%s] status=%s", "inv-1", "created")
+    finally:
+        listener.stop()
+        logger.handlers.clear()
+
+    with open(tmp_path / "service.log", encoding="utf-8") as f:
+        record = json.loads(f.readline())
+    assert record["message"] == "Invoice: [inv-1] status=created"
+    assert not logger.propagate
@@ -0,0 +1,37 @@
+"""
+Реестр адаптеров платежных систем и разбор вебхуков адаптерами.
+"""
+import asyncio
+
+import pytest
+
+from db import DatabaseManager, PaymentMethod
+from providers import ProviderRegistry
+from storage import create_engine
+
+
+def test_disabled_method_still_accepts_webhooks():
+    async def run_async():
+        engine = create_engine("memory")
+        await engine.save_payment_method_async(PaymentMethod("enot", "Enot", "", "https://icons/enot.png", None))
+        registry = ProviderRegistry(DatabaseManager(engine), None, {"enot": "apis.enot:EnotAdapter", "pally": "apis.pally:PallyAdapter"})
+
+        assert (await registry.get_async("enot")).method_id == "enot"
+        assert await registry.get_async("pally") is None
+        assert (await registry.get_async("pally", require_enabled=False)).method_id == "pally"
+        assert await registry.get_async("pally") is None    # загруженный для вебхука адаптер не включает создание счетов
+        assert await registry.get_async("unknown", require_enabled=False) is None
+
+    asyncio.run(run_async())
+
+
+def test_aaio_webhook_without_required_fields():
+    pytest.importorskip("AaioAsync")
+    from apis.aaio import AaioAdapter
+
+    adapter = AaioAdapter(None)
+    data = {"order_id": "inv-1", "profit": "97.50", "invoice_id": "aaio-1", "amount": "100.00", "currency": "RUB"}
+    assert adapter.parse_webhook(data).transaction_id == "aaio-1"
+    for key in ("order_id", "profit", "invoice_id"):
+        with pytest.raises(ValueError):
+            adapter.parse_webhook({k: v for k, v in data.items() if k != key})
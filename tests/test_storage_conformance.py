@@ -0,0 +1,322 @@
+"""
+Общие проверки для всех движков хранилища (storage). Новый движок добавляется в ENGINES и должен проходить все тесты.
+Запуск: python -m pytest tests
+MySQL проверяется, только если задана переменная окружения STORAGE_TEST_MYSQL_DATABASE - пустая БД,
+все данные в которой будут удалены; доступ берется из config.py (MYSQL_HOST, MYSQL_USER, MYSQL_PASSWORD).
+"""
+import asyncio
+import datetime
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from storage import create_engine, INVOICE_COLUMNS, ColumnRef, PaymentMethod, DuplicateInvoiceError, \
+    InsertInvoice, UpdateInvoice, TransitionInvoice
+
+NOW = datetime.datetime.now().replace(microsecond=0)    # MySQL DATETIME хранит время с точностью до секунды
+
+
+@pytest.fixture(params=["memory", "sqlite", "mysql"])
+def make_engine(request, tmp_path):
+    match request.param:
+        case "sqlite":
+            pytest.importorskip("aiosqlite")
+            options = {"path": str(tmp_path / "storage.db")}
+        case "mysql":
+            db_name = os.environ.get("STORAGE_TEST_MYSQL_DATABASE")
+            if not db_name:
+                pytest.skip("STORAGE_TEST_MYSQL_DATABASE is not set")
+            pytest.importorskip("aiomysql")
+            import config
+            options = {"host": config.MYSQL_HOST, "user": config.MYSQL_USER, "password": config.MYSQL_PASSWORD, "db_name": db_name}
+        case _:
+            options = {}
+    return lambda: create_engine(request.param, **options)
+
+
+def conformance(test):
+    """
+    Выполняет асинхронный тест test(engine) на чистом хранилище каждого движка.
+    """
+    async def run_async(make_engine):
+        engine = make_engine()
+        await engine.connect_async()
+        try:
+            await engine.create_tables_async()
+            if engine.__class__.__name__ == "MySQLEngine":
+                async with engine._get_connection() as conn:
+                    async with conn.cursor() as cur:
+                        for table in ("invoices", "payment_methods", "webhook_outbox", "webhook_inbox"):
+                            await cur.execute(f"DELETE FROM {table};")
+            await test(engine)
+        finally:
+            await engine.close_async()
+
+    def wrapper(make_engine):
+        asyncio.run(run_async(make_engine))
+
+    wrapper.__name__ = test.__name__
+    wrapper.__doc__ = test.__doc__
+    return wrapper
+
+
+def make_row(invoice_id: str, **values) -> tuple:
+    row = {
+        "invoice_id": invoice_id,
+        "status": "created",
+        "amount": 100.0,
+        "credited": 0.0,
+        "created": NOW,
+        "payed": None,
+        "comment": "Пополнение баланса",
+        "custom_fields": '{"user": 1}',
+        "webhook_url": "https://example.com/webhook",
+        "payment_method": None,
+        "payment_url": "",
+        "payment_method_invoice_id": None,
+        "idempotency_key": None,
+    } | values
+    return tuple(row[column] for column in INVOICE_COLUMNS)
+
+
+def get_value(row: tuple, column: str):
+    return row[INVOICE_COLUMNS.index(column)]
+
+
+@conformance
+async def test_insert_and_get(engine):
+    row = make_row("inv-1", payed=NOW, payment_method="enot", payment_method_invoice_id="enot-1", idempotency_key="key-1")
+    await engine.insert_invoice_async(row)
+
+    assert await engine.get_invoice_row_async("inv-1") == row
+    assert await engine.get_invoice_row_by_idempotency_key_async("key-1") == row
+    assert await engine.get_invoice_row_by_provider_id_async("enot", "enot-1") == row
+    assert await engine.get_invoice_row_async("missing") is None
+    assert await engine.get_invoice_row_by_idempotency_key_async("missing") is None
+    assert await engine.get_invoice_row_by_provider_id_async("pally", "enot-1") is None
+
+
+@conformance
+async def test_insert_duplicate(engine):
+    await engine.insert_invoice_async(make_row("inv-1", idempotency_key="key-1"))
+    await engine.insert_invoice_async(make_row("inv-2"))
+    await engine.insert_invoice_async(make_row("inv-3"))    # счета без ключа не конфликтуют между собой
+
+    with pytest.raises(DuplicateInvoiceError):
+        await engine.insert_invoice_async(make_row("inv-1"))
+    with pytest.raises(DuplicateInvoiceError):
+        await engine.insert_invoice_async(make_row("inv-4", idempotency_key="key-1"))
+    assert await engine.get_invoice_row_async("inv-4") is None
+
+
+@conformance
+async def test_insert_many(engine):
+    rows = [make_row(f"inv-{i}") for i in range(3)]
+    await engine.insert_invoices_async(rows)
+    assert [await engine.get_invoice_row_async(f"inv-{i}") for i in range(3)] == rows
+
+    # конфликт одного счета отменяет вставку всех
+    with pytest.raises(DuplicateInvoiceError):
+        await engine.insert_invoices_async([make_row("inv-3"), make_row("inv-1")])
+    with pytest.raises(DuplicateInvoiceError):
+        await engine.insert_invoices_async([make_row("inv-4", idempotency_key="key-1"), make_row("inv-5", idempotency_key="key-1")])
+    for invoice_id in ("inv-3", "inv-4", "inv-5"):
+        assert await engine.get_invoice_row_async(invoice_id) is None
+
+
+@conformance
+async def test_update(engine):
+    await engine.insert_invoice_async(make_row("inv-1"))
+    await engine.update_invoice_async("inv-1", {"payment_url": "https://pay/1", "payed": NOW})
+
+    row = await engine.get_invoice_row_async("inv-1")
+    assert get_value(row, "payment_url") == "https://pay/1"
+    assert get_value(row, "payed") == NOW
+    assert get_value(row, "status") == "created"
+
+
+@conformance
+async def test_transition(engine):
+    await engine.insert_invoice_async(make_row("inv-1"))
+
+    assert not await engine.transition_invoice_async("inv-1", ["processing"], "success", {}, False, False)
+    assert await engine.transition_invoice_async("inv-1", ["created"], "processing",
+                                                 {"payment_method": "enot"}, True, False)
+    # платежная система уже выбрана
+    assert not await engine.transition_invoice_async("inv-1", ["processing"], "processing",
+                                                     {"payment_method": "pally"}, True, False)
+    assert await engine.transition_invoice_async("inv-1", ["created", "processing"], "success",
+                                                 {"credited": ColumnRef("amount"), "payed": NOW}, False, False)
+    assert not await engine.transition_invoice_async("missing", ["created"], "success", {}, False, False)
+
+    row = await engine.get_invoice_row_async("inv-1")
+    assert get_value(row, "status") == "success"
+    assert get_value(row, "payment_method") == "enot"
+    assert get_value(row, "credited") == 100.0
+    assert get_value(row, "payed") == NOW
+
+
+@conformance
+async def test_transition_enqueues_webhook(engine):
+    await engine.insert_invoice_async(make_row("inv-1", amount=150.5))
+    await engine.insert_invoice_async(make_row("inv-2", webhook_url=""))
+
+    assert not await engine.transition_invoice_async("inv-1", ["processing"], "success", {}, False, True)
+    assert (await engine.get_outbox_backlog_async()).pending == 0
+
+    assert await engine.transition_invoice_async("inv-1", ["created"], "success", {}, False, True)
+    assert await engine.transition_invoice_async("inv-2", ["created"], "success", {}, False, True)    # без webhook_url
+
+    backlog = await engine.get_outbox_backlog_async()
+    assert (backlog.pending, backlog.due) == (1, 1)
+    assert backlog.oldest_created is not None
+
+    entries = await engine.claim_outbox_async(10, 60)
+    assert len(entries) == 1
+    entry = entries[0]
+    assert (entry.invoice_id, entry.url, entry.attempts) == ("inv-1", "https://example.com/webhook", 1)
+    assert entry.payload == {"invoice_id": "inv-1", "sum": 150.5, "comment": "Пополнение баланса", "custom_field": '{"user": 1}'}
+
+
+@conformance
+async def test_outbox_lifecycle(engine):
+    for i in range(3):
+        await engine.insert_invoice_async(make_row(f"inv-{i}"))
+        await engine.transition_invoice_async(f"inv-{i}", ["created"], "success", {}, False, True)
+
+    first = await engine.claim_outbox_async(2, 60)
+    assert len(first) == 2
+    rest = await engine.claim_outbox_async(10, 60)    # забранные записи не выдаются повторно до истечения аренды
+    assert len(rest) == 1
+    assert await engine.claim_outbox_async(10, 60) == []
+    assert (await engine.get_outbox_backlog_async()).due == 0
+
+    await engine.mark_outbox_delivered_async(first[0].id)
+    await engine.reschedule_outbox_async(first[1].id, 0, "HTTP 500", give_up=False)
+    await engine.release_outbox_async(rest[0].id)
+    await engine.release_outbox_async(first[0].id)    # доставленная запись в очередь не возвращается
+
+    again = sorted(await engine.claim_outbox_async(10, 60), key=lambda e: e.id)
+    assert [(e.id, e.attempts) for e in again] == sorted([(first[1].id, 2), (rest[0].id, 1)])
+
+    await engine.reschedule_outbox_async(first[1].id, 0, "HTTP 500", give_up=True)
+    await engine.reschedule_outbox_async(rest[0].id, 3600, "HTTP 500", give_up=False)
+    assert await engine.claim_outbox_async(10, 60) == []
+
+    backlog = await engine.get_outbox_backlog_async()
+    assert (backlog.pending, backlog.due) == (1, 0)
+
+
+@conformance
+async def test_execute_writes(engine):
+    await engine.insert_invoice_async(make_row("inv-0", idempotency_key="key-0"))
+
+    results = await engine.execute_writes_async([
+        InsertInvoice(make_row("inv-1")),
+        InsertInvoice(make_row("inv-2", idempotency_key="key-0")),    # конфликт не должен отменить соседние вставки
+        InsertInvoice(make_row("inv-3")),
+        UpdateInvoice("inv-1", {"payment_url": "https://pay/1"}),
+        UpdateInvoice("inv-3", {"payment_url": "https://pay/3"}),
+        TransitionInvoice("inv-1", ["created"], "success", {"credited": ColumnRef("amount")}, enqueue_webhook=True),
+        TransitionInvoice("inv-1", ["created"], "error", {}),
+        TransitionInvoice("inv-2", ["created"], "error", {}),
+    ])
+
+    assert [r if not isinstance(r, Exception) else type(r) for r in results] == \
+           [None, DuplicateInvoiceError, None, None, None, True, False, False]
+    assert await engine.get_invoice_row_async("inv-2") is None
+    inv_1 = await engine.get_invoice_row_async("inv-1")
+    assert (get_value(inv_1, "status"), get_value(inv_1, "credited"), get_value(inv_1, "payment_url")) == ("success", 100.0, "https://pay/1")
+    assert get_value(await engine.get_invoice_row_async("inv-3"), "payment_url") == "https://pay/3"
+    assert (await engine.get_outbox_backlog_async()).pending == 1
+
+
+@conformance
+async def test_rows_by_status(engine):
+    # несколько счетов с одинаковым временем создания проверяют продолжение обхода внутри одной секунды
+    for i in range(5):
+        await engine.insert_invoice_async(make_row(f"inv-{i}", created=NOW - datetime.timedelta(seconds=10 if i < 3 else i)))
+    await engine.insert_invoice_async(make_row("inv-new", created=NOW + datetime.timedelta(minutes=1)))
+    await engine.insert_invoice_async(make_row("inv-other", status="processing", created=NOW - datetime.timedelta(minutes=1)))
+
+    ids = []
+    after = (datetime.datetime.min, "")
+    while True:
+        rows = await engine.get_invoice_rows_by_status_async("created", NOW, after, 2)
+        ids += [row[0] for row in rows]
+        if len(rows) < 2:
+            break
+        after = (get_value(rows[-1], "created"), rows[-1][0])
+
+    assert ids == ["inv-0", "inv-1", "inv-2", "inv-4", "inv-3"]
+
+
+@conformance
+async def test_expire(engine):
+    old = NOW - datetime.timedelta(hours=1)
+    await engine.insert_invoice_async(make_row("inv-1", created=old - datetime.timedelta(minutes=3)))
+    await engine.insert_invoice_async(make_row("inv-2", created=old - datetime.timedelta(minutes=2), payment_method="enot"))
+    await engine.insert_invoice_async(make_row("inv-3", created=old - datetime.timedelta(minutes=1), payment_method="pally"))
+    await engine.insert_invoice_async(make_row("inv-4", created=NOW))
+    await engine.insert_invoice_async(make_row("inv-5", created=old, status="success"))
+
+    assert await engine.expire_invoices_async("created", "timeout", old, 1, None, []) == ["inv-1"]
+    assert await engine.expire_invoices_async("created", "timeout", old, 10, None, ["pally"]) == ["inv-2"]
+    assert await engine.expire_invoices_async("created", "timeout", old, 10, "enot", []) == []
+    assert await engine.expire_invoices_async("created", "timeout", old, 10, "pally", []) == ["inv-3"]
+
+    statuses = {f"inv-{i}": get_value(await engine.get_invoice_row_async(f"inv-{i}"), "status") for i in range(1, 6)}
+    assert statuses == {"inv-1": "timeout", "inv-2": "timeout", "inv-3": "timeout", "inv-4": "created", "inv-5": "success"}
+
+
+@conformance
+async def test_named_lock(engine):
+    async with engine.named_lock_async("sweeper") as acquired:
+        assert acquired
+        async with engine.named_lock_async("sweeper") as acquired_again:
+            assert not acquired_again
+        async with engine.named_lock_async("other") as other:
+            assert other
+
+    async with engine.named_lock_async("sweeper") as acquired:
+        assert acquired
+
+
+@conformance
+async def test_inbox(engine):
+    leased = await engine.add_inbox_async("pally", "inv-1", {"status": "success", "credited": 97.5}, 60)
+    pending = await engine.add_inbox_async("enot", "inv-2", {"status": "error"}, 0)
+
+    # событие, забранное при записи, скрыто от других воркеров до истечения аренды
+    entries = await engine.claim_inbox_async(10, 60)
+    assert [(e.id, e.method_id, e.invoice_id, e.payload, e.attempts) for e in entries] == [(pending, "enot", "inv-2", {"status": "error"}, 1)]
+    assert await engine.claim_inbox_async(10, 60) == []
+
+    await engine.reschedule_inbox_async(pending, 0, "ConnectionError()", False)
+    assert [(e.id, e.attempts) for e in await engine.claim_inbox_async(10, 60)] == [(pending, 2)]
+
+    await engine.release_inbox_async(pending)
+    await engine.release_inbox_async(leased)
+    assert sorted((e.id, e.attempts) for e in await engine.claim_inbox_async(10, 60)) == sorted([(leased, 1), (pending, 2)])
+
+    await engine.mark_inbox_processed_async(leased)
+    await engine.reschedule_inbox_async(pending, 0, "InvalidInvoiceError()", True)
+    await engine.release_inbox_async(leased)
+    await engine.release_inbox_async(pending)
+    assert await engine.claim_inbox_async(10, 60) == []
+
+
+@conformance
+async def test_payment_methods(engine):
+    assert await engine.get_payment_methods_async() == []
+
+    await engine.save_payment_method_async(PaymentMethod("enot", "Enot", "", "https://icons/enot.png", None))
+    await engine.save_payment_method_async(PaymentMethod("pally", "Pally", "Карты", "https://icons/pally.png", "Инструкция"))
+    await engine.save_payment_method_async(PaymentMethod("enot", "Enot.io", "", "https://icons/enot.png", None))
+
+    methods = sorted(await engine.get_payment_methods_async(), key=lambda m: m.method_id)
+    assert methods == [PaymentMethod("enot", "Enot.io", "", "https://icons/enot.png", None),
+                       PaymentMethod("pally", "Pally", "Карты", "https://icons/pally.png", "Инструкция")]
@@ -0,0 +1,61 @@
+"""
+Доставка вебхуков на сервер игры (webhooks.WebhookDispatcher).
+"""
+import asyncio
+import contextlib
+from urllib.parse import urlsplit
+
+from db import DatabaseManager, OutboxEntry
+from storage import create_engine
+from webhooks import WebhookDispatcher
+
+
+class FakeResponse:
+    status = 200
+
+
+class FakeSessions:
+    """
+    Вместо отправки запоминает хосты; запросы на хосты из blocked ждут, пока их не отпустят через release.
+    """
+
+    def __init__(self, blocked: set[str]):
+        self.blocked = blocked
+        self.release = asyncio.Event()
+        self.sent = []
+
+    def get(self, url: str):
+        return self
+
+    @contextlib.asynccontextmanager
+    async def post(self, url: str, **kwargs):
+        host = urlsplit(url).netloc
+        if host in self.blocked:
+            await self.release.wait()
+        self.sent.append(host)
+        yield FakeResponse()
+
+
+def test_busy_destination_does_not_block_others():
+    async def run_async():
+        sessions = FakeSessions({"slow.example.com"})
+        dispatcher = WebhookDispatcher(DatabaseManager(create_engine("memory")), sessions, "token",
+                                       workers=2, per_destination_limit=1, poll_interval=60)
+        for i, host in enumerate(["slow.example.com"] * 3 + ["fast.example.com"]):
+            dispatcher._queue.put_nowait(OutboxEntry(i, f"inv-{i}", f"https://{host}/webhook", {}, 1))
+        await dispatcher.start_async()
+
+        # один воркер ждет медленный хост, второй откладывает остальные вебхуки на него и отправляет на быстрый
+        for _ in range(100):
+            if sessions.sent:
+                break
+            await asyncio.sleep(0.005)
+        assert sessions.sent == ["fast.example.com"]
+        assert dispatcher.get_stats().queued == 2
+
+        sessions.release.set()
+        await dispatcher.stop_async(1)
+        assert sessions.sent == ["fast.example.com"] + ["slow.example.com"] * 3
+        assert dispatcher.get_stats().delivered == 4
+
+    asyncio.run(run_async())
@@ -0,0 +1,263 @@
+"""
+Трассировка запросов. Middleware присваивает запросу идентификатор (X-Request-Id) и открывает трассу,
+которая доступна через contextvar во всем коде, выполняемом в рамках запроса. Функции, помеченные traced_async,
+и блоки span() записывают в нее интервалы (спаны). Медленные трассы и случайная доля остальных пишутся в JSONL-файл.
+Без открытой трассы span() ничего не делает, поэтому фоновые задачи не платят за трассировку.
+"""
+import contextvars
+import datetime
+import functools
+import json
+import logging
+import queue
+import random
+import re
+import threading
+import time
+import uuid
+from dataclasses import dataclass, field, asdict
+from typing import Any
+
+import aiohttp
+from starlette.types import ASGIApp, Scope, Receive, Send, Message
+
+
+@dataclass
+class Span:
+    id: int
+    parent: int | None
+    name: str
+    start_ms: float    # от начала трассы
+    duration_ms: float = 0
+    attrs: dict[str, Any] = field(default_factory=dict)
+    error: str | None = None
+
+
+class Trace:
+
+    MAX_SPANS = 1000
+
+    trace_id: str
+    name: str
+    started: float
+    started_at: datetime.datetime
+    spans: list[Span]
+    dropped: int    # спаны, не записанные из-за MAX_SPANS
+
+    def __init__(self, trace_id: str, name: str):
+        self.trace_id = trace_id
+        self.name = name
+        self.started = time.perf_counter()
+        self.started_at = datetime.datetime.now()
+        self.spans = []
+        self.dropped = 0
+
+    def add_span(self, name: str, parent: int | None, started: float, attrs: dict[str, Any]) -> Span | None:
+        if len(self.spans) >= self.MAX_SPANS:
+            self.dropped += 1
+            return None
+        span = Span(len(self.spans) + 1, parent, name, (started - self.started) * 1000, attrs=attrs)
+        self.spans.append(span)
+        return span
+
+    def to_dict(self, duration: float, **extra) -> dict:
+        return {
+            "trace_id": self.trace_id,
+            "name": self.name,
+            "start": self.started_at.isoformat(),
+            "duration_ms": round(duration * 1000, 3),
+            **extra,
+            "dropped_spans": self.dropped,
+            "spans": [asdict(s) for s in self.spans],
+        }
+
+
+_current_trace: contextvars.ContextVar[Trace | None] = contextvars.ContextVar("current_trace", default=None)
+_current_span: contextvars.ContextVar[int | None] = contextvars.ContextVar("current_span", default=None)
+
+
+def get_trace_id() -> str | None:
+    """
+    Идентификатор текущего запроса (correlation id) или None вне запроса.
+    """
+    trace = _current_trace.get()
+    return trace.trace_id if trace is not None else None
+
+
+class span:
+    """
+    Записывает интервал выполнения блока with в текущую трассу. Вложенные спаны получают его как родителя.
+    """
+    __slots__ = ("_name", "_attrs", "_started", "_span", "_token")
+
+    @property
+    def item(self) -> Span | None:
+        """
+        Записываемый спан; None, если трасса не открыта.
+        """
+        return self._span
+
+    def __init__(self, name: str, **attrs):
+        self._name = name
+        self._attrs = attrs
+        self._span = None
+        self._token = None
+
+    def __enter__(self) -> Span | None:
+        trace = _current_trace.get()
+        if trace is None:
+            return None
+        self._started = time.perf_counter()
+        self._span = trace.add_span(self._name, _current_span.get(), self._started, self._attrs)
+        if self._span is not None:
+            self._token = _current_span.set(self._span.id)
+        return self._span
+
+    def __exit__(self, exc_type, exc, tb):
+        if self._span is None:
+            return
+        self._span.duration_ms = (time.perf_counter() - self._started) * 1000
+        if exc is not None:
+            self._span.error = repr(exc)
+        _current_span.reset(self._token)
+
+
+def traced_async(prefix: str):
+    """
+    Декоратор асинхронных функций: выполнение записывается спаном "<prefix>.<имя функции>".
+    """
+    def decorator(func):
+        name = f"{prefix}.{func.__name__}"
+
+        @functools.wraps(func)
+        async def wrapper(*args, **kwargs):
+            if _current_trace.get() is None:
+                return await func(*args, **kwargs)
+            with span(name):
+                return await func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def create_aiohttp_trace_config() -> aiohttp.TraceConfig:
+    """
+    Записывает спаном каждый HTTP-запрос, выполненный сессией aiohttp с этой конфигурацией.
+    """
+    async def on_request_start(session, ctx, params: aiohttp.TraceRequestStartParams):
+        ctx.span = span(f"http.{params.method}", host=params.url.host, path=params.url.path)
+        ctx.span.__enter__()
+
+    async def on_request_end(session, ctx, params: aiohttp.TraceRequestEndParams):
+        if ctx.span.item is not None:
+            ctx.span.item.attrs["status"] = params.response.status
+        ctx.span.__exit__(None, None, None)
+
+    async def on_request_exception(session, ctx, params: aiohttp.TraceRequestExceptionParams):
+        ctx.span.__exit__(type(params.exception), params.exception, None)
+
+    trace_config = aiohttp.TraceConfig()
+    trace_config.on_request_start.append(on_request_start)
+    trace_config.on_request_end.append(on_request_end)
+    trace_config.on_request_exception.append(on_request_exception)
+    return trace_config
+
+
+class TraceWriter:
+    """
+    Пишет трассы в JSONL-файл из отдельного потока, чтобы запись на диск не блокировала цикл событий.
+    """
+
+    _path: str
+    _queue: queue.SimpleQueue
+    _thread: threading.Thread | None
+    _logger: logging.Logger
+
+    def __init__(self, path: str):
+        self._path = path
+        self._queue = queue.SimpleQueue()
+        self._thread = None
+        self._logger = logging.getLogger("payment_api_logger")
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, name="trace-writer", daemon=True)
+        self._thread.start()
+
+    def write(self, data: dict):
+        if self._thread is not None:
+            self._queue.put(data)
+
+    def _run(self):
+        with open(self._path, "a", encoding="utf-8") as f:
+            while True:
+                data = self._queue.get()
+                if data is None:
+                    return
+                try:
+                    f.write(json.dumps(data, ensure_ascii=False, default=str) + "\n")
+                    if self._queue.empty():
+                        f.flush()
+                except Exception as ex:
+                    self._logger.exception("[TRACING] Failed to write trace", exc_info=ex)
+
+    def close(self, timeout: float = 5):
+        if self._thread is None:
+            return
+        self._queue.put(None)
+        self._thread.join(timeout)
+        self._thread = None
+
+
+class TracingMiddleware:
+    """
+    ASGI middleware, открывающее трассу на каждый HTTP-запрос.
+    Идентификатор берется из заголовка X-Request-Id (если он корректен) или генерируется, и возвращается в ответе.
+    """
+
+    _REQUEST_ID_PATTERN = re.compile(r"[A-Za-z0-9._-]{1,64}")
+
+    def __init__(self, app: ASGIApp, writer: TraceWriter, slow_threshold: float = 1, sample_rate: float = 0):
+        """
+        :param writer: куда записывать трассы
+        :param slow_threshold: трассы дольше этого времени, сек, записываются всегда
+        :param sample_rate: доля остальных трасс, которые записываются (от 0 до 1)
+        """
+        self.app = app
+        self._writer = writer
+        self._slow_threshold = slow_threshold
+        self._sample_rate = sample_rate
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        trace_id = self._get_request_id(scope) or uuid.uuid4().hex
+        trace = Trace(trace_id, f"{scope['method']} {scope['path']}")
+        status = 500
+
+        async def send_wrapper(message: Message):
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+                message["headers"] = [*message.get("headers", []), (b"x-request-id", trace_id.encode("ascii"))]
+            await send(message)
+
+        trace_token = _current_trace.set(trace)
+        span_token = _current_span.set(None)
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            _current_span.reset(span_token)
+            _current_trace.reset(trace_token)
+            duration = time.perf_counter() - trace.started
+            if duration >= self._slow_threshold or random.random() < self._sample_rate:
+                route = scope.get("route")
+                self._writer.write(trace.to_dict(duration, route=getattr(route, "path", None), status=status,
+                                                 slow=duration >= self._slow_threshold))
+
+    def _get_request_id(self, scope: Scope) -> str | None:
+        for name, value in scope.get("headers", []):
+            if name == b"x-request-id":
+                request_id = value.decode("latin-1")
+                return request_id if self._REQUEST_ID_PATTERN.fullmatch(request_id) else None
+        return None
@@ -0,0 +1,254 @@
+"""
+Доставка вебхуков об оплате на сервер игры.
+Вебхуки записываются в таблицу webhook_outbox в одной транзакции с оплатой счета, поэтому не теряются при перезапуске.
+Диспетчер забирает готовые к отправке записи пачками и отправляет их ограниченным набором asyncio-воркеров
+с лимитом одновременных запросов на один хост: вебхук на занятый хост откладывается в памяти, и воркер сразу берет
+следующий, поэтому медленный сервер не задерживает вебхуки на другие. Неудачные попытки откладываются в БД с экспоненциальной задержкой
+и случайным разбросом.
+"""
+import asyncio
+import logging
+import random
+from collections import defaultdict, deque
+from dataclasses import dataclass
+from urllib.parse import urlsplit
+
+from apis.sessions import ProviderSessions
+from db import DatabaseManager, OutboxEntry
+from metrics import WEBHOOK_DELIVERY_SECONDS, WEBHOOK_DELIVERIES
+
+
+@dataclass
+class WebhookDispatcherStats:
+    queued: int    # забранные из БД и ожидающие отправки (в том числе отложенные до освобождения хоста)
+    in_flight: int    # отправляемые прямо сейчас
+    delivered: int
+    retried: int    # неудачные попытки, отложенные на потом
+    failed: int    # вебхуки, не доставленные после всех попыток
+
+
+class WebhookDispatcher:
+    """
+    Отправка вебхуков из webhook_outbox. Запускается при старте приложения, при остановке дожидается отправки
+    уже забранных вебхуков, а неотправленные возвращает в БД.
+    """
+
+    _db_manager: DatabaseManager
+    _sessions: ProviderSessions
+    _auth_token: str
+    _workers_count: int
+    _per_destination_limit: int
+    _batch_size: int
+    _poll_interval: float
+    _lease_seconds: int
+    _max_attempts: int
+    _base_delay: float
+    _max_delay: float
+    _logger: logging.Logger
+
+    _queue: asyncio.Queue[OutboxEntry]
+    _workers: list[asyncio.Task]
+    _poller: asyncio.Task | None
+    _wakeup: asyncio.Event
+    _active: defaultdict[str, int]    # хост -> количество отправляемых на него прямо сейчас
+    _parked: dict[str, deque[OutboxEntry]]    # хост -> вебхуки, ожидающие, пока на этом хосте освободится место
+    _in_flight: int
+    _delivered: int
+    _retried: int
+    _failed: int
+
+    def __init__(self, db_manager: DatabaseManager, sessions: ProviderSessions, auth_token: str,
+                 workers: int = 8,
+                 per_destination_limit: int = 4,
+                 batch_size: int = 50,
+                 poll_interval: float = 5,
+                 lease_seconds: int = 120,
+                 max_attempts: int = 10,
+                 base_delay: float = 5,
+                 max_delay: float = 3600):
+        """
+        :param sessions: HTTP-сессии для отправки запросов на сервера игры
+        :param auth_token: значение заголовка User-Id, по которому сервер игры проверяет вебхук
+        :param workers: количество одновременно работающих отправителей
+        :param per_destination_limit: максимальное количество одновременных запросов на один хост
+        :param batch_size: сколько вебхуков забирать из БД за один запрос
+        :param poll_interval: как часто проверять БД, если новых вебхуков не поступало, сек
+        :param lease_seconds: на сколько забранный вебхук скрывается от других воркеров, сек;
+            должно быть больше времени, за которое пачка успевает отправиться
+        :param max_attempts: количество попыток доставки одного вебхука
+        :param base_delay: задержка перед первой повторной попыткой, сек; удваивается с каждой попыткой
+        :param max_delay: максимальная задержка между попытками, сек
+        """
+        self._db_manager = db_manager
+        self._sessions = sessions
+        self._auth_token = auth_token
+        self._workers_count = workers
+        self._per_destination_limit = per_destination_limit
+        self._batch_size = batch_size
+        self._poll_interval = poll_interval
+        self._lease_seconds = lease_seconds
+        self._max_attempts = max_attempts
+        self._base_delay = base_delay
+        self._max_delay = max_delay
+        self._logger = logging.getLogger("payment_api_logger")
+
+        self._queue = asyncio.Queue(batch_size)
+        self._workers = []
+        self._poller = None
+        self._wakeup = asyncio.Event()
+        self._active = defaultdict(int)
+        self._parked = {}
+        self._in_flight = 0
+        self._delivered = 0
+        self._retried = 0
+        self._failed = 0
+
+    async def start_async(self):
+        self._workers = [asyncio.create_task(self._worker_async()) for _ in range(self._workers_count)]
+        self._poller = asyncio.create_task(self._poll_async())
+
+    def notify(self):
+        """
+        Сообщает, что в webhook_outbox появились новые вебхуки, чтобы они были отправлены без ожидания опроса БД.
+        """
+        self._wakeup.set()
+
+    async def _poll_async(self):
+        while True:
+            # отложенные вебхуки тоже занимают место: иначе при медленном хосте их аренда истекала бы раньше отправки
+            limit = self._batch_size - self._get_parked_count()
+            entries = []
+            if limit > 0:
+                try:
+                    entries = await self._db_manager.claim_outbox_async(limit, self._lease_seconds)
+                except Exception as ex:
+                    self._logger.exception("[USER WEBHOOK] Failed to claim webhooks from outbox", exc_info=ex)
+
+            for entry in entries:
+                await self._queue.put(entry)
+
+            if limit > 0 and len(entries) == limit:
+                continue    # пачка заполнена целиком - вероятно, в БД есть еще
+
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), self._poll_interval)
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup.clear()
+
+    async def _worker_async(self):
+        while True:
+            entry = await self._queue.get()
+            destination = urlsplit(entry.url).netloc
+            if self._active[destination] >= self._per_destination_limit:
+                # хост занят: вебхук отправит воркер, который освободит на нем место, а этот берет следующий из очереди.
+                # task_done вызывается после отправки, чтобы stop_async дожидался и отложенных вебхуков
+                self._parked.setdefault(destination, deque()).append(entry)
+                continue
+
+            self._active[destination] += 1
+            try:
+                while entry is not None:
+                    await self._deliver_async(entry)
+                    entry = self._unpark(destination)
+            finally:
+                self._active[destination] -= 1
+                if not self._active[destination]:
+                    del self._active[destination]
+
+    def _unpark(self, destination: str) -> OutboxEntry | None:
+        parked = self._parked.get(destination)
+        if not parked:
+            return None
+        entry = parked.popleft()
+        if not parked:
+            del self._parked[destination]
+        return entry
+
+    def _get_parked_count(self) -> int:
+        return sum(len(parked) for parked in self._parked.values())
+
+    async def _deliver_async(self, entry: OutboxEntry):
+        self._in_flight += 1
+        try:
+            error = await self._send_async(entry)
+            await self._save_result_async(entry, error)
+        except Exception as ex:
+            # результат не записан - вебхук будет забран повторно после истечения lease_seconds
+            self._logger.exception("[USER WEBHOOK] Failed to save delivery result: id = %s", entry.invoice_id, exc_info=ex)
+        finally:
+            self._in_flight -= 1
+            self._queue.task_done()
+
+    async def _send_async(self, entry: OutboxEntry) -> str | None:
+        """
+        Отправляет вебхук. Возвращает текст ошибки или None, если вебхук доставлен.
+        """
+        try:
+            session = self._sessions.get(entry.url)
+            with WEBHOOK_DELIVERY_SECONDS.time():
+                async with session.post(entry.url, json=entry.payload, headers={"User-Id": self._auth_token}) as resp:
+                    if resp.status != 200:
+                        self._logger.error("Failed to send webhook with status code %s: id = %s", resp.status, entry.invoice_id)
+                        return f"HTTP {resp.status}"
+            self._logger.info("[USER WEBHOOK] Sended successfully: id = %s", entry.invoice_id)
+            return None
+        except Exception as ex:
+            self._logger.exception("Internal error occured while sending webhook: id = %s", entry.invoice_id, exc_info=ex)
+            return repr(ex)
+
+    async def _save_result_async(self, entry: OutboxEntry, error: str | None):
+        if error is None:
+            self._delivered += 1
+            WEBHOOK_DELIVERIES.inc("delivered")
+            await self._db_manager.mark_outbox_delivered_async(entry.id)
+            return
+
+        give_up = entry.attempts >= self._max_attempts
+        if give_up:
+            self._failed += 1
+            WEBHOOK_DELIVERIES.inc("failed")
+            self._logger.error("[USER WEBHOOK] Giving up after %s attempts: id = %s", entry.attempts, entry.invoice_id)
+        else:
+            self._retried += 1
+            WEBHOOK_DELIVERIES.inc("retried")
+        await self._db_manager.reschedule_outbox_async(entry.id, round(self.get_retry_delay(entry.attempts)), error, give_up)
+
+    def get_retry_delay(self, attempt: int) -> float:
+        """
+        Экспоненциальная задержка с полным случайным разбросом (full jitter), чтобы повторы к одному серверу не шли пачкой.
+        """
+        return random.uniform(0, min(self._max_delay, self._base_delay * 2 ** (attempt - 1)))
+
+    def get_stats(self) -> WebhookDispatcherStats:
+        return WebhookDispatcherStats(self._queue.qsize() + self._get_parked_count(), self._in_flight, self._delivered, self._retried, self._failed)
+
+    async def stop_async(self, timeout: float = 10):
+        """
+        Прекращает забирать вебхуки из БД и ждет отправки уже забранных (но не дольше timeout секунд).
+        Не отправленные за это время возвращаются в БД.
+        """
+        if self._poller is not None:
+            self._poller.cancel()
+            await asyncio.gather(self._poller, return_exceptions=True)
+            self._poller = None
+
+        try:
+            await asyncio.wait_for(self._queue.join(), timeout)
+        except asyncio.TimeoutError:
+            self._logger.warning("[USER WEBHOOK] Shutdown timeout, %s webhooks are returned to outbox",
+                                 self._queue.qsize() + self._get_parked_count())
+
+        for worker in self._workers:
+            worker.cancel()
+        await asyncio.gather(*self._workers, return_exceptions=True)
+        self._workers = []
+
+        unsent = [self._queue.get_nowait() for _ in range(self._queue.qsize())]
+        unsent += [entry for parked in self._parked.values() for entry in parked]
+        self._parked = {}
+        for entry in unsent:
+            try:
+                await self._db_manager.release_outbox_async(entry.id)
+            except Exception as ex:
+                self._logger.exception("[USER WEBHOOK] Failed to return webhook to outbox: id = %s", entry.invoice_id, exc_info=ex)